@@ -0,0 +1,143 @@
+from bisect import bisect_right
+
+import numpy as np
+import pandas as pd
+from fact.analysis import li_ma_significance
+
+
+NIGHTLY = 'nightly'
+
+
+def ontime_bin_starts(ontime, breaks, bin_width):
+    '''
+    First run of each bin for `ontime` binning of sorted runs.
+
+    Like `fact.analysis.binning.ontime_binning`, runs are added to a bin
+    until the next run would exceed `bin_width` seconds of ontime,
+    and a new bin is started at every index in `breaks`.
+    The cumulative ontime is computed once. Segments between breaks with
+    at most `bin_width` of ontime are a single bin, in the others the end
+    of each bin is found by bisecting the cumulative ontime.
+
+    Parameters
+    ----------
+    ontime: np.ndarray
+        ontime of each run in seconds
+    breaks: np.ndarray
+        sorted indices of runs that have to start a new bin
+    bin_width: float
+        ontime of a bin in seconds
+
+    Returns
+    -------
+    starts: np.ndarray
+        index of the first run of each bin
+    '''
+    n_runs = len(ontime)
+    cumulative = np.append(0, np.cumsum(ontime))
+
+    segment_starts = np.union1d([0], breaks).astype(np.int64)
+    segment_stops = np.append(segment_starts[1:], n_runs)
+    short = cumulative[segment_stops] - cumulative[segment_starts] <= bin_width
+
+    starts = [segment_starts[short]]
+    # plain python floats, bisect on a list is much faster than np.searchsorted on scalars
+    cumulative = cumulative.tolist()
+    for segment_start, segment_stop in zip(segment_starts[~short], segment_stops[~short]):
+        start = int(segment_start)
+        long_starts = []
+        while start < segment_stop:
+            long_starts.append(start)
+            # the runs start, ..., stop - 1 have at most bin_width ontime
+            stop = bisect_right(cumulative, cumulative[start] + bin_width, start, segment_stop + 1) - 1
+            # a single run longer than the bin width gets its own bin
+            start = max(stop, start + 1)
+        starts.append(long_starts)
+
+    return np.sort(np.concatenate(starts)).astype(np.int64)
+
+
+def bin_starts(runs, binning):
+    '''
+    First run of each bin for `runs` sorted by source and `run_start`,
+    `binning` is either `NIGHTLY` or the ontime of a bin in minutes.
+    Bins never contain runs of different sources.
+    '''
+    source = runs['source'].values
+    new_source = np.append(True, source[1:] != source[:-1])
+
+    if binning == NIGHTLY:
+        night = runs['night'].values
+        return np.flatnonzero(new_source | np.append(True, night[1:] != night[:-1]))
+
+    bin_width = float(binning) * 60
+    run_start = runs['run_start'].values
+    run_stop = runs['run_stop'].values
+    # a gap longer than the bin width also starts a new bin
+    gap = np.append(False, (run_start[1:] - run_stop[:-1]) > np.timedelta64(int(bin_width * 1e9), 'ns'))
+    breaks = np.flatnonzero(new_source | gap)
+    return ontime_bin_starts(runs['ontime'].values.astype(float), breaks, bin_width)
+
+
+def aggregate_bins(runs, starts, alpha):
+    '''
+    Sum the runs into the bins starting at `starts` and calculate
+    the excess rate and significance of each bin, with the same columns
+    as `fact.analysis.binning.bin_runs`
+    '''
+    binned = pd.DataFrame({
+        'ontime': np.add.reduceat(runs['ontime'].values.astype(float), starts),
+        'n_on': np.add.reduceat(runs['n_on'].values.astype(float), starts),
+        'n_off': np.add.reduceat(runs['n_off'].values.astype(float), starts),
+        'run_start': runs['run_start'].values[starts],
+        'run_stop': np.maximum.reduceat(runs['run_stop'].values, starts),
+    })
+    binned.index.name = 'bin'
+
+    binned['n_excess'] = binned.n_on - binned.n_off * alpha
+    binned['excess_rate_per_h'] = binned.n_excess / binned.ontime * 3600
+
+    binned['time_width'] = binned.run_stop - binned.run_start
+    binned['time_mean'] = binned.run_start + 0.5 * binned.time_width
+
+    binned['excess_rate_err'] = np.sqrt(binned.n_on + alpha**2 * binned.n_off)
+    binned['excess_rate_err'] /= binned.ontime / 3600
+
+    binned['significance'] = li_ma_significance(binned.n_on, binned.n_off, alpha)
+
+    binned['source'] = runs['source'].values[starts]
+    # the date at noon before the mean time as YYYYMMDD
+    noon = (binned.time_mean - pd.Timedelta(hours=12)).dt
+    binned['night'] = noon.year * 10000 + noon.month * 100 + noon.day
+    return binned
+
+
+def bin_runs(runs, alpha=0.2, binnings=(20, )):
+    '''
+    Bin a run summary for several light curve binnings at once,
+    sorting the runs only once.
+
+    Parameters
+    ----------
+    runs: pd.DataFrame
+        one row per run, required are `ontime`, `n_on`, `n_off`,
+        `run_start`, `run_stop`, `source` and, for nightly binning, `night`
+    alpha: float
+        ratio of on to off exposure
+    binnings: iterable
+        `NIGHTLY` or the ontime of a bin in minutes for each binning
+
+    Returns
+    -------
+    binned: dict
+        the binned runs for each of `binnings`
+    '''
+    runs = runs.sort_values(['source', 'run_start'], kind='stable')
+    binned = {}
+    for binning in binnings:
+        if len(runs) == 0:
+            starts = np.empty(0, dtype=np.int64)
+        else:
+            starts = bin_starts(runs, binning)
+        binned[binning] = aggregate_bins(runs, starts, alpha)
+    return binned
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'FACT_PLOTS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'fact_plots'),
+)
+DEFAULT_MAX_SIZE = 1024**3
+
+
+def file_identity(path):
+    '''
+    Identify the content of the file at `path` without reading it,
+    by its absolute path, size and modification time.
+    '''
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def cache_key(*parts):
+    '''
+    Hash json serializable `parts` into a key for `DiskCache`.
+    Dict keys are sorted, so the order of config entries does not matter.
+    '''
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class DiskCache:
+    '''
+    A directory of numpy arrays stored as `.npy` files, with a least
+    recently used eviction once the total size exceeds `max_size` bytes.
+
+    The modification time of a file is used as its last access time,
+    so no index has to be kept consistent between processes.
+    '''
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        '''Return the array stored for `key` or None'''
+        path = self._path(key)
+        try:
+            array = np.load(path, allow_pickle=False)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return array
+
+    def put(self, key, array, evict=True):
+        '''
+        Store `array` for `key` and evict old entries if needed.
+        When storing many entries at once, pass `evict=False`
+        and call `evict` once after the last one.
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asanyarray(array), allow_pickle=False)
+            # atomic, concurrent readers never see a partial file
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if evict:
+            self.evict()
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits into `max_size`'''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
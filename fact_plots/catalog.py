@@ -0,0 +1,196 @@
+import json
+import os
+import tempfile
+
+import h5py
+import numpy as np
+
+from .cache import DEFAULT_CACHE_DIR, cache_key, file_identity
+from .histograms import iter_chunks, resolve_column, DEFAULT_CHUNKSIZE
+from .memory import reserve
+from .quantiles import QuantileSketch
+
+
+CATALOG_VERSION = 3
+CATALOG_SUFFIX = '.catalog.json'
+# in percent like np.nanpercentile, p / 100 is not always exactly the stored quantile
+CATALOG_PERCENTILES = [0.1, 1, 5, 25, 50, 75, 95, 99, 99.9]
+
+
+class ColumnSummary:
+    '''
+    Statistics of a single column as stored in a catalog,
+    offering the same `min`, `max`, `percentile` and `len` interface
+    as `fact_plots.quantiles.QuantileSketch`.
+    Percentiles between the stored quantiles are interpolated linearly.
+    '''
+    def __init__(self, n, n_nan, min, max, quantiles):
+        self.n = n
+        self.n_nan = n_nan
+        self.min = min
+        self.max = max
+        self.quantiles = quantiles
+
+    def __len__(self):
+        return self.n
+
+    def percentile(self, p):
+        xp = [0.0] + CATALOG_PERCENTILES + [100.0]
+        fp = [self.min] + self.quantiles + [self.max]
+        return np.interp(np.asanyarray(p, dtype=float), xp, fp)[()]
+
+
+def list_columns(group):
+    '''
+    Column names of `group` as read by `fact.io.read_h5py` without `columns`:
+    all 1d datasets except `index`, which becomes the index of the DataFrame
+    '''
+    return [
+        name for name, dataset in group.items()
+        if isinstance(dataset, h5py.Dataset) and dataset.ndim == 1 and name != 'index'
+    ]
+
+
+def build_catalog(path, keys=('events', 'runs'), chunksize=DEFAULT_CHUNKSIZE):
+    '''
+    Collect column names, dtypes, row counts and per column
+    min, max, number of NaNs and coarse quantiles of the groups `keys`
+    of the h5py file at `path` in one chunked pass per group.
+
+    `chunksize` can be a `fact_plots.memory.MemoryBudget`,
+    the memory of the sketches of all columns is reserved from it.
+    '''
+    catalog = {
+        'version': CATALOG_VERSION,
+        'identity': file_identity(path),
+        'groups': {},
+    }
+
+    with h5py.File(path, 'r') as f:
+        layout = {}
+        for key in keys:
+            group = f.get(key)
+            if group is None:
+                continue
+
+            columns = list_columns(group)
+            dtypes = {
+                column: resolve_column(group, column)[0].dtype.str
+                for column in columns
+            }
+            if columns:
+                n_rows = resolve_column(group, columns[0])[0].shape[0]
+            else:
+                n_rows = 0
+            layout[key] = (columns, dtypes, n_rows)
+
+    for key, (columns, dtypes, n_rows) in layout.items():
+        numeric = [c for c in columns if np.dtype(dtypes[c]).kind in 'biuf']
+        sketches = {column: QuantileSketch() for column in numeric}
+        group_chunksize = reserve(chunksize, len(numeric) * QuantileSketch.max_nbytes())
+
+        for chunk in iter_chunks(path, numeric, key=key, chunksize=group_chunksize):
+            for column, sketch in sketches.items():
+                sketch.update(chunk[column])
+
+        summaries = {}
+        for column in columns:
+            summary = {'dtype': dtypes[column]}
+            sketch = sketches.get(column)
+            if sketch is not None:
+                summary.update(
+                    n_nan=int(sketch.n_nan),
+                    min=float(sketch.min) if len(sketch) > 0 else None,
+                    max=float(sketch.max) if len(sketch) > 0 else None,
+                    quantiles=[float(v) for v in np.atleast_1d(sketch.percentile(CATALOG_PERCENTILES))],
+                )
+            summaries[column] = summary
+
+        catalog['groups'][key] = {'n_rows': int(n_rows), 'columns': summaries}
+
+    return catalog
+
+
+def catalog_paths(path):
+    '''
+    Candidate locations of the catalog for `path`: a sidecar file next to it
+    and, for read only input directories, a file in the cache directory
+    '''
+    return [
+        path + CATALOG_SUFFIX,
+        os.path.join(
+            DEFAULT_CACHE_DIR, 'catalogs',
+            cache_key(os.path.abspath(path)) + CATALOG_SUFFIX,
+        ),
+    ]
+
+
+def write_catalog(catalog, path):
+    for catalog_path in catalog_paths(path):
+        directory = os.path.dirname(os.path.abspath(catalog_path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        except OSError:
+            continue
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(catalog, f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, catalog_path)
+        return catalog_path
+
+
+def read_catalog(path):
+    '''
+    Return the stored catalog for `path` or None, if there is none
+    or the file changed since it was built.
+    '''
+    identity = file_identity(path)
+    for catalog_path in catalog_paths(path):
+        try:
+            with open(catalog_path) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        if catalog.get('version') == CATALOG_VERSION and catalog.get('identity') == identity:
+            return catalog
+    return None
+
+
+def get_catalog(path, chunksize=DEFAULT_CHUNKSIZE):
+    '''Read the catalog for `path`, building and storing it if needed'''
+    catalog = read_catalog(path)
+    if catalog is None:
+        catalog = build_catalog(path, chunksize=chunksize)
+        write_catalog(catalog, path)
+    return catalog
+
+
+def get_columns(catalog, key='events'):
+    return list(catalog['groups'][key]['columns'].keys())
+
+
+def get_n_rows(catalog, key='events'):
+    return catalog['groups'][key]['n_rows']
+
+
+def get_column_summary(catalog, column, key='events'):
+    '''
+    `ColumnSummary` of a numeric column of the catalog,
+    None for non numeric columns
+    '''
+    summary = catalog['groups'][key]['columns'][column]
+    if 'quantiles' not in summary:
+        return None
+
+    n_nan = summary['n_nan']
+    n = get_n_rows(catalog, key) - n_nan
+    return ColumnSummary(
+        n=n,
+        n_nan=n_nan,
+        min=summary['min'],
+        max=summary['max'],
+        quantiles=summary['quantiles'],
+    )
@@ -0,0 +1,305 @@
+import ast
+import re
+
+import numexpr as ne
+import numpy as np
+
+
+# functions available in expressions and their number of arguments
+FUNCTIONS = {
+    name: 1 for name in (
+        'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan',
+        'sinh', 'cosh', 'tanh', 'arcsinh', 'arccosh', 'arctanh',
+        'log', 'log10', 'log1p', 'exp', 'expm1', 'sqrt', 'abs',
+    )
+}
+FUNCTIONS.update({'arctan2': 2, 'mod': 2, 'minimum': 2, 'maximum': 2, 'where': 3})
+
+CONSTANTS = {'pi': repr(np.pi), 'e': repr(np.e)}
+
+# column names that are not python identifiers are quoted in backticks
+QUOTED_COLUMN = re.compile(r'`([^`]+)`')
+
+BINARY_OPERATORS = {
+    ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+    ast.Pow: '**', ast.Mod: '%',
+    ast.BitAnd: '&', ast.BitOr: '|',
+}
+UNARY_OPERATORS = {ast.USub: '-', ast.UAdd: '+', ast.Not: '~', ast.Invert: '~'}
+BOOLEAN_OPERATORS = {ast.And: '&', ast.Or: '|'}
+COMPARISONS = {
+    ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=',
+    ast.Eq: '==', ast.NotEq: '!=',
+}
+
+# transforms of the old config format, which were evaluated as python
+LEGACY_TRANSFORMS = {
+    'wrap_angle': 'mod({}, 360)',
+}
+
+
+class Translator:
+    '''
+    Translate the python syntax tree of an expression into a numexpr
+    expression string, rejecting everything but arithmetic, comparisons
+    and the functions in `FUNCTIONS`.
+
+    Column names have to be python identifiers, other names
+    like `fact-size` can be quoted in backticks: `` `fact-size` ``.
+    Columns are replaced by placeholder variables `c<i>`, so column names
+    don't have to be valid numexpr identifiers. Names in `definitions`
+    are replaced by the expression they define.
+    Names of columns in `available` are used as columns even if they are
+    one of the `CONSTANTS` like `e`, other constant names are constants.
+
+    `not` requires a boolean operand. Operands that are columns are
+    collected in `boolean_columns` to be checked once the data is read,
+    see `check_boolean`.
+    '''
+    def __init__(self, columns=None, definitions=None, available=None):
+        self.columns = columns if columns is not None else {}
+        self.definitions = definitions or {}
+        self.available = set(available) if available is not None else set()
+        self.boolean_columns = set()
+        self._quoted = {}
+        self._expanding = []
+
+    def translate(self, source):
+        node, text = self.parse(source)
+        return self.visit(node, text)
+
+    def parse(self, source):
+        '''The syntax tree of `source` and the parsed text, with quoted names replaced by identifiers'''
+        def replace(match):
+            var = '_quoted_{}'.format(len(self._quoted))
+            self._quoted[var] = match.group(1)
+            return var
+
+        text = QUOTED_COLUMN.sub(replace, source.strip())
+        try:
+            return ast.parse(text, mode='eval').body, text
+        except SyntaxError as e:
+            raise ValueError('Invalid expression "{}": {}'.format(source, e.msg))
+
+    def restore(self, text):
+        '''`text` with the quoted names put back in, for error messages'''
+        return re.sub(r'_quoted_\d+', lambda m: '`{}`'.format(self._quoted[m.group()]), text)
+
+    def segment(self, node, text):
+        return self.restore(ast.get_source_segment(text, node) or type(node).__name__)
+
+    def column(self, name):
+        for var, column in self.columns.items():
+            if column == name:
+                return var
+        var = 'c{}'.format(len(self.columns))
+        self.columns[var] = name
+        return var
+
+    def is_constant(self, name):
+        return name in CONSTANTS and name not in self.available
+
+    def boolean(self, node):
+        '''
+        Whether `node` is boolean, None if that depends on the dtype of columns,
+        which are added to `boolean_columns`
+        '''
+        def combine(nodes):
+            kinds = [self.boolean(n) for n in nodes]
+            if False in kinds:
+                return False
+            if None in kinds:
+                return None
+            return True
+
+        if isinstance(node, ast.Compare):
+            return True
+        if isinstance(node, ast.BoolOp):
+            return combine(node.values)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.Invert)):
+            return self.boolean(node.operand)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            return combine([node.left, node.right])
+        if isinstance(node, ast.Call) and function_name(node.func) == 'where' and len(node.args) == 3:
+            return combine(node.args[1:])
+        if isinstance(node, ast.Name):
+            if node.id in self._quoted:
+                self.boolean_columns.add(self._quoted[node.id])
+                return None
+            if node.id in self.definitions:
+                return self.boolean(self.parse(self.definitions[node.id])[0])
+            if self.is_constant(node.id):
+                return False
+            self.boolean_columns.add(node.id)
+            return None
+        return False
+
+    def visit(self, node, source):
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise ValueError('Only numbers are allowed as constants in "{}"'.format(self.restore(source)))
+            return repr(node.value)
+
+        if isinstance(node, ast.Name):
+            if node.id in self._quoted:
+                return self.column(self._quoted[node.id])
+            if node.id in self.definitions:
+                if node.id in self._expanding:
+                    raise ValueError('Recursive definition of "{}"'.format(node.id))
+                self._expanding.append(node.id)
+                expression = self.translate(self.definitions[node.id])
+                self._expanding.pop()
+                return '({})'.format(expression)
+            if self.is_constant(node.id):
+                return CONSTANTS[node.id]
+            return self.column(node.id)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            return '({} {} {})'.format(
+                self.visit(node.left, source),
+                BINARY_OPERATORS[type(node.op)],
+                self.visit(node.right, source),
+            )
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            operand = self.visit(node.operand, source)
+            # numexpr's ~ is a bitwise not, which fails for floats
+            if isinstance(node.op, ast.Not) and self.boolean(node.operand) is False:
+                raise ValueError('"not" needs a boolean operand like a comparison, not "{}" in "{}"'.format(
+                    self.segment(node.operand, source), self.restore(source),
+                ))
+            return '({}{})'.format(UNARY_OPERATORS[type(node.op)], operand)
+
+        if isinstance(node, ast.BoolOp):
+            operator = ' {} '.format(BOOLEAN_OPERATORS[type(node.op)])
+            return '({})'.format(operator.join(self.visit(v, source) for v in node.values))
+
+        if isinstance(node, ast.Compare) and all(type(op) in COMPARISONS for op in node.ops):
+            # chained comparisons like 0 < x < 1 become (0 < x) & (x < 1)
+            operands = [self.visit(node.left, source)]
+            operands += [self.visit(c, source) for c in node.comparators]
+            terms = [
+                '({} {} {})'.format(left, COMPARISONS[type(op)], right)
+                for left, op, right in zip(operands[:-1], node.ops, operands[1:])
+            ]
+            return '({})'.format(' & '.join(terms))
+
+        if isinstance(node, ast.Call):
+            name = function_name(node.func)
+            if name not in FUNCTIONS or node.keywords:
+                raise ValueError('Unknown function "{}" in "{}"'.format(
+                    self.segment(node.func, source), self.restore(source),
+                ))
+            if len(node.args) != FUNCTIONS[name]:
+                raise ValueError('{} takes {} arguments in "{}"'.format(
+                    name, FUNCTIONS[name], self.restore(source),
+                ))
+            args = [self.visit(arg, source) for arg in node.args]
+
+            if name == 'mod':
+                return '({} % {})'.format(*args)
+            if name == 'minimum':
+                return 'where({0} < {1}, {0}, {1})'.format(*args)
+            if name == 'maximum':
+                return 'where({0} > {1}, {0}, {1})'.format(*args)
+            return '{}({})'.format(name, ', '.join(args))
+
+        raise ValueError('Unsupported syntax "{}" in "{}"'.format(
+            self.segment(node, source), self.restore(source),
+        ))
+
+
+def quote(column):
+    '''`column` to be used in an expression, in backticks if it is not an identifier'''
+    return column if column.isidentifier() else '`{}`'.format(column)
+
+
+def check_boolean(chunk, columns):
+    '''Raise a ValueError if one of `columns` of `chunk`, used with `not`, is not boolean'''
+    for column in columns:
+        if chunk[column].dtype.kind != 'b':
+            raise ValueError('"not" needs a boolean operand, but column "{}" is {}'.format(
+                column, chunk[column].dtype,
+            ))
+
+
+def function_name(node):
+    '''Name of a called function, accepting `np.` or `numpy.` as prefix'''
+    if isinstance(node, ast.Name):
+        return node.id
+    if (
+        isinstance(node, ast.Attribute)
+        and isinstance(node.value, ast.Name)
+        and node.value.id in ('np', 'numpy')
+    ):
+        return node.attr
+    return None
+
+
+class Expression:
+    '''
+    An expression on the columns of a file like `log10(size)`,
+    `width / length` or `mod(az, 360)`, compiled into a single numexpr
+    kernel that computes the result chunk by chunk without full size
+    temporary arrays.
+
+    Parameters
+    ----------
+    source: str
+        the expression, using python syntax for arithmetic, comparisons,
+        `and`, `or`, `not` and the functions in `FUNCTIONS`, column names
+        that are not python identifiers have to be quoted in backticks
+    definitions: dict or None
+        mapping of names to expressions, e.g. other derived columns,
+        that can be used in `source`
+    available: iterable or None
+        the columns of the files, see `Translator`
+    '''
+    def __init__(self, source, definitions=None, available=None):
+        self.source = source
+        translator = Translator(definitions=definitions, available=available)
+        self.expression = translator.translate(source)
+        self.columns = translator.columns
+        self.boolean_columns = translator.boolean_columns
+        if not self.columns:
+            raise ValueError('Expression "{}" does not use any column'.format(source))
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.source)
+
+    def evaluate(self, chunk):
+        '''Evaluate on `chunk`, a mapping of column name to array'''
+        if self.expression == 'c0':
+            # a single column, e.g. used for slicing, can also be non numeric
+            return chunk[self.columns['c0']]
+
+        check_boolean(chunk, self.boolean_columns)
+        # numexpr caches the compiled expression, so only the first chunk pays for it
+        local_dict = {var: chunk[column] for var, column in self.columns.items()}
+        return ne.evaluate(self.expression, local_dict=local_dict)
+
+
+def transform_source(column, transform):
+    '''
+    Expression for a column `transform` of the config, which is either
+    a full expression like `log10(size)`, the name of a function applied
+    to the column like `log10` or one of the `LEGACY_TRANSFORMS`
+    '''
+    transform = transform.strip()
+    if transform in LEGACY_TRANSFORMS:
+        return LEGACY_TRANSFORMS[transform].format(quote(column))
+    name = transform.rpartition('.')[2] if transform.startswith(('np.', 'numpy.')) else transform
+    if FUNCTIONS.get(name) == 1:
+        return '{}({})'.format(name, quote(column))
+    return transform
+
+
+def required_columns(columns, expressions):
+    '''Columns to read for `columns`, some of which may be computed by `expressions`'''
+    required = set()
+    for column in columns:
+        if column in expressions:
+            required.update(expressions[column].columns.values())
+        else:
+            required.add(column)
+    return required
@@ -0,0 +1,163 @@
+import glob
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+from fact.io import read_h5py
+
+from .cache import file_identity
+from .histograms import iter_chunks, DEFAULT_CHUNKSIZE
+from .theta_squared import RUN_ID_FACTOR, chunk_theta, theta_columns
+
+
+HDF5_PATTERNS = ('*.hdf5', '*.hdf', '*.h5')
+
+
+def input_files(path):
+    '''The hdf5 files to follow, `path` itself or all hdf5 files in the directory `path`'''
+    if not os.path.isdir(path):
+        return [path]
+    files = set()
+    for pattern in HDF5_PATTERNS:
+        files.update(glob.glob(os.path.join(path, pattern)))
+    return sorted(files)
+
+
+class RunCounter:
+    '''
+    Count the on and off events of each run in hdf5 files that grow
+    during observations, reading only the events appended since the
+    last call of `update`.
+
+    The counts are the same as of `fact_plots.theta_squared.run_summary`,
+    so the work per update depends only on the number of new events
+    and not on the length of the files.
+
+    Parameters
+    ----------
+    threshold: float
+        only events with a `gamma_prediction` of at least `threshold` are counted
+    theta2_cut: float
+        events with theta² up to `theta2_cut` are counted
+    key: str
+        name of the hdf5 group of the events
+    n_off: int or None
+        compute theta for `n_off` off positions, see `fact_plots.theta_squared.read_theta`
+    '''
+    def __init__(self, threshold, theta2_cut, key='events', n_off=None, chunksize=DEFAULT_CHUNKSIZE):
+        self.threshold = threshold
+        self.theta_cut = np.sqrt(theta2_cut)
+        self.key = key
+        self.n_off = n_off
+        self.chunksize = chunksize
+        self.n_regions = None
+        # for each file: identity at the last update, the file system entry
+        # and last counted row to detect replaced files, number of rows
+        # already counted, counts per run key and the runs table
+        self.identities = {}
+        self.inodes = {}
+        self.last_rows = {}
+        self.rows_seen = {}
+        self.counts = {}
+        self.runs = {}
+
+    def _read_row(self, path, columns, row):
+        '''The raw bytes of `row` of `columns`, to recognise it after the file changed'''
+        chunk = next(iter_chunks(path, columns, key=self.key, start=row, stop=row + 1))
+        return b''.join(chunk[column].tobytes() for column in columns)
+
+    def _replaced(self, path, columns, n_rows):
+        '''
+        Whether `path` is not the file seen before with events appended:
+        another file system entry, fewer rows or a different last counted row
+        '''
+        stat = os.stat(path)
+        if self.inodes.get(path) != (stat.st_dev, stat.st_ino):
+            return True
+        start = self.rows_seen[path]
+        if n_rows < start:
+            return True
+        return start > 0 and self._read_row(path, columns, start - 1) != self.last_rows[path]
+
+    def update(self, path):
+        '''
+        Count the events of `path` appended since the last update
+        and re-read its runs table, return the number of new events.
+        Files that did not change since the last update are not opened,
+        replaced files are counted again from the start.
+        '''
+        identity = file_identity(path)
+        if self.identities.get(path) == identity:
+            return 0
+
+        off_columns, n_regions, columns = theta_columns(path, key=self.key, n_off=self.n_off)
+        if self.n_regions is not None and n_regions != self.n_regions:
+            raise ValueError('{} has {} off regions instead of {}'.format(path, n_regions, self.n_regions))
+        self.n_regions = n_regions
+        columns = columns + ['gamma_prediction', 'night', 'run_id']
+
+        with h5py.File(path, 'r') as f:
+            n_rows = f[self.key][columns[0]].shape[0]
+
+        if path in self.rows_seen and self._replaced(path, columns, n_rows):
+            del self.rows_seen[path]
+            del self.counts[path]
+        start = self.rows_seen.get(path, 0)
+        counts = self.counts.setdefault(path, {})
+
+        offset = start
+        for chunk in iter_chunks(
+            path, columns, key=self.key, chunksize=self.chunksize, start=start, stop=n_rows,
+        ):
+            # n_off stays None when the stored columns are used
+            theta = chunk_theta(chunk, off_columns, self.n_off)
+            offset += theta.shape[1]
+
+            selected = chunk['gamma_prediction'] >= self.threshold
+            on = selected & (theta[0] <= self.theta_cut)
+            off = np.sum(selected & (theta[1:] <= self.theta_cut), axis=0)
+
+            run_keys = chunk['night'].astype(np.int64) * RUN_ID_FACTOR + chunk['run_id']
+            unique_keys, run_index = np.unique(run_keys, return_inverse=True)
+            n_on = np.bincount(run_index, weights=on, minlength=len(unique_keys))
+            n_off_events = np.bincount(run_index, weights=off, minlength=len(unique_keys))
+            for run_key, run_on, run_off in zip(unique_keys.tolist(), n_on, n_off_events):
+                previous = counts.get(run_key, (0, 0))
+                counts[run_key] = (previous[0] + int(run_on), previous[1] + int(run_off))
+
+        stat = os.stat(path)
+        self.inodes[path] = (stat.st_dev, stat.st_ino)
+        if offset > start:
+            self.last_rows[path] = self._read_row(path, columns, offset - 1)
+        self.rows_seen[path] = offset
+        self.identities[path] = identity
+
+        runs = read_h5py(path, key='runs')
+        runs['run_start'] = pd.to_datetime(runs['run_start'])
+        runs['run_stop'] = pd.to_datetime(runs['run_stop'])
+        self.runs[path] = runs
+
+        return offset - start
+
+    @property
+    def n_runs(self):
+        return sum(len(runs) for runs in self.runs.values())
+
+    def summary(self):
+        '''The runs tables of all files with the `n_on` and `n_off` counts of each run'''
+        run_keys = []
+        n_on = []
+        n_off = []
+        for counts in self.counts.values():
+            run_keys.extend(counts.keys())
+            n_on.extend(on for on, _ in counts.values())
+            n_off.extend(off for _, off in counts.values())
+        night, run_id = np.divmod(np.array(run_keys, dtype=np.int64), RUN_ID_FACTOR)
+        counts = pd.DataFrame({'night': night, 'run_id': run_id, 'n_on': n_on, 'n_off': n_off})
+        counts = counts.groupby(['night', 'run_id'], as_index=False).sum()
+
+        runs = pd.concat(list(self.runs.values()), ignore_index=True)
+        summary = runs.merge(counts, on=['night', 'run_id'], how='left')
+        summary[['n_on', 'n_off']] = summary[['n_on', 'n_off']].fillna(0)
+        return summary
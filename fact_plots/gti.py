@@ -0,0 +1,274 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+
+def to_nanoseconds(time):
+    '''A datetime, timestamp or string as int64 nanoseconds since the epoch'''
+    return np.datetime64(pd.Timestamp(time).to_datetime64(), 'ns').view(np.int64)
+
+
+def datetime_column_to_nanoseconds(column):
+    '''A pandas column of datetimes as int64 nanoseconds since the epoch'''
+    return pd.to_datetime(column).values.astype('datetime64[ns]').view(np.int64)
+
+
+# used for open ends of intervals, far enough apart for all time spans
+# but close enough that sums of durations don't overflow
+OPEN_START = to_nanoseconds('1970-01-01')
+OPEN_STOP = to_nanoseconds('2200-01-01')
+
+
+def read_ranges(path):
+    '''
+    Read time intervals from a text file with one interval per line, start and stop
+    separated by a comma or tab, e.g. `2016-01-01 20:00, 2016-01-02 04:00`.
+    Empty lines and lines starting with `#` are ignored.
+
+    Returns
+    -------
+    ranges: list
+        pairs of start and stop strings
+    '''
+    ranges = []
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = re.split(r'\s*[,\t]\s*', line)
+            if len(parts) != 2:
+                raise ValueError('Line {} of {} is not "start, stop"'.format(number, path))
+            ranges.append(tuple(parts))
+    return ranges
+
+
+class GTI:
+    '''
+    Good time intervals, a set of closed time intervals [start, stop],
+    stored as sorted, non overlapping int64 nanoseconds.
+
+    Overlapping intervals passed to the constructor are merged.
+    All operations are vectorised with `np.searchsorted` over the interval
+    boundaries, so applying M intervals to N events or runs is O(N log M).
+    '''
+    def __init__(self, starts, stops):
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        if np.any(stops < starts):
+            raise ValueError('Time intervals must not end before they start')
+
+        order = np.argsort(starts, kind='stable')
+        starts, stops = starts[order], stops[order]
+
+        # an interval starts a new merged interval if it starts after all previous ones stopped
+        if len(starts) > 0:
+            previous_stop = np.maximum.accumulate(stops)[:-1]
+            first = np.flatnonzero(np.append(True, starts[1:] > previous_stop))
+            starts, stops = starts[first], np.maximum.reduceat(stops, first)
+
+        self.starts = starts
+        self.stops = stops
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        '''From pairs of start and stop, anything `pd.Timestamp` accepts, None for an open end'''
+        starts = [OPEN_START if start is None else to_nanoseconds(start) for start, _ in ranges]
+        stops = [OPEN_STOP if stop is None else to_nanoseconds(stop) for _, stop in ranges]
+        return cls(starts, stops)
+
+    @classmethod
+    def from_file(cls, path):
+        '''From a text file with one interval per line, see `read_ranges`'''
+        return cls.from_ranges(read_ranges(path))
+
+    @classmethod
+    def from_runs(cls, runs):
+        '''From the `run_start` and `run_stop` columns of a runs table, e.g. of runs passing quality cuts'''
+        return cls(
+            datetime_column_to_nanoseconds(runs['run_start']),
+            datetime_column_to_nanoseconds(runs['run_stop']),
+        )
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return '{}({} intervals)'.format(self.__class__.__name__, len(self))
+
+    def intersect(self, other):
+        '''The times in both `self` and `other`'''
+        if len(self) == 0 or len(other) == 0:
+            return GTI([], [])
+
+        # every intersection starts at a start of one of the sets inside the other
+        # and stops at the first stop of the two intervals containing that start
+        starts = np.concatenate([self.starts, other.starts])
+        inside = self.contains(starts) & other.contains(starts)
+        starts = starts[inside]
+        stops = np.minimum(
+            self.stops[self.interval_index(starts)],
+            other.stops[other.interval_index(starts)],
+        )
+        return GTI(starts, stops)
+
+    def interval_index(self, times):
+        '''Index of the last interval starting at or before each of `times`, -1 for none'''
+        return np.searchsorted(self.starts, times, side='right') - 1
+
+    def contains(self, times):
+        '''Whether each of `times`, int64 nanoseconds, is inside an interval'''
+        times = np.asarray(times, dtype=np.int64)
+        if len(self) == 0:
+            return np.zeros(times.shape, dtype=bool)
+        index = self.interval_index(times)
+        return (index >= 0) & (times <= self.stops[np.clip(index, 0, None)])
+
+    def overlaps(self, starts, stops):
+        '''Whether each of the intervals [`starts`, `stops`] overlaps with an interval'''
+        if len(self) == 0:
+            return np.zeros(np.shape(starts), dtype=bool)
+        # the first interval not stopping before the start has to start before the stop
+        index = np.searchsorted(self.stops, starts, side='left')
+        valid = index < len(self)
+        return valid & (self.starts[np.clip(index, 0, len(self) - 1)] <= stops)
+
+    def covered(self, times):
+        '''Time in nanoseconds covered by intervals before each of `times`'''
+        times = np.asarray(times, dtype=np.int64)
+        if len(self) == 0:
+            return np.zeros(times.shape, dtype=np.int64)
+        durations = self.stops - self.starts
+        cumulative = np.append(0, np.cumsum(durations))
+        index = self.interval_index(times)
+        clipped = np.clip(index, 0, None)
+        partial = np.clip(times - self.starts[clipped], 0, durations[clipped])
+        return np.where(index >= 0, cumulative[clipped] + partial, 0)
+
+    def overlap(self, starts, stops):
+        '''Time in nanoseconds of each of [`starts`, `stops`] covered by intervals'''
+        return self.covered(stops) - self.covered(starts)
+
+    def ontime_fraction(self, starts, stops):
+        '''Fraction of each of [`starts`, `stops`] covered by intervals'''
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        durations = stops - starts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = self.overlap(starts, stops) / durations
+        # empty intervals are either completely in or out
+        return np.where(durations > 0, fraction, self.contains(starts).astype(float))
+
+    def select_runs(self, runs):
+        '''
+        The runs overlapping the intervals with their `ontime` scaled
+        by the fraction of the run inside the intervals,
+        which is stored in the new column `ontime_fraction`
+        '''
+        fraction = self.ontime_fraction(
+            datetime_column_to_nanoseconds(runs['run_start']),
+            datetime_column_to_nanoseconds(runs['run_stop']),
+        )
+        runs = runs.assign(ontime=runs['ontime'] * fraction, ontime_fraction=fraction)
+        return runs[fraction > 0]
+
+
+def build_gti(start=None, end=None, path=None, runs=None, run_selection=None):
+    '''
+    Combine the time selections of the command line scripts into one `GTI`,
+    None if there is no selection at all.
+
+    Parameters
+    ----------
+    start, end: datetime or None
+        a single time window
+    path: str or None
+        file with intervals, see `GTI.from_file`
+    runs: pd.DataFrame or None
+        the runs table, needed for `run_selection`
+    run_selection: str or None
+        query on the runs table, e.g. on quality flags, only the time
+        of the selected runs is used
+    '''
+    selections = []
+    if start is not None or end is not None:
+        selections.append(GTI.from_ranges([(start, end)]))
+    if path is not None:
+        selections.append(GTI.from_file(path))
+    if run_selection is not None:
+        selections.append(GTI.from_runs(runs.query(run_selection)))
+
+    if not selections:
+        return None
+
+    gti = selections[0]
+    for selection in selections[1:]:
+        gti = gti.intersect(selection)
+    return gti
+
+
+class TimeWindows:
+    '''
+    Separate, non overlapping time windows, e.g. one per month,
+    to split a data set into.
+
+    Parameters
+    ----------
+    labels: list[str]
+        name of each window, e.g. used in file names
+    starts: np.ndarray
+    stops: np.ndarray
+        int64 nanoseconds, window `i` is [starts[i], stops[i]]
+    '''
+    def __init__(self, labels, starts, stops):
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        order = np.argsort(starts, kind='stable')
+        self.labels = [labels[i] for i in order]
+        self.starts = starts[order]
+        self.stops = stops[order]
+        if np.any(self.stops < self.starts):
+            raise ValueError('Time windows must not end before they start')
+        if np.any(self.starts[1:] <= self.stops[:-1]):
+            raise ValueError('Time windows must not overlap')
+
+    @classmethod
+    def from_file(cls, path):
+        '''From a text file with one window per line, see `read_ranges`'''
+        ranges = read_ranges(path)
+        return cls(
+            ['{}_{}'.format(*(pd.Timestamp(t).strftime('%Y%m%d%H%M') for t in r)) for r in ranges],
+            [to_nanoseconds(start) for start, _ in ranges],
+            [to_nanoseconds(stop) for _, stop in ranges],
+        )
+
+    @classmethod
+    def periodic(cls, start, end, freq):
+        '''
+        The periods between `start` and `end` with frequency `freq`,
+        a pandas period alias like `M` for months, `Y` for years or `7D`
+        '''
+        periods = pd.period_range(pd.Timestamp(start), pd.Timestamp(end), freq=freq)
+        return cls(
+            [str(period) for period in periods],
+            [to_nanoseconds(period.start_time) for period in periods],
+            [to_nanoseconds(period.end_time) for period in periods],
+        )
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(zip(self.labels, self.starts, self.stops))
+
+    def gti(self):
+        '''All windows as one `GTI`'''
+        return GTI(self.starts, self.stops)
+
+    def window_index(self, times):
+        '''Index of the window containing each of `times`, int64 nanoseconds, -1 for none'''
+        times = np.asarray(times, dtype=np.int64)
+        index = np.searchsorted(self.starts, times, side='right') - 1
+        inside = (index >= 0) & (times <= self.stops[np.clip(index, 0, None)])
+        return np.where(inside, index, -1)
@@ -0,0 +1,484 @@
+import json
+
+import h5py
+import numpy as np
+from fact.io import to_native_byteorder
+
+from .quantiles import QuantileSketch
+from .expressions import required_columns
+from .memory import resolve_chunksize
+from .profiling import profiler
+
+
+DEFAULT_CHUNKSIZE = 1000000
+
+
+def resolve_column(group, column):
+    '''
+    Find the dataset for `column` in the h5py `group`.
+
+    Two dimensional datasets are split into columns `<name>_<i>`
+    by `fact.io.read_h5py`, so these names are resolved to the
+    dataset and the index into its second axis.
+
+    Returns
+    -------
+    dataset: h5py.Dataset
+    index: int or None
+    '''
+    if column in group:
+        return group[column], None
+
+    base, _, index = column.rpartition('_')
+    if base in group and index.isdigit() and group[base].ndim == 2:
+        return group[base], int(index)
+
+    raise KeyError('Column "{}" not in group "{}"'.format(column, group.name))
+
+
+def iter_chunks(path, columns, key='events', chunksize=DEFAULT_CHUNKSIZE, rows=None, start=0, stop=None):
+    '''
+    Read `columns` of the group `key` in the h5py file at `path`
+    in chunks of `chunksize` rows, opening the file only once.
+
+    Parameters
+    ----------
+    path: str
+        path to the hdf5 file
+    columns: iterable[str]
+        column names as returned by `fact.io.read_h5py`
+    key: str
+        name of the hdf5 group
+    chunksize: int or fact_plots.memory.MemoryBudget
+        number of rows read at once, or a memory budget from which
+        the number of rows is calculated using the size of the columns
+    rows: array-like[int] or None
+        Sorted indices of the selected rows, e.g. from
+        `fact_plots.selection.select_rows`. If given, only the selected
+        rows are returned, chunks without any selected row are not read
+        at all and otherwise only the span between the first and last
+        selected row of a chunk is read.
+    start: int
+    stop: int or None
+        only read the rows `start` to `stop`, by default all,
+        e.g. the rows appended to a file since it was last read
+
+    Yields
+    ------
+    chunk: dict
+        mapping of column name to numpy array
+    '''
+    with h5py.File(path, 'r') as f:
+        group = f.get(key)
+        if group is None:
+            raise IOError('File does not contain group "{}"'.format(key))
+
+        datasets = {column: resolve_column(group, column) for column in columns}
+        if not datasets:
+            return
+        n_rows = next(iter(datasets.values()))[0].shape[0]
+        if stop is None or stop > n_rows:
+            stop = n_rows
+
+        bytes_per_row = sum(dataset.dtype.itemsize for dataset, _ in datasets.values())
+        chunksize = resolve_chunksize(chunksize, bytes_per_row)
+
+        if rows is not None:
+            rows = np.asarray(rows)
+            edges = np.minimum(np.arange(start, stop + chunksize, chunksize), stop)
+            boundaries = np.searchsorted(rows, edges)
+
+        for i, chunk_start in enumerate(range(start, stop, chunksize)):
+            chunk_stop = min(chunk_start + chunksize, stop)
+
+            if rows is not None:
+                chunk_rows = rows[boundaries[i]:boundaries[i + 1]]
+                if len(chunk_rows) == 0:
+                    continue
+                chunk_start, chunk_stop = chunk_rows[0], chunk_rows[-1] + 1
+                chunk_rows = chunk_rows - chunk_start
+
+            chunk = {}
+            for column, (dataset, index) in datasets.items():
+                if index is None:
+                    array = dataset[chunk_start:chunk_stop]
+                else:
+                    array = dataset[chunk_start:chunk_stop, index]
+
+                array = to_native_byteorder(array)
+                if rows is not None:
+                    array = array[chunk_rows]
+                chunk[column] = array
+
+            profiler.add_rows(len(array))
+            yield chunk
+
+
+def fill_histograms(
+    path,
+    bins,
+    transforms=None,
+    rows=None,
+    weights=None,
+    key='events',
+    chunksize=DEFAULT_CHUNKSIZE,
+    slicing=None,
+):
+    '''
+    Fill weighted histograms for many columns in a single chunked
+    pass over the file at `path`.
+
+    Parameters
+    ----------
+    path: str
+        path to the hdf5 file
+    bins: dict
+        mapping of column name to the bin edges for that column
+    transforms: dict or None
+        mapping of column name to a `fact_plots.expressions.Expression`,
+        which is evaluated on each chunk and histogrammed instead of the
+        column, so derived columns not in the file can be histogrammed
+    rows: array-like[int] or None
+        sorted indices of the selected rows, only these are histogrammed
+    weights: array-like or None
+        weights of the selected rows
+    key: str
+        name of the hdf5 group
+    chunksize: int or fact_plots.memory.MemoryBudget
+        number of rows read at once
+    slicing: Slicing or None
+        If given, one histogram per slice is filled in the same pass
+        and the arrays of bin contents have the shape (n_slices, n_bins)
+
+    Returns
+    -------
+    counts: dict
+        mapping of column name to the array of bin contents
+    sumw2: dict
+        mapping of column name to the array of summed squared weights,
+        the squared statistical uncertainty of the bin contents
+    '''
+    transforms = transforms or {}
+    n_slices = slicing.n_slices if slicing is not None else None
+
+    def shape(edges):
+        n_bins = len(edges) - 1
+        return (n_slices, n_bins) if slicing is not None else (n_bins, )
+
+    counts = {column: np.zeros(shape(edges)) for column, edges in bins.items()}
+    sumw2 = {column: np.zeros(shape(edges)) for column, edges in bins.items()}
+
+    if weights is not None:
+        weights = np.asarray(weights)
+
+    offset = 0
+    columns = required_columns(bins.keys(), transforms)
+    if slicing is not None:
+        columns |= slicing.columns
+
+    for chunk in iter_chunks(path, columns, key=key, chunksize=chunksize, rows=rows):
+        n_rows = len(next(iter(chunk.values())))
+        if weights is not None:
+            chunk_weights = weights[offset:offset + n_rows]
+        else:
+            chunk_weights = None
+        offset += n_rows
+
+        slices = slicing.indices(chunk) if slicing is not None else None
+
+        for column, edges in bins.items():
+            values = column_values(chunk, column, transforms)
+
+            c, s = histogram(
+                values, edges, weights=chunk_weights, slices=slices, n_slices=n_slices,
+            )
+            counts[column] += c
+            sumw2[column] += s
+
+    return counts, sumw2
+
+
+def column_values(chunk, column, transforms):
+    '''Values of `column` in `chunk`, computed by its expression in `transforms` if any'''
+    if column in transforms:
+        return transforms[column].evaluate(chunk)
+    return chunk[column]
+
+
+def bin_indices(values, edges):
+    '''
+    Index of the bin of each value, -1 for values outside of the edges
+    or NaN. As for `np.histogram`, the last bin includes its upper edge.
+
+    For equally spaced edges, the index is computed directly instead of
+    a binary search, the result is identical to `np.histogram`.
+    '''
+    values = np.asanyarray(values)
+    edges = np.asanyarray(edges, dtype=float)
+    n_bins = len(edges) - 1
+    first, last = edges[0], edges[-1]
+
+    valid = (values >= first) & (values <= last)
+    indices = np.full(len(values), -1, dtype=np.intp)
+
+    widths = np.diff(edges)
+    if np.allclose(widths, widths[0], rtol=1e-12, atol=0):
+        v = values[valid].astype(float, copy=False)
+        idx = ((v - first) * (n_bins / (last - first))).astype(np.intp)
+        np.clip(idx, 0, n_bins - 1, out=idx)
+
+        # correct floating point rounding at the bin edges
+        idx[v < edges[idx]] -= 1
+        increment = (v >= edges[idx + 1]) & (idx != n_bins - 1)
+        idx[increment] += 1
+    else:
+        idx = np.searchsorted(edges, values[valid], side='right') - 1
+        np.clip(idx, 0, n_bins - 1, out=idx)
+
+    indices[valid] = idx
+    return indices
+
+
+def histogram(values, edges, weights=None, slices=None, n_slices=None):
+    '''
+    Weighted histogram of `values`, also returning the sum of squared weights,
+    computing the bin indices only once and filling with `np.bincount`.
+
+    If `slices`, the slice index of each value or -1 for values in no slice,
+    is given, one histogram per slice is filled in the same `np.bincount`
+    using the combined index `slice * n_bins + bin`.
+
+    Returns
+    -------
+    counts: np.ndarray
+        shape (n_bins, ) or (n_slices, n_bins)
+    sumw2: np.ndarray
+        same shape as `counts`
+    '''
+    n_bins = len(edges) - 1
+    indices = bin_indices(values, edges)
+    valid = indices >= 0
+    shape = (n_bins, )
+
+    if slices is not None:
+        valid &= slices >= 0
+        indices = indices + slices * n_bins
+        shape = (n_slices, n_bins)
+
+    indices = indices[valid]
+    length = int(np.prod(shape))
+
+    if weights is None:
+        counts = np.bincount(indices, minlength=length).astype(float).reshape(shape)
+        return counts, counts.copy()
+
+    weights = np.asanyarray(weights)[valid]
+    counts = np.bincount(indices, weights=weights, minlength=length).reshape(shape)
+    sumw2 = np.bincount(indices, weights=weights**2, minlength=length).reshape(shape)
+    return counts, sumw2
+
+
+class Slicing:
+    '''
+    Split events into slices by the value of an expression, e.g. zenith
+    bands or observation periods, to fill one histogram per slice.
+
+    Parameters
+    ----------
+    expression: fact_plots.expressions.Expression
+        the value used to assign the slices
+    edges: array-like or None
+        slice by the intervals between these edges
+    values: list or None
+        slice by these categorical values instead
+    labels: list[str] or None
+        names of the slices, by default created from the edges or values
+    '''
+    def __init__(self, expression, edges=None, values=None, labels=None):
+        if (edges is None) == (values is None):
+            raise ValueError('Slicing needs either edges or values')
+
+        self.expression = expression
+        self.edges = np.asarray(edges, dtype=float) if edges is not None else None
+        self.values = list(values) if values is not None else None
+
+        if self.edges is not None:
+            self.n_slices = len(self.edges) - 1
+        else:
+            self.n_slices = len(self.values)
+
+        self.labels = list(labels) if labels is not None else self.default_labels()
+        if len(self.labels) != self.n_slices:
+            raise ValueError('Got {} labels for {} slices'.format(len(self.labels), self.n_slices))
+
+    @property
+    def columns(self):
+        return set(self.expression.columns.values())
+
+    def default_labels(self):
+        name = self.expression.source
+        if self.edges is not None:
+            return [
+                '{}: {:g} to {:g}'.format(name, low, high)
+                for low, high in zip(self.edges[:-1], self.edges[1:])
+            ]
+        return ['{}: {}'.format(name, value) for value in self.values]
+
+    def indices(self, chunk):
+        '''Slice index of each row in `chunk`, -1 for rows in no slice'''
+        values = self.expression.evaluate(chunk)
+        if self.edges is not None:
+            return bin_indices(values, self.edges)
+
+        categories = np.asarray(self.values)
+        if values.dtype.kind == 'S' and categories.dtype.kind == 'U':
+            categories = np.char.encode(categories)
+
+        indices = np.full(len(values), -1, dtype=np.intp)
+        for i, category in enumerate(categories):
+            indices[values == category] = i
+        return indices
+
+
+def fill_sketches(
+    path,
+    columns,
+    transforms=None,
+    rows=None,
+    key='events',
+    chunksize=DEFAULT_CHUNKSIZE,
+):
+    '''
+    Fill a `QuantileSketch` for each of `columns` in a single chunked
+    pass over the file at `path`, without keeping the values in memory.
+
+    Parameters
+    ----------
+    path: str
+        path to the hdf5 file
+    columns: iterable[str]
+        column names
+    transforms: dict or None
+        mapping of column name to a `fact_plots.expressions.Expression`,
+        whose values are added to the sketch instead of the column
+    rows: array-like[int] or None
+        sorted indices of the selected rows, only these are added
+    key: str
+        name of the hdf5 group
+    chunksize: int or fact_plots.memory.MemoryBudget
+        number of rows read at once
+
+    Returns
+    -------
+    sketches: dict
+        mapping of column name to `QuantileSketch`
+    '''
+    transforms = transforms or {}
+    sketches = {column: QuantileSketch() for column in columns}
+
+    required = required_columns(columns, transforms)
+    for chunk in iter_chunks(path, required, key=key, chunksize=chunksize, rows=rows):
+        for column, sketch in sketches.items():
+            sketch.update(column_values(chunk, column, transforms))
+
+    return sketches
+
+
+HISTOGRAM_ARTIFACT_VERSION = 1
+
+
+def write_histograms(path, bins, counts, sumw2, attrs=None):
+    '''
+    Store histograms of several datasets in the hdf5 file `path`.
+
+    Parameters
+    ----------
+    path: str
+        output file, overwritten if it exists
+    bins: dict
+        mapping of column name to the bin edges, the order is kept
+    counts: list
+        per dataset either a dict mapping column name to bin contents
+        or a list of such dicts, one for each part of the dataset
+    sumw2: list
+        summed squared weights, same structure as `counts`
+    attrs: dict or None
+        json serializable metadata stored with the histograms
+    '''
+    structure = [len(c) if isinstance(c, list) else -1 for c in counts]
+    flat_counts = flatten(counts)
+    flat_sumw2 = flatten(sumw2)
+
+    with h5py.File(path, 'w') as f:
+        f.attrs['version'] = HISTOGRAM_ARTIFACT_VERSION
+        f.attrs['structure'] = json.dumps(structure)
+        f.attrs['columns'] = json.dumps(list(bins.keys()))
+        f.attrs['metadata'] = json.dumps(attrs or {})
+
+        for column, edges in bins.items():
+            group = f.create_group(column)
+            group['edges'] = edges
+            # one row per dataset or part
+            group['counts'] = np.array([c[column] for c in flat_counts])
+            group['sumw2'] = np.array([s[column] for s in flat_sumw2])
+
+
+def read_histograms(path):
+    '''
+    Read histograms written by `write_histograms`
+
+    Returns
+    -------
+    bins: dict
+    counts: list
+    sumw2: list
+    attrs: dict
+    '''
+    with h5py.File(path, 'r') as f:
+        if f.attrs.get('version') != HISTOGRAM_ARTIFACT_VERSION:
+            raise IOError('{} is not a histogram file of a supported version'.format(path))
+
+        structure = json.loads(f.attrs['structure'])
+        columns = json.loads(f.attrs['columns'])
+        attrs = json.loads(f.attrs['metadata'])
+
+        n_flat = sum(n if n >= 0 else 1 for n in structure)
+        bins = {}
+        flat_counts = [{} for _ in range(n_flat)]
+        flat_sumw2 = [{} for _ in range(n_flat)]
+        for column in columns:
+            group = f[column]
+            bins[column] = group['edges'][:]
+            for i, (c, s) in enumerate(zip(group['counts'][:], group['sumw2'][:])):
+                flat_counts[i][column] = c
+                flat_sumw2[i][column] = s
+
+    return bins, unflatten(flat_counts, structure), unflatten(flat_sumw2, structure), attrs
+
+
+def flatten(nested):
+    '''Flatten a per dataset list with lists for the parts of a dataset'''
+    flat = []
+    for item in nested:
+        if isinstance(item, list):
+            flat.extend(item)
+        else:
+            flat.append(item)
+    return flat
+
+
+def unflatten(flat, structure):
+    '''
+    Inverse of `flatten`, `structure` contains the number of parts
+    for each dataset or -1 for datasets without parts
+    '''
+    nested = []
+    i = 0
+    for n_parts in structure:
+        if n_parts < 0:
+            nested.append(flat[i])
+            i += 1
+        else:
+            nested.append(flat[i:i + n_parts])
+            i += n_parts
+    return nested
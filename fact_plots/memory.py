@@ -0,0 +1,158 @@
+import re
+import resource
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+MIN_CHUNKSIZE = 1000
+
+
+def parse_memory(value):
+    '''
+    Parse a memory size like `4G`, `512M`, `2.5GB` or a plain number of bytes
+    '''
+    m = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)i?B?\s*', str(value), flags=re.IGNORECASE)
+    if m is None:
+        raise ValueError('Could not parse memory size "{}"'.format(value))
+    number, unit = m.groups()
+    return int(float(number) * UNITS[unit.upper()])
+
+
+def format_memory(n_bytes):
+    return '{:.1f} MB'.format(n_bytes / 1024**2)
+
+
+def current_rss():
+    '''Current resident set size of this process in bytes'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # no procfs, use the peak instead, which is an upper bound
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget:
+    '''
+    Can be passed as `chunksize` to the chunked readers in
+    `fact_plots.histograms`, which then read as many rows as fit
+    into what is left of `max_memory` bytes for the process.
+
+    Parameters
+    ----------
+    max_memory: int
+        maximum resident set size of the process in bytes
+    row_overhead: int
+        bytes per row added to the size of the columns read,
+        for the temporary arrays of processing one column of a chunk
+    reserved: int
+        bytes kept free, e.g. for results growing while reading
+    shares: int
+        number of threads reading concurrently with the same budget,
+        each of them only uses its share of the available memory
+    '''
+    def __init__(self, max_memory, row_overhead=128, reserved=0, shares=1):
+        self.max_memory = max_memory
+        self.row_overhead = row_overhead
+        self.reserved = reserved
+        self.shares = shares
+
+    def reserve(self, n_bytes):
+        '''New budget keeping additional `n_bytes` free'''
+        return MemoryBudget(
+            self.max_memory, self.row_overhead, self.reserved + n_bytes, self.shares,
+        )
+
+    def share(self, n_shares):
+        '''New budget to be used by `n_shares` threads at the same time'''
+        return MemoryBudget(
+            self.max_memory, self.row_overhead, self.reserved, self.shares * n_shares,
+        )
+
+    def chunksize(self, bytes_per_row):
+        available = (self.max_memory - current_rss() - self.reserved) / self.shares
+        return chunksize_for_memory(available, bytes_per_row + self.row_overhead)
+
+
+def resolve_chunksize(chunksize, bytes_per_row):
+    '''Number of rows for `chunksize` being either an int or a `MemoryBudget`'''
+    if isinstance(chunksize, MemoryBudget):
+        return chunksize.chunksize(bytes_per_row)
+    return chunksize
+
+
+def reserve(chunksize, n_bytes):
+    '''Reserve `n_bytes` if `chunksize` is a `MemoryBudget`'''
+    if isinstance(chunksize, MemoryBudget):
+        return chunksize.reserve(n_bytes)
+    return chunksize
+
+
+def share(chunksize, n_shares):
+    '''Share `chunksize` between `n_shares` threads if it is a `MemoryBudget`'''
+    if isinstance(chunksize, MemoryBudget):
+        return chunksize.share(n_shares)
+    return chunksize
+
+
+def chunksize_for_memory(available, bytes_per_row, min_chunksize=MIN_CHUNKSIZE):
+    '''
+    Number of rows of `bytes_per_row` bytes, including temporaries,
+    that fit into `available` bytes.
+    '''
+    chunksize = int(available // max(bytes_per_row, 1))
+    if chunksize < min_chunksize:
+        raise MemoryError(
+            'Only {} available, not enough for {} rows of {} bytes'.format(
+                format_memory(available), min_chunksize, bytes_per_row,
+            )
+        )
+    return chunksize
+
+
+class MemoryMonitor:
+    '''
+    Track the peak resident set size of named stages,
+    by sampling the rss in a background thread every `interval` seconds.
+    '''
+    def __init__(self, interval=0.01, enabled=False):
+        self.interval = interval
+        self.enabled = enabled
+        self.peaks = OrderedDict()
+
+    def _sample(self, stop, peak):
+        while not stop.wait(self.interval):
+            peak[0] = max(peak[0], current_rss())
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield self
+            return
+
+        # each stage has its own sampler, so stages can be nested
+        peak = [current_rss()]
+        stop = threading.Event()
+        thread = threading.Thread(target=self._sample, args=(stop, peak), daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+            peak = max(peak[0], current_rss())
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+    def report(self, max_memory=None):
+        lines = ['Peak memory per stage:']
+        for name, peak in self.peaks.items():
+            lines.append('  {: <20} {: >12}'.format(name, format_memory(peak)))
+        if max_memory is not None:
+            lines.append('  {: <20} {: >12}'.format('limit', format_memory(max_memory)))
+        return '\n'.join(lines)
+
+
+# shared by all stages of a process, only collects data if enabled
+monitor = MemoryMonitor()
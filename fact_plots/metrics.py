@@ -0,0 +1,145 @@
+import csv
+import json
+
+import numpy as np
+from scipy.stats import chi2 as chi2_distribution
+
+
+METRIC_FIELDS = [
+    'column', 'slice', 'data', 'chi2', 'ndf', 'chi2_ndf', 'p_value',
+    'ks', 'rate_ratio', 'rate_ratio_err', 'data_rate', 'mc_rate',
+]
+
+
+def chi2_test(counts_a, sumw2_a, counts_b, sumw2_b):
+    '''
+    Chi² test of the shapes of two weighted histograms.
+    Both are normalised to a sum of one, bins without entries in both
+    histograms are ignored.
+
+    Returns
+    -------
+    chi2: float
+    ndf: int
+        number of bins used minus one for the normalisation
+    '''
+    total_a = counts_a.sum()
+    total_b = counts_b.sum()
+    if total_a <= 0 or total_b <= 0:
+        return np.nan, 0
+
+    variance = sumw2_a / total_a**2 + sumw2_b / total_b**2
+    used = variance > 0
+    difference = counts_a[used] / total_a - counts_b[used] / total_b
+    chi2 = np.sum(difference**2 / variance[used])
+    return float(chi2), int(np.count_nonzero(used)) - 1
+
+
+def ks_distance(counts_a, counts_b):
+    '''Maximum distance of the cumulative distributions of two histograms'''
+    total_a = counts_a.sum()
+    total_b = counts_b.sum()
+    if total_a <= 0 or total_b <= 0:
+        return np.nan
+    cdf_a = np.cumsum(counts_a) / total_a
+    cdf_b = np.cumsum(counts_b) / total_b
+    return float(np.max(np.abs(cdf_a - cdf_b)))
+
+
+def rate_ratio(counts_a, sumw2_a, counts_b, sumw2_b):
+    '''Ratio of the total rates of two histograms and its uncertainty'''
+    total_a = counts_a.sum()
+    total_b = counts_b.sum()
+    if total_b <= 0:
+        return np.nan, np.nan
+    ratio = total_a / total_b
+    if total_a <= 0:
+        return float(ratio), np.nan
+    error = ratio * np.sqrt(sumw2_a.sum() / total_a**2 + sumw2_b.sum() / total_b**2)
+    return float(ratio), float(error)
+
+
+def compare_histograms(counts_a, sumw2_a, counts_b, sumw2_b):
+    '''All agreement metrics of histogram a, e.g. data, to histogram b, e.g. simulations'''
+    chi2, ndf = chi2_test(counts_a, sumw2_a, counts_b, sumw2_b)
+    ratio, ratio_err = rate_ratio(counts_a, sumw2_a, counts_b, sumw2_b)
+    return {
+        'chi2': chi2,
+        'ndf': ndf,
+        'chi2_ndf': chi2 / ndf if ndf > 0 else np.nan,
+        'p_value': float(chi2_distribution.sf(chi2, ndf)) if ndf > 0 else np.nan,
+        'ks': ks_distance(counts_a, counts_b),
+        'rate_ratio': ratio,
+        'rate_ratio_err': ratio_err,
+        'data_rate': float(counts_a.sum()),
+        'mc_rate': float(counts_b.sum()),
+    }
+
+
+def dataset_totals(counts, dataset):
+    '''Histograms of a dataset, summing the histograms of its parts'''
+    if 'parts' in dataset:
+        return {column: sum(part[column] for part in counts) for column in counts[0]}
+    return counts
+
+
+def calc_metrics(bins, counts, sumw2, datasets, slice_labels=None):
+    '''
+    Agreement metrics of every observed dataset to the sum of all
+    simulated datasets for each column of `bins`, one row per column,
+    observed dataset and slice, ranked by chi² / ndf, worst first.
+
+    `counts` and `sumw2` have the structure returned by
+    `fact_plots.histograms.fill_histograms` for each dataset.
+    With `slice_labels`, the histograms contain one row per slice.
+    '''
+    data = [
+        (dataset['label'], dataset_totals(counts[d], dataset), dataset_totals(sumw2[d], dataset))
+        for d, dataset in enumerate(datasets)
+        if dataset['kind'] == 'observations'
+    ]
+    simulated = [d for d, dataset in enumerate(datasets) if dataset['kind'] != 'observations']
+    if not data or not simulated:
+        raise ValueError('Metrics need at least one observed and one simulated dataset')
+
+    mc_counts = {}
+    mc_sumw2 = {}
+    for column in bins:
+        mc_counts[column] = sum(dataset_totals(counts[d], datasets[d])[column] for d in simulated)
+        mc_sumw2[column] = sum(dataset_totals(sumw2[d], datasets[d])[column] for d in simulated)
+
+    if slice_labels is None:
+        slices = [(None, Ellipsis)]
+    else:
+        slices = [(slice_label, s) for s, slice_label in enumerate(slice_labels)]
+
+    rows = []
+    for column in bins:
+        for label, data_counts, data_sumw2 in data:
+            for slice_label, s in slices:
+                row = {'column': column, 'slice': slice_label, 'data': label}
+                row.update(compare_histograms(
+                    data_counts[column][s], data_sumw2[column][s],
+                    mc_counts[column][s], mc_sumw2[column][s],
+                ))
+                rows.append(row)
+
+    # nan sorts last
+    rows.sort(key=lambda row: -row['chi2_ndf'] if np.isfinite(row['chi2_ndf']) else np.inf)
+    return rows
+
+
+def write_metrics(path, rows):
+    '''Write the rows of `calc_metrics` as csv, if `path` ends with .csv, else as json'''
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=METRIC_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, 'w') as f:
+            # json has no nan, use null instead
+            json.dump([
+                {k: None if isinstance(v, float) and not np.isfinite(v) else v for k, v in row.items()}
+                for row in rows
+            ], f, indent=2)
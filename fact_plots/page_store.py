@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+
+
+class PageStore:
+    '''
+    Directory keeping the intermediate products of a data/MC comparison,
+    each stored under a fingerprint of all of its inputs:
+
+    - `bins/<key>.npy`: bin edges of a column
+    - `hists/<key>.npz`: histogram of one column of one dataset or part
+    - `pages/<key>.pdf`: the rendered page of one column
+
+    Anything whose fingerprint did not change between two runs is reused.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        for kind in ('bins', 'hists', 'pages'):
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+
+    def _path(self, kind, key, ext):
+        return os.path.join(self.directory, kind, key + ext)
+
+    def get_bins(self, key):
+        path = self._path('bins', key, '.npy')
+        if not os.path.exists(path):
+            return None
+        return np.load(path)
+
+    def put_bins(self, key, edges):
+        save_atomic(self._path('bins', key, '.npy'), np.save, edges)
+
+    def get_hist(self, key):
+        path = self._path('hists', key, '.npz')
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as f:
+            return f['counts'], f['sumw2']
+
+    def put_hist(self, key, counts, sumw2):
+        save_atomic(
+            self._path('hists', key, '.npz'),
+            lambda f, _: np.savez(f, counts=counts, sumw2=sumw2),
+            None,
+        )
+
+    def page_path(self, key):
+        return self._path('pages', key, '.pdf')
+
+    def has_page(self, key):
+        return os.path.exists(self.page_path(key))
+
+    def put_page(self, key, render):
+        '''
+        Call `render(path)` with a temporary path in the store,
+        then move the page into place, so interrupted runs leave no partial pages
+        '''
+        path = self.page_path(key)
+        tmp_path = os.path.splitext(path)[0] + '.tmp.pdf'
+        render(tmp_path)
+        os.replace(tmp_path, path)
+
+    def collect_garbage(self, used_keys):
+        '''Remove all entries whose key is not in `used_keys`'''
+        used_keys = set(used_keys)
+        for kind in ('bins', 'hists', 'pages'):
+            for entry in os.scandir(os.path.join(self.directory, kind)):
+                key, _ = os.path.splitext(entry.name)
+                if key not in used_keys:
+                    os.remove(entry.path)
+
+
+def save_atomic(path, save, data):
+    '''Call `save(f, data)` on a temporary file, then move it to `path`'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        save(f, data)
+    os.replace(tmp_path, path)
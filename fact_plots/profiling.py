@@ -0,0 +1,219 @@
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import click
+
+from .memory import monitor, format_memory
+
+
+def bytes_read():
+    '''
+    Number of bytes this process read so far, including reads served
+    from the page cache, or 0 if this is not available
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'rchar':
+                    return int(value)
+    except OSError:
+        pass
+    return 0
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes_read = 0
+        self.rows = 0
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'bytes_read': self.bytes_read,
+            'rows': self.rows,
+        }
+
+
+class Profiler:
+    '''
+    Collect wall time, cpu time, bytes read, rows processed
+    and, through `fact_plots.memory.monitor`, the peak memory
+    of named stages.
+
+    Stages can be nested, the outer stage includes the inner ones.
+    Cpu time and bytes read are those of the whole process, so
+    stages running concurrently in threads include each other.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = OrderedDict()
+        self.rows = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _active(self):
+        if not hasattr(self._local, 'active'):
+            self._local.active = []
+        return self._local.active
+
+    @contextmanager
+    def stage(self, name):
+        with monitor.stage(name):
+            if not self.enabled:
+                yield self
+                return
+
+            active = self._active()
+            active.append(name)
+            with self._lock:
+                stats = self.stages.setdefault(name, StageStats())
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            read = bytes_read()
+            try:
+                yield self
+            finally:
+                active.pop()
+                with self._lock:
+                    stats.calls += 1
+                    stats.wall += time.perf_counter() - wall
+                    stats.cpu += time.process_time() - cpu
+                    stats.bytes_read += bytes_read() - read
+
+    def add_rows(self, n_rows):
+        '''Count `n_rows` as processed by all stages active in this thread'''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.rows += n_rows
+            for name in set(self._active()):
+                self.stages[name].rows += n_rows
+
+    def to_dict(self):
+        stages = OrderedDict()
+        for name, stats in self.stages.items():
+            stages[name] = stats.to_dict()
+            stages[name]['peak_rss'] = monitor.peaks.get(name)
+        return stages
+
+    def report(self, total=None):
+        '''The collected stats as a table'''
+        header = '{: <20} {: >6} {: >10} {: >10} {: >12} {: >12} {: >12}'
+        row = '{: <20} {: >6} {: >10.2f} {: >10.2f} {: >12} {: >12} {: >12}'
+        lines = [header.format('stage', 'calls', 'wall / s', 'cpu / s', 'read', 'rows', 'peak rss')]
+
+        stages = self.to_dict()
+        if total is not None:
+            stages['total'] = total
+        for name, stats in stages.items():
+            peak = stats['peak_rss']
+            lines.append(row.format(
+                name,
+                stats['calls'],
+                stats['wall'],
+                stats['cpu'],
+                format_memory(stats['bytes_read']),
+                stats['rows'],
+                format_memory(peak) if peak is not None else '',
+            ))
+        return '\n'.join(lines)
+
+
+# shared by all stages of a process, only collects data if enabled
+profiler = Profiler()
+
+
+@contextmanager
+def profile_run(command, output=None, cprofile_output=None):
+    '''
+    Enable the profiler for the duration of the context and print the report
+    to stderr at the end. The report is also written as json to `output`
+    and the cProfile stats to `cprofile_output`, if given.
+    Both paths may contain `{command}`, which is replaced by `command`,
+    so one environment variable can be used for all scripts.
+    '''
+    profiler.enabled = True
+    monitor.enabled = True
+    rows = profiler.rows
+
+    if cprofile_output is not None:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    read = bytes_read()
+    try:
+        yield profiler
+    finally:
+        if cprofile_output is not None:
+            cprofile.disable()
+            cprofile.dump_stats(cprofile_output.format(command=command))
+
+        total = {
+            'calls': 1,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'bytes_read': bytes_read() - read,
+            'rows': profiler.rows - rows,
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+        click.echo(profiler.report(total), err=True)
+
+        if output is not None:
+            with open(output.format(command=command), 'w') as f:
+                json.dump({
+                    'command': command,
+                    'argv': sys.argv,
+                    'time': time.time(),
+                    'pid': os.getpid(),
+                    'total': total,
+                    'stages': profiler.to_dict(),
+                }, f, indent=2)
+
+
+def profile_command(f):
+    '''
+    Add the `--profile`, `--profile-output` and `--cprofile-output` options
+    to a click command, place directly below `@click.command()`.
+    Profiling can also be enabled through the environment variables
+    `FACT_PLOTS_PROFILE`, `FACT_PLOTS_PROFILE_OUTPUT` and `FACT_PLOTS_CPROFILE_OUTPUT`.
+    '''
+    @click.option(
+        '--profile', is_flag=True, envvar='FACT_PLOTS_PROFILE',
+        help='Print time, bytes read, rows and peak memory of each stage to stderr',
+    )
+    @click.option(
+        '--profile-output', envvar='FACT_PLOTS_PROFILE_OUTPUT',
+        help='Write the profiling report as json to this file, implies --profile',
+    )
+    @click.option(
+        '--cprofile-output', envvar='FACT_PLOTS_CPROFILE_OUTPUT',
+        help='Dump cProfile stats to this file, implies --profile',
+    )
+    @functools.wraps(f)
+    def wrapper(*args, profile, profile_output, cprofile_output, **kwargs):
+        if not (profile or profile_output or cprofile_output):
+            return f(*args, **kwargs)
+
+        command = f.__module__.rpartition('.')[2]
+        if command == '__main__':
+            command = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        with profile_run(command, output=profile_output, cprofile_output=cprofile_output):
+            return f(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,168 @@
+import numpy as np
+
+
+DEFAULT_K = 2000
+# enough for the exact 0.1 and 99.9 percentiles of up to 1e7 values
+DEFAULT_TAIL = 10000
+
+
+class QuantileSketch:
+    '''
+    Mergeable streaming approximation of the quantiles of a
+    stream of values, following the KLL sketch of
+    Karnin, Lang and Liberty (2016).
+
+    Values are stored in levels of compactors, an item in level `h`
+    represents `2**h` values of the input. When a level exceeds its capacity,
+    it is sorted and every other item is promoted to the next level.
+    Minimum and maximum are tracked exactly, NaNs are ignored and counted.
+
+    The rank error of the levels is about the same for all quantiles,
+    which is large relative to the extreme quantiles used for plot limits.
+    So the `tail` smallest and largest values are also kept, quantiles
+    falling into them are exact and interpolated like `np.nanpercentile`.
+
+    Parameters
+    ----------
+    k: int
+        Capacity of the highest level, the rank error is of order 1 / k
+    seed: int or None
+        Seed for the random choice of the promoted items
+    tail: int
+        Number of smallest and largest values kept exactly
+    '''
+    def __init__(self, k=DEFAULT_K, seed=0, tail=DEFAULT_TAIL):
+        self.k = k
+        self.tail = tail
+        self.levels = [np.empty(0)]
+        # sorted, the `tail` smallest and largest values
+        self.low = np.empty(0)
+        self.high = np.empty(0)
+        self.n = 0
+        self.n_nan = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.n
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2 / 3)**depth)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+
+                items = np.sort(items)
+                if len(items) % 2 == 1:
+                    self.levels[level] = items[-1:]
+                    items = items[:-1]
+                else:
+                    self.levels[level] = np.empty(0)
+
+                offset = self._rng.integers(2)
+                self.levels[level + 1] = np.concatenate([
+                    self.levels[level + 1], items[offset::2]
+                ])
+
+            level += 1
+
+    def _update_tails(self, low, high):
+        '''Keep the `tail` smallest of `low` and largest of `high` together with the current ones'''
+        low = np.concatenate([self.low, low])
+        if len(low) > self.tail:
+            low = np.partition(low, self.tail - 1)[:self.tail]
+        self.low = np.sort(low)
+
+        high = np.concatenate([self.high, high])
+        if len(high) > self.tail:
+            high = np.partition(high, len(high) - self.tail)[-self.tail:]
+        self.high = np.sort(high)
+
+    def update(self, values):
+        '''Add the values of the array-like `values` to the sketch'''
+        values = np.asanyarray(values, dtype=float).ravel()
+
+        nan = np.isnan(values)
+        n_nan = np.count_nonzero(nan)
+        if n_nan > 0:
+            self.n_nan += n_nan
+            values = values[~nan]
+
+        if len(values) == 0:
+            return self
+
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._update_tails(values, values)
+
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        '''
+        Approximate `q`-th quantile of the values seen so far,
+        `q` can be a number or an array-like of numbers in [0, 1].
+        Returns NaN if no values were added.
+        '''
+        q = np.asanyarray(q, dtype=float)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)[()]
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(level_items), 2.0**level)
+            for level, level_items in enumerate(self.levels)
+        ])
+        order = np.argsort(items, kind='stable')
+        items = items[order]
+        cumulative = np.cumsum(weights[order])
+
+        idx = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        result = items[np.clip(idx, 0, len(items) - 1)]
+
+        # the extremes are known exactly
+        result = np.where(q <= 0, self.min, result)
+        result = np.where(q >= 1, self.max, result)
+
+        # quantiles among the kept smallest or largest values are exact, interpolated
+        # between the order statistics around q * (n - 1) like np.nanpercentile
+        position = np.clip(q, 0, 1) * (self.n - 1)
+        below = np.floor(position).astype(np.int64)
+        above = np.ceil(position).astype(np.int64)
+        fraction = position - below
+        # the largest values are the order statistics n - len(high), ..., n - 1
+        offset = self.n - len(self.high)
+        for values, first, inside in (
+            (self.low, 0, above < len(self.low)),
+            (self.high, offset, below >= offset),
+        ):
+            lower = values[np.clip(below - first, 0, len(values) - 1)]
+            upper = values[np.clip(above - first, 0, len(values) - 1)]
+            # same rounding as the interpolation of np.percentile
+            diff = upper - lower
+            interpolated = np.where(fraction >= 0.5, upper - diff * (1 - fraction), lower + diff * fraction)
+            result = np.where(inside, interpolated, result)
+        return result[()]
+
+    def percentile(self, p):
+        '''Same as `quantile`, but `p` in percent like `np.nanpercentile`'''
+        return self.quantile(np.asanyarray(p, dtype=float) / 100)
+
+    @staticmethod
+    def max_nbytes(k=DEFAULT_K, tail=DEFAULT_TAIL):
+        '''
+        Upper bound of the memory of a sketch between updates,
+        the capacities of the levels sum up to less than `3 * k` items,
+        plus the `tail` smallest and largest values
+        '''
+        return (3 * k + 2 * tail) * np.dtype(float).itemsize
@@ -2,6 +2,7 @@ import click
 from fact.io import read_h5py
 from ..plotting import add_preliminary
 from ..angular_resolution import plot_angular_resolution
+from ..profiling import profiler, profile_command
 import matplotlib.pyplot as plt
 from ruamel.yaml import YAML
 import numpy as np
@@ -19,6 +20,7 @@ plot_config = {
 
 
 @click.command()
+@profile_command
 @click.argument('gamma_path')
 @click.option(
     '--std', default=False, is_flag=True,
@@ -72,44 +74,49 @@ def main(
     if only_correct:
         columns += ['true_disp', 'disp_prediction']
 
-    df = read_h5py(
-        gamma_path,
-        columns=columns,
-        key='events',
-    )
+    with profiler.stage('read'):
+        df = read_h5py(
+            gamma_path,
+            columns=columns,
+            key='events',
+        )
+        profiler.add_rows(len(df))
 
-    if threshold:
-        df = df.query('gamma_prediction >= @threshold').copy()
+    with profiler.stage('selection'):
+        if threshold:
+            df = df.query('gamma_prediction >= @threshold').copy()
 
-    if only_correct:
-        correct = np.sign(df['disp_prediction']) == np.sign(df['true_disp'])
-        df = df.loc[correct].copy()
-
-    fig = plt.figure()
-    ax = fig.add_subplot(1, 1, 1)
-    ax.grid()
-
-    if preliminary:
-        add_preliminary(
-            plot_config['preliminary_position'],
-            size=plot_config['preliminary_size'],
-            color=plot_config['preliminary_color'],
-            ax=ax,
-        )
+        if only_correct:
+            correct = np.sign(df['disp_prediction']) == np.sign(df['true_disp'])
+            df = df.loc[correct].copy()
 
     e_low = e_low or df['corsika_event_header_total_energy'].min()
     e_high = e_high or df['corsika_event_header_total_energy'].max()
     bins = np.logspace(np.log10(e_low), np.log10(e_high), n_bins + 1)
 
-    plot_angular_resolution(df, bins=bins, ax=ax)
+    with profiler.stage('plotting'):
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 1, 1)
+        ax.grid()
+
+        if preliminary:
+            add_preliminary(
+                plot_config['preliminary_position'],
+                size=plot_config['preliminary_size'],
+                color=plot_config['preliminary_color'],
+                ax=ax,
+            )
+
+        plot_angular_resolution(df, bins=bins, ax=ax)
 
-    ax.set_xlabel(plot_config['xlabel'])
-    ax.set_ylabel(plot_config['ylabel'])
+        ax.set_xlabel(plot_config['xlabel'])
+        ax.set_ylabel(plot_config['ylabel'])
 
-    fig.tight_layout(pad=0)
+        fig.tight_layout(pad=0)
 
     if output:
-        fig.savefig(output, dpi=300)
+        with profiler.stage('writing'):
+            fig.savefig(output, dpi=300)
     else:
         plt.show()
 
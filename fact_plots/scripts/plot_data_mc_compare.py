@@ -13,18 +13,31 @@ from ruamel.yaml import YAML
 from collections import OrderedDict
 from tqdm import tqdm
 from fnmatch import fnmatch
-from operator import lt, le, eq, ne, gt, ge
-
-
-OPERATORS = {
-    '<': lt, 'lt': lt,
-    '<=': le, 'le': le,
-    '==': eq, 'eq': eq,
-    '=': eq,
-    '!=': ne, 'ne': ne,
-    '>': gt, 'gt': gt,
-    '>=': ge, 'ge': ge,
-}
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import deque
+from pypdf import PdfWriter
+import tempfile
+import os
+
+from ..histograms import (
+    Slicing,
+    iter_chunks,
+    fill_histograms,
+    fill_sketches,
+    read_histograms,
+    write_histograms as write_histograms_file,
+    flatten,
+    unflatten,
+    DEFAULT_CHUNKSIZE,
+)
+from ..selection import select_rows
+from ..expressions import Expression, transform_source
+from ..catalog import get_catalog, get_columns, get_n_rows, get_column_summary
+from ..cache import DiskCache, cache_key, file_identity, DEFAULT_CACHE_DIR
+from ..page_store import PageStore
+from ..metrics import calc_metrics, write_metrics
+from ..memory import MemoryBudget, monitor, parse_memory, reserve, share
+from ..profiling import profiler, profile_command
 
 
 if plt.get_backend() == 'pgf':
@@ -34,33 +47,43 @@ else:
 
 
 ETRUE = 'corsika_event_header_total_energy'
-yaml = YAML(typ='safe')
 
-
-def wrap_angle(angle):
-    angle = np.asanyarray(angle).copy()
-    while np.any(angle < 0):
-        angle[angle < 0] += 360
-
-    while np.any(angle > 360):
-        angle[angle > 360] -= 360
-
-    return angle
+# config entries of a dataset the weights depend on,
+# increase the version if the weight calculation changes
+WEIGHT_KEYS = {
+    'kind', 'n_showers', 'e_min', 'e_max', 'spectral_index',
+    'max_impact', 'sample_fraction', 'viewcone', 'spectrum',
+}
+WEIGHTS_CACHE_VERSION = 1
+# increase if binning, histogramming or plotting changes
+PAGE_STORE_VERSION = 3
+# distinguish the slices of a dataset when overlaid
+SLICE_LINESTYLES = ['-', '--', ':', '-.']
+yaml = YAML(typ='safe')
 
 
-def calc_limis(arrays):
-    '''Calculate axis limits, try go get a nice range for visualization'''
+def calc_limis(sketches):
+    '''
+    Calculate axis limits, try go get a nice range for visualization.
+    Uses the quantiles of `QuantileSketch` or catalog `ColumnSummary`
+    instances, so the values don't have to be held in memory.
+    '''
     flat = []
-    for data in arrays:
+    for data in sketches:
         if isinstance(data, list):
             flat.extend(data)
         else:
             flat.append(data)
 
-    min_x = min(np.nanmin(a) for a in flat)
-    max_x = max(np.nanmax(a) for a in flat)
-    p1 = min(np.nanpercentile(a, 0.1) for a in flat)
-    p99 = max(np.nanpercentile(a, 99.9) for a in flat)
+    # empty sketches, e.g. for a part without selected events, are ignored
+    flat = [sketch for sketch in flat if len(sketch) > 0]
+    if len(flat) == 0:
+        return [np.nan, np.nan]
+
+    min_x = min(sketch.min for sketch in flat)
+    max_x = max(sketch.max for sketch in flat)
+    p1 = min(sketch.percentile(0.1) for sketch in flat)
+    p99 = max(sketch.percentile(99.9) for sketch in flat)
 
     r = max_x - min_x
 
@@ -75,57 +98,42 @@ def calc_limis(arrays):
     return limits
 
 
-def unity(x):
-    return x
+def stairs(ax, values, edges, color=None, **kwargs):
+    '''`ax.stairs`, but using the color cycle like `ax.hist` if color is None'''
+    if color is None:
+        color = ax._get_lines.get_next_color()
+    return ax.stairs(values, edges, color=color, **kwargs)
 
 
 def plot_hists(
-    dfs,
-    weights,
+    hists,
     key,
     datasets,
-    n_bins=100,
-    limits=None,
-    transform=None,
+    edges,
     xlabel=None,
     yscale='linear',
     ax=None,
     legend_loc='best',
     colors=None,
+    label_suffix='',
+    linestyle=None,
 ):
+    '''Plot the accumulated bin contents `hists` of column `key`'''
     if ax is None:
         ax = plt.gca()
 
-    if transform is None:
-        transform = unity
-
-    trans = []
-    for d, dataset in enumerate(dfs):
-        if isinstance(dataset, list):
-            trans.append([])
-            for part in dataset:
-                trans[-1].append(transform(part[key].values))
-        else:
-            trans.append(transform(dfs[d].values))
-
-    if limits is None:
-        limits = calc_limis(trans)
-
-    if transform is np.log10 and xlabel is None:
-        xlabel = 'log10(' + key + ')'
-
     for d, dataset in enumerate(datasets):
         label = dataset['label']
 
         if 'parts' in dataset:
-            ax.hist(
-                np.concatenate(trans[d]),
-                bins=n_bins,
-                range=limits,
-                weights=np.concatenate(weights[d]),
-                label=label,
-                histtype='step',
+            # the total is the sum of the already filled part histograms
+            stairs(
+                ax,
+                sum(part[key] for part in hists[d]),
+                edges,
+                label=label + label_suffix,
                 color=dataset.get('color'),
+                linestyle=linestyle,
             )
 
             if dataset.get('show_parts', True):
@@ -133,27 +141,25 @@ def plot_hists(
                     color = part.get('color')
                     alpha = part.get('alpha', 0.5 if not color else None)
 
-                    ax.hist(
-                        trans[d][p],
-                        bins=n_bins,
-                        range=limits,
-                        weights=weights[d][p],
-                        label=part['label'],
-                        histtype='step',
+                    stairs(
+                        ax,
+                        hists[d][p][key],
+                        edges,
+                        label=part['label'] + label_suffix,
                         color=color,
-                        alpha=alpha
+                        alpha=alpha,
+                        linestyle=linestyle,
                     )
 
         else:
-            ax.hist(
-                trans[d],
-                bins=n_bins,
-                range=limits,
-                weights=weights[d],
-                label=label,
-                histtype='step',
+            stairs(
+                ax,
+                hists[d][key],
+                edges,
+                label=label + label_suffix,
                 color=dataset.get('color'),
                 alpha=dataset.get('alpha', 1.0),
+                linestyle=linestyle,
             )
 
     ax.set_ylabel('Events / h')
@@ -162,16 +168,14 @@ def plot_hists(
     ax.legend(loc=legend_loc)
 
 
-def calc_weights(dataset, mask=None):
+def calc_weights(dataset, rows=None, chunksize=DEFAULT_CHUNKSIZE):
     # observed datasets
     if dataset['kind'] == 'observations':
         runs = read_h5py(dataset['path'], key='runs', columns=['ontime'])
-        if mask is None:
-            n_events = len(read_h5py(
-                dataset['path'], key='events', columns=['event_num']
-            ))
+        if rows is None:
+            n_events = get_n_rows(get_catalog(dataset['path'], chunksize=chunksize))
         else:
-            n_events = np.count_nonzero(mask)
+            n_events = len(rows)
         ontime = runs['ontime'].sum() / 3600
         return np.ones(n_events) / ontime
 
@@ -179,147 +183,346 @@ def calc_weights(dataset, mask=None):
     kind = dataset['kind']
     if kind in ('protons', 'gammas', 'electrons', 'helium'):
 
-        energy = read_h5py(
-            dataset['path'], key='events', columns=[ETRUE]
-        )[ETRUE]
-
-        if mask is not None:
-            energy = energy[mask]
-
-        if kind == 'gammas':
-            viewcone = None
+        # calculate the weights chunk by chunk, so that the temporaries of the
+        # unit calculations don't need memory for the whole dataset
+        if rows is None:
+            n_events = get_n_rows(get_catalog(dataset['path'], chunksize=chunksize))
         else:
-            viewcone = dataset['viewcone'] * u.deg
-
-        spectrum = dataset.get('spectrum')
-        kwargs = dict(
-            energy=u.Quantity(energy.values, u.GeV, copy=False),
-            obstime=1 * u.hour,
-            n_events=dataset['n_showers'],
-            e_min=dataset['e_min'] * u.GeV,
-            e_max=dataset['e_max'] * u.GeV,
-            simulated_index=dataset['spectral_index'],
-            scatter_radius=dataset['max_impact'] * u.m,
-            sample_fraction=dataset.get('sample_fraction', 1.0),
-            viewcone=viewcone,
-        )
-        if spectrum is None:
-            if kind == 'protons':
-                return calc_weights_cosmic_rays(**kwargs).to_value(u.dimensionless_unscaled)
+            n_events = len(rows)
+        chunksize = reserve(chunksize, 2 * n_events * np.dtype(float).itemsize)
 
-            raise ValueError(
-                'Particle types other then protons require a "spectrum" in config'
-            )
-
-        if spectrum['function'] == 'power_law':
-            return calc_weights_powerlaw(
-                **kwargs,
-                flux_normalization=u.Quantity(**spectrum['phi_0']),
-                target_index=spectrum['spectral_index'],
-                e_ref=u.Quantity(**spectrum['e_ref'])
-            ).to_value(u.dimensionless_unscaled)
-
-        if spectrum['function'] == 'log_parabola':
-            return calc_weights_logparabola(
-                flux_normalization=u.Quantity(**spectrum['phi_0']),
-                e_ref=u.Quantity(**spectrum['e_ref']),
-                target_a=spectrum['a'],
-                target_b=spectrum['b'],
-            ).to_value(u.dimensionless_unscaled)
-
-        if spectrum['function'] == 'power_law_exponential_cutoff':
-            return calc_weights_exponential_cutoff(
-                **kwargs,
-                flux_normalization=u.Quantity(**spectrum['phi_0']),
-                target_index=spectrum['spectral_index'],
-                target_e_cutoff=u.Quantity(**spectrum['e_cutoff']),
-                e_ref=u.Quantity(**spectrum['e_ref'])
-            ).to_value(u.dimensionless_unscaled)
-
-        raise ValueError('Unknown spectral function {}'.format(spectrum['function']))
+        weights = [np.empty(0)]
+        chunks = iter_chunks(dataset['path'], [ETRUE], chunksize=chunksize, rows=rows)
+        for chunk in chunks:
+            weights.append(calc_weights_for_energy(dataset, chunk[ETRUE]))
+        return np.concatenate(weights)
 
     raise ValueError('Unknown dataset kind "{}"'.format(dataset['kind']))
 
 
-def update_columns(dataset_config, common_columns):
-    df = read_h5py(dataset_config['path'], key='events', last=1)
+def calc_weights_for_energy(dataset, energy):
+    '''Weights of simulated events of `dataset` with true `energy` in GeV'''
+    kind = dataset['kind']
+    if kind == 'gammas':
+        viewcone = None
+    else:
+        viewcone = dataset['viewcone'] * u.deg
+
+    spectrum = dataset.get('spectrum')
+    kwargs = dict(
+        energy=u.Quantity(energy, u.GeV, copy=False),
+        obstime=1 * u.hour,
+        n_events=dataset['n_showers'],
+        e_min=dataset['e_min'] * u.GeV,
+        e_max=dataset['e_max'] * u.GeV,
+        simulated_index=dataset['spectral_index'],
+        scatter_radius=dataset['max_impact'] * u.m,
+        sample_fraction=dataset.get('sample_fraction', 1.0),
+        viewcone=viewcone,
+    )
+    if spectrum is None:
+        if kind == 'protons':
+            return calc_weights_cosmic_rays(**kwargs).to_value(u.dimensionless_unscaled)
+
+        raise ValueError(
+            'Particle types other then protons require a "spectrum" in config'
+        )
+
+    if spectrum['function'] == 'power_law':
+        return calc_weights_powerlaw(
+            **kwargs,
+            flux_normalization=u.Quantity(**spectrum['phi_0']),
+            target_index=spectrum['spectral_index'],
+            e_ref=u.Quantity(**spectrum['e_ref'])
+        ).to_value(u.dimensionless_unscaled)
+
+    if spectrum['function'] == 'log_parabola':
+        return calc_weights_logparabola(
+            flux_normalization=u.Quantity(**spectrum['phi_0']),
+            e_ref=u.Quantity(**spectrum['e_ref']),
+            target_a=spectrum['a'],
+            target_b=spectrum['b'],
+        ).to_value(u.dimensionless_unscaled)
+
+    if spectrum['function'] == 'power_law_exponential_cutoff':
+        return calc_weights_exponential_cutoff(
+            **kwargs,
+            flux_normalization=u.Quantity(**spectrum['phi_0']),
+            target_index=spectrum['spectral_index'],
+            target_e_cutoff=u.Quantity(**spectrum['e_cutoff']),
+            e_ref=u.Quantity(**spectrum['e_ref'])
+        ).to_value(u.dimensionless_unscaled)
+
+    raise ValueError('Unknown spectral function {}'.format(spectrum['function']))
+
+
+def update_columns(dataset_config, common_columns, chunksize=DEFAULT_CHUNKSIZE):
+    columns = get_columns(get_catalog(dataset_config['path'], chunksize=chunksize))
 
     if len(common_columns) == 0:
-        return set(df.columns)
-    return common_columns.intersection(df.columns)
+        return set(columns)
+    return common_columns.intersection(columns)
 
 
-def read_dfs_for_column(datasets, column, masks=None):
-    dfs = []
-    for d, dataset in enumerate(datasets):
+def select_all_rows(config, chunksize=DEFAULT_CHUNKSIZE):
+    rows = []
+    selection_config = config['event_selection']
+    definitions = get_definitions(config)
+    for d, dataset in enumerate(config['datasets']):
         if 'parts' in dataset:
             parts = []
-            for p, part in enumerate(dataset['parts']):
-                df = read_h5py(
-                    part['path'], key='events', columns=[column]
-                )
-                if masks is not None:
-                    mask = masks[d][p]
-                    df = df.loc[mask].copy()
-                parts.append(df)
-            dfs.append(parts)
+            for part in dataset['parts']:
+                parts.append(select_rows(
+                    part['path'], selection_config,
+                    chunksize=chunksize, definitions=definitions,
+                ))
+            rows.append(parts)
         else:
-            df = read_h5py(dataset['path'], key='events', columns=[column])
-            if masks is not None:
-                mask = masks[d]
-                df = df.loc[mask].copy()
-            dfs.append(df)
-    return dfs
+            rows.append(select_rows(
+                dataset['path'], selection_config,
+                chunksize=chunksize, definitions=definitions,
+            ))
 
+    return rows
 
-def create_masks(config):
-    masks = []
-    mask_config = config['event_selection']
-    for d, dataset in enumerate(config['datasets']):
+
+def calc_all_weights(datasets, rows=None, cache=None, event_selection=None, chunksize=DEFAULT_CHUNKSIZE):
+    weights = []
+    for d, dataset in enumerate(datasets):
         if 'parts' in dataset:
             parts = []
-            for part in dataset['parts']:
-                parts.append(create_mask(part['path'], mask_config))
-            masks.append(parts)
+            for p, part in enumerate(dataset['parts']):
+                part_rows = rows[d][p] if rows is not None else None
+                parts.append(calc_weights_cached(
+                    part, part_rows, cache, event_selection, chunksize=chunksize,
+                ))
+            weights.append(parts)
         else:
-            masks.append(create_mask(dataset['path'], mask_config))
+            dataset_rows = rows[d] if rows is not None else None
+            weights.append(calc_weights_cached(
+                dataset, dataset_rows, cache, event_selection, chunksize=chunksize,
+            ))
+    return weights
 
-    return masks
 
+def calc_weights_cached(dataset, rows=None, cache=None, event_selection=None, chunksize=DEFAULT_CHUNKSIZE):
+    '''
+    Look up the weights of `dataset` in the `DiskCache` `cache`
+    and only call `calc_weights` if they are not cached yet.
+    `event_selection` identifies the selection of `rows`, see `selection_key`.
+    '''
+    if cache is None:
+        return calc_weights(dataset, rows=rows, chunksize=chunksize)
+
+    key = cache_key(
+        'weights',
+        WEIGHTS_CACHE_VERSION,
+        file_identity(dataset['path']),
+        {k: v for k, v in dataset.items() if k in WEIGHT_KEYS},
+        event_selection,
+    )
+    weights = cache.get(key)
+    if weights is None:
+        weights = calc_weights(dataset, rows=rows, chunksize=chunksize)
+        cache.put(key, weights)
+    return weights
 
-def create_mask(input_file, mask_config):
-    columns = list(mask_config.keys())
-    df = read_h5py(input_file, key='events', columns=columns)
 
-    mask = np.ones(len(df), dtype='bool')
-    for key, (op, val) in mask_config.items():
-        mask &= OPERATORS[op](df[key], val)
-    return mask
+def fill_all_histograms(
+    datasets,
+    bins,
+    transforms,
+    rows=None,
+    weights=None,
+    chunksize=DEFAULT_CHUNKSIZE,
+    slicing=None,
+):
+    hists = []
+    sumw2 = []
+    for d, dataset in enumerate(datasets):
+        if 'parts' in dataset:
+            hists.append([])
+            sumw2.append([])
+            for p, part in enumerate(dataset['parts']):
+                counts, part_sumw2 = fill_histograms(
+                    part['path'],
+                    bins,
+                    transforms=transforms,
+                    rows=rows[d][p] if rows is not None else None,
+                    weights=weights[d][p] if weights is not None else None,
+                    chunksize=chunksize,
+                    slicing=slicing,
+                )
+                hists[-1].append(counts)
+                sumw2[-1].append(part_sumw2)
+        else:
+            counts, dataset_sumw2 = fill_histograms(
+                dataset['path'],
+                bins,
+                transforms=transforms,
+                rows=rows[d] if rows is not None else None,
+                weights=weights[d] if weights is not None else None,
+                chunksize=chunksize,
+                slicing=slicing,
+            )
+            hists.append(counts)
+            sumw2.append(dataset_sumw2)
+    return hists, sumw2
 
 
-def calc_all_weights(datasets, masks=None):
-    weights = []
+def fill_all_sketches(datasets, columns, transforms, rows=None, chunksize=DEFAULT_CHUNKSIZE):
+    sketches = []
     for d, dataset in enumerate(datasets):
         if 'parts' in dataset:
             parts = []
             for p, part in enumerate(dataset['parts']):
-                mask = masks[d][p] if masks is not None else None
-                parts.append(calc_weights(part, mask=mask))
-            weights.append(parts)
+                parts.append(fill_sketches(
+                    part['path'],
+                    columns,
+                    transforms=transforms,
+                    rows=rows[d][p] if rows is not None else None,
+                    chunksize=chunksize,
+                ))
+            sketches.append(parts)
         else:
-            mask = masks[d] if masks is not None else None
-            weights.append(calc_weights(dataset, mask=mask))
-    return weights
+            sketches.append(fill_sketches(
+                dataset['path'],
+                columns,
+                transforms=transforms,
+                rows=rows[d] if rows is not None else None,
+                chunksize=chunksize,
+            ))
+    return sketches
 
 
-def get_common_columns(datasets):
+def get_all_catalogs(datasets, chunksize=DEFAULT_CHUNKSIZE):
+    catalogs = []
+    for dataset in datasets:
+        if 'parts' in dataset:
+            catalogs.append([get_catalog(part['path'], chunksize=chunksize) for part in dataset['parts']])
+        else:
+            catalogs.append(get_catalog(dataset['path'], chunksize=chunksize))
+    return catalogs
+
+
+def get_column_summaries(catalogs, column):
+    '''
+    `ColumnSummary` of `column` for each dataset and part,
+    None if the column is not numeric in any of the files
+    '''
+    summaries = []
+    for catalog in catalogs:
+        if isinstance(catalog, list):
+            summaries.append([get_column_summary(c, column) for c in catalog])
+            if any(summary is None for summary in summaries[-1]):
+                return None
+        else:
+            summaries.append(get_column_summary(catalog, column))
+            if summaries[-1] is None:
+                return None
+    return summaries
+
+
+def select_column(nested, column):
+    '''Pick `column` from each dict of a nested per dataset/part structure'''
+    return [
+        [part[column] for part in dataset] if isinstance(dataset, list) else dataset[column]
+        for dataset in nested
+    ]
+
+
+def get_column_kwargs(config, column, n_bins):
+    kwargs = dict(config.get('columns').get(column, {}))
+    kwargs['n_bins'] = kwargs.get('n_bins', n_bins)
+    return kwargs
+
+
+def get_definitions(config):
+    '''
+    Derived columns defined in the config by an `expression`
+    on the columns of the files, e.g. `width / length`
+    '''
+    return {
+        column: column_config['expression']
+        for column, column_config in (config.get('columns') or {}).items()
+        if column_config and 'expression' in column_config
+    }
+
+
+def get_slicing(config, available=None):
+    '''
+    `Slicing` for the `slice_by` entry of the config, e.g.
+
+        slice_by:
+            column: zd_tracking
+            bins: [0, 30, 45, 60]
+            mode: pages
+
+    Instead of `bins`, a list of categorical `values` can be given.
+    `column` can also be an expression or a derived column and the
+    names of the slices can be set using `labels`.
+    `available` are the columns of the files, see `get_file_columns`.
+    '''
+    slice_config = config.get('slice_by')
+    if slice_config is None:
+        return None
+
+    return Slicing(
+        Expression(slice_config['column'], get_definitions(config), available),
+        edges=slice_config.get('bins'),
+        values=slice_config.get('values'),
+        labels=slice_config.get('labels'),
+    )
+
+
+def slicing_key(slice_config):
+    '''The entries of a `slice_by` config the filled histograms depend on'''
+    if slice_config is None:
+        return None
+    return {k: v for k, v in slice_config.items() if k not in ('labels', 'mode')}
+
+
+def select_slice(nested, index):
+    '''Pick slice `index` of all histograms of a nested per dataset/part structure'''
+    def select(hists):
+        return {column: counts[index] for column, counts in hists.items()}
+
+    return [
+        [select(part) for part in dataset] if isinstance(dataset, list) else select(dataset)
+        for dataset in nested
+    ]
+
+
+def selection_key(config):
+    '''Everything the selected rows depend on, to be used in cache keys'''
+    selection = config.get('event_selection')
+    definitions = get_definitions(config)
+    if selection is None or not definitions:
+        return selection
+    return [selection, definitions]
+
+
+def get_derived_columns(config, common_columns):
+    '''Derived columns whose inputs are available in all datasets'''
+    definitions = get_definitions(config)
+    derived = []
+    for column, source in definitions.items():
+        expression = Expression(source, definitions, common_columns)
+        if set(expression.columns.values()) <= set(common_columns):
+            derived.append(column)
+        else:
+            print(f'Not all columns for derived column {column} available, skipping')
+    return derived
+
+
+def get_common_columns(datasets, chunksize=DEFAULT_CHUNKSIZE):
     common_columns = set()
     for dataset in datasets:
         if 'parts' in dataset:
             for part in dataset['parts']:
-                common_columns = update_columns(part, common_columns)
+                common_columns = update_columns(part, common_columns, chunksize)
         else:
-            common_columns = update_columns(dataset, common_columns)
+            common_columns = update_columns(dataset, common_columns, chunksize)
     return common_columns
 
 
@@ -338,27 +541,695 @@ def print_event_rates(weights, datasets):
             print(f'{l: <15}', f'{weights[d].sum() / 3600:6.2f} Events/s')
 
 
+def calc_all_bins(columns, config, rows, chunksize):
+    '''
+    Determine the bin edges of `columns`, columns for which no limits
+    could be determined are skipped.
+    '''
+    datasets = config['datasets']
+    n_bins = config.get('n_bins', 100)
+
+    column_kwargs = {
+        column: get_column_kwargs(config, column, n_bins)
+        for column in columns
+    }
+    transforms = get_transforms(config, columns)
+
+    # columns without configured limits need a look at the data first.
+    # Without selection and transformation, the statistics in the file catalogs
+    # can be used, for the others quantile sketches are filled in one pass
+    catalog_limits = {}
+    if rows is None:
+        catalogs = get_all_catalogs(datasets, chunksize)
+        for column in columns:
+            if column_kwargs[column].get('limits') is None and column not in transforms:
+                summaries = get_column_summaries(catalogs, column)
+                if summaries is not None:
+                    catalog_limits[column] = calc_limis(summaries)
+
+    auto_limits = [
+        column for column in columns
+        if column_kwargs[column].get('limits') is None and column not in catalog_limits
+    ]
+    if auto_limits:
+        sketches = fill_all_sketches(
+            datasets, auto_limits, transforms, rows=rows, chunksize=chunksize,
+        )
+
+    bins = {}
+    for column in columns:
+        kwargs = column_kwargs[column]
+        limits = kwargs.get('limits')
+        if limits is None and column in catalog_limits:
+            limits = catalog_limits[column]
+        elif limits is None:
+            limits = calc_limis(select_column(sketches, column))
+        if not np.all(np.isfinite(limits)):
+            print(f'Could not determine limits for column {column}, skipping')
+            continue
+        bins[column] = np.linspace(limits[0], limits[1], kwargs['n_bins'] + 1)
+
+    return bins
+
+
+def get_file_columns(config):
+    '''
+    Columns in the files of all datasets, so that columns
+    named like constants in expressions are used as columns
+    '''
+    return get_common_columns(config['datasets'])
+
+
+def get_transforms(config, columns):
+    '''
+    Compiled expressions for the derived columns and the columns
+    with a `transform` among `columns`
+    '''
+    definitions = get_definitions(config)
+    available = get_file_columns(config)
+    transforms = {}
+    for column in columns:
+        column_config = config.get('columns').get(column) or {}
+        if column_config.get('transform') is not None:
+            source = transform_source(column, column_config['transform'])
+        elif column in definitions:
+            source = column
+        else:
+            continue
+        # derived columns used in the expression are expanded to their definition
+        transforms[column] = Expression(source, definitions, available)
+    return transforms
+
+
+def fill_column_histograms(columns, config, rows, weights, chunksize):
+    '''
+    Determine the binning of `columns` and fill the histograms
+    of all datasets
+
+    Returns
+    -------
+    bins: dict
+        mapping of column to bin edges
+    hists: list
+        bin contents per dataset and part
+    sumw2: list
+        summed squared weights per dataset and part
+    '''
+    with profiler.stage('limits'):
+        bins = calc_all_bins(columns, config, rows, chunksize)
+
+    # read every file only once and fill the histograms of all columns
+    # and all slices
+    with profiler.stage('histograms'):
+        hists, sumw2 = fill_all_histograms(
+            config['datasets'],
+            bins,
+            get_transforms(config, bins.keys()),
+            rows=rows,
+            weights=weights,
+            chunksize=chunksize,
+            slicing=get_slicing(config, get_file_columns(config)),
+        )
+    return bins, hists, sumw2
+
+
+def prefetch_histograms(columns, config, rows, weights, chunksize, batch_size, prefetch, threads=1):
+    '''
+    Fill the histograms of `columns` in batches of `batch_size` columns
+    using `threads` background threads, while the caller consumes
+    the previous batches, e.g. by writing their pages.
+
+    At most `prefetch` batches are filled ahead of the one being consumed,
+    which bounds the memory needed for the waiting histograms.
+
+    Yields
+    ------
+    The `fill_column_histograms` results of the batches, in order
+    '''
+    batches = [columns[i:i + batch_size] for i in range(0, len(columns), batch_size)]
+    chunksize = share(chunksize, threads)
+
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        for batch in batches:
+            pending.append(executor.submit(
+                fill_column_histograms, batch, config, rows, weights, chunksize,
+            ))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def write_pages(outputfile, bins, hists, config, progress=True):
+    '''Write one page per column of `bins` into the pdf file `outputfile`'''
+    write_batches(outputfile, [(bins, hists)], config, n_pages=len(bins), progress=progress)
+
+
+def slice_pages(hists, slicing, mode='pages'):
+    '''
+    The pages of one column, each a list of `(hists, plot_hists kwargs)`
+    drawn on the same axes, and the page title.
+
+    Without `slicing` this is a single page, with mode `pages` one page
+    per slice and with mode `overlay` a single page showing all slices.
+    '''
+    if slicing is None:
+        return [([(hists, {})], None)]
+
+    if mode == 'overlay':
+        layers = [
+            (select_slice(hists, s), {
+                'label_suffix': ', ' + label,
+                'linestyle': SLICE_LINESTYLES[s % len(SLICE_LINESTYLES)],
+            })
+            for s, label in enumerate(slicing.labels)
+        ]
+        return [(layers, None)]
+
+    if mode == 'pages':
+        return [
+            ([(select_slice(hists, s), {})], label)
+            for s, label in enumerate(slicing.labels)
+        ]
+
+    raise ValueError('Unknown slice_by mode "{}"'.format(mode))
+
+
+def write_batches(outputfile, batches, config, n_pages=None, progress=True):
+    '''
+    Like `write_pages`, but for an iterable of `(bins, hists)` tuples,
+    so later batches can still be filled while the first pages are written
+    '''
+    datasets = config['datasets']
+    n_bins = config.get('n_bins', 100)
+    slicing = get_slicing(config)
+    slice_mode = (config.get('slice_by') or {}).get('mode', 'pages')
+
+    fig = plt.figure(constrained_layout=True)
+    ax_hist = fig.add_subplot(1, 1, 1)
+
+    with PdfPages(outputfile) as pdf, tqdm(total=n_pages, disable=not progress) as bar:
+        for bins, hists in batches:
+            for column in bins.keys():
+                kwargs = get_column_kwargs(config, column, n_bins)
+                kwargs.pop('n_bins')
+                kwargs.pop('limits', None)
+                kwargs.pop('expression', None)
+                transform = kwargs.pop('transform', None)
+                if transform is not None and kwargs.get('xlabel') is None:
+                    kwargs['xlabel'] = transform_source(column, transform)
+
+                for layers, title in slice_pages(hists, slicing, slice_mode):
+                    ax_hist.cla()
+                    try:
+                        with profiler.stage('plotting'):
+                            for layer_hists, layer_kwargs in layers:
+                                # same colors for the datasets in all slices
+                                ax_hist.set_prop_cycle(None)
+                                plot_hists(
+                                    layer_hists, column, datasets, bins[column],
+                                    ax=ax_hist, **kwargs, **layer_kwargs,
+                                )
+                            if title is not None:
+                                ax_hist.set_title(title)
+                        # fig.tight_layout(pad=0)
+                        with profiler.stage('writing'):
+                            pdf.savefig(fig)
+                    except IOError as e:
+                        print(f'Could not plot column {column}')
+                        print(e)
+                bar.update(1)
+
+    plt.close(fig)
+
+
+def render_pages(
+    outputfile,
+    columns,
+    config,
+    rows,
+    weights,
+    chunksize,
+    progress=True,
+    batch_size=None,
+    prefetch=0,
+    threads=1,
+):
+    '''
+    Fill the histograms of `columns` and write one page per column
+    into the pdf file `outputfile`.
+
+    With `prefetch` > 0, the histograms are filled in batches of `batch_size`
+    columns by `prefetch_histograms`, so reading the next columns overlaps
+    with writing the pages of the previous ones.
+
+    Returns the binning and histograms like `fill_column_histograms`.
+    '''
+    if prefetch == 0 or batch_size is None or len(columns) <= batch_size:
+        bins, hists, sumw2 = fill_column_histograms(columns, config, rows, weights, chunksize)
+        with profiler.stage('rendering'):
+            write_pages(outputfile, bins, hists, config, progress=progress)
+        return bins, hists, sumw2
+
+    results = []
+
+    def batches():
+        for result in prefetch_histograms(
+            columns, config, rows, weights, chunksize, batch_size, prefetch, threads,
+        ):
+            results.append(result)
+            bins, hists, _ = result
+            yield bins, hists
+
+    with profiler.stage('rendering'):
+        write_batches(outputfile, batches(), config, n_pages=len(columns), progress=progress)
+    return merge_shards(results)
+
+
+def merge_shards(results):
+    '''Combine the `render_pages` results of several column shards'''
+    bins = {}
+    for shard_bins, _, _ in results:
+        bins.update(shard_bins)
+
+    hists = [
+        merge_column_dicts(shard_hists)
+        for shard_hists in zip(*(hists for _, hists, _ in results))
+    ]
+    sumw2 = [
+        merge_column_dicts(shard_sumw2)
+        for shard_sumw2 in zip(*(sumw2 for _, _, sumw2 in results))
+    ]
+    return bins, hists, sumw2
+
+
+def merge_column_dicts(dicts):
+    '''Merge the dicts of one dataset, or of each of its parts, from all shards'''
+    if isinstance(dicts[0], list):
+        return [merge_column_dicts(parts) for parts in zip(*dicts)]
+
+    merged = {}
+    for d in dicts:
+        merged.update(d)
+    return merged
+
+
+def merge_pdfs(inputfiles, outputfile):
+    '''Concatenate the pages of all `inputfiles` into `outputfile`'''
+    writer = PdfWriter()
+    for inputfile in inputfiles:
+        # PdfPages does not create a file if no page was saved
+        if os.path.exists(inputfile):
+            writer.append(inputfile)
+
+    with open(outputfile, 'wb') as f:
+        writer.write(f)
+
+
+def write_metrics_table(outputfile, bins, hists, sumw2, config):
+    '''Write the data/MC agreement metrics of all columns of `bins` to `outputfile`'''
+    slicing = get_slicing(config)
+    with profiler.stage('metrics'):
+        rows = calc_metrics(
+            bins, hists, sumw2, config['datasets'],
+            slice_labels=slicing.labels if slicing is not None else None,
+        )
+    with profiler.stage('writing'):
+        write_metrics(outputfile, rows)
+
+
+def render_pages_parallel(outputfile, columns, config, rows, weights, chunksize, jobs):
+    '''
+    Split `columns` into contiguous shards, render each shard in a worker
+    process and merge the resulting pdfs in the original column order.
+    Returns the `render_pages` results of all shards.
+    '''
+    n_shards = max(min(jobs, len(columns)), 1)
+    shards = [
+        columns[i * len(columns) // n_shards:(i + 1) * len(columns) // n_shards]
+        for i in range(n_shards)
+    ]
+
+    with tempfile.TemporaryDirectory(prefix='fact_plots_') as tmpdir:
+        paths = [
+            os.path.join(tmpdir, 'shard_{:04d}.pdf'.format(i))
+            for i in range(len(shards))
+        ]
+        # the stages of the workers are not profiled, only their total time
+        with profiler.stage('workers'), ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(
+                    render_pages, path, shard, config, rows, weights, chunksize,
+                    progress=False,
+                )
+                for path, shard in zip(paths, shards)
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+
+        with profiler.stage('writing'):
+            merge_pdfs(paths, outputfile)
+
+    return [future.result() for future in futures]
+
+
+def render_incremental(outputfile, columns, config, chunksize, cache, store):
+    '''
+    Like `render_pages`, but every bin edges, histogram and page is stored
+    in the `PageStore` `store` under a fingerprint of its inputs.
+    Only what is not found in the store is recomputed, so e.g. changing the
+    spectrum of one dataset only re-reads the files of that dataset and
+    changing the limits of one column only refills and renders that column.
+    '''
+    datasets = config['datasets']
+    structure = dataset_structure(datasets)
+    leaves = flatten([d['parts'] if 'parts' in d else d for d in datasets])
+    selection = config.get('event_selection')
+    definitions = get_definitions(config)
+    selection_id = selection_key(config)
+    identities = [file_identity(leaf['path']) for leaf in leaves]
+    n_bins = config.get('n_bins', 100)
+    transforms = get_transforms(config, columns)
+
+    binning_keys = {}
+    for column in columns:
+        column_config = config.get('columns').get(column, {})
+        transform = transforms.get(column)
+        inputs = [
+            column,
+            column_config.get('n_bins', n_bins),
+            [transform.expression, transform.columns] if transform is not None else None,
+        ]
+        if column_config.get('limits') is None:
+            # automatic limits depend on the data of all datasets
+            inputs += [identities, selection_id]
+        else:
+            inputs += [column_config['limits']]
+        binning_keys[column] = cache_key('bins', PAGE_STORE_VERSION, *inputs)
+
+    slicing = get_slicing(config, get_file_columns(config))
+    if slicing is not None:
+        slice_id = [
+            slicing.expression.expression,
+            slicing.expression.columns,
+            slicing_key(config['slice_by']),
+        ]
+    else:
+        slice_id = None
+
+    hist_keys = {
+        column: [
+            cache_key(
+                'hist', binning_key, identity, selection_id, slice_id,
+                {k: v for k, v in leaf.items() if k in WEIGHT_KEYS},
+            )
+            for leaf, identity in zip(leaves, identities)
+        ]
+        for column, binning_key in binning_keys.items()
+    }
+
+    bins = {column: store.get_bins(key) for column, key in binning_keys.items()}
+    missing_bins = [column for column, edges in bins.items() if edges is None]
+    missing_hists = [
+        [
+            column for column in columns
+            if bins[column] is None or store.get_hist(hist_keys[column][i]) is None
+        ]
+        for i in range(len(leaves))
+    ]
+
+    # the selection and weights are only needed for leaves that are read
+    needed = {i for i, missing in enumerate(missing_hists) if missing}
+    if missing_bins:
+        needed = set(range(len(leaves)))
+
+    flat_rows = [None] * len(leaves)
+    if selection is not None:
+        with profiler.stage('selection'):
+            for i in needed:
+                flat_rows[i] = select_rows(
+                    leaves[i]['path'], selection,
+                    chunksize=chunksize, definitions=definitions,
+                )
+
+    if missing_bins:
+        rows = unflatten(flat_rows, structure) if selection is not None else None
+        with profiler.stage('limits'):
+            new_bins = calc_all_bins(missing_bins, config, rows, chunksize)
+        for column in missing_bins:
+            if column in new_bins:
+                bins[column] = new_bins[column]
+                store.put_bins(binning_keys[column], new_bins[column])
+
+    # columns without valid limits are skipped
+    columns = [column for column in columns if bins[column] is not None]
+
+    for i in sorted(needed):
+        missing = {c: bins[c] for c in missing_hists[i] if bins[c] is not None}
+        if not missing:
+            continue
+
+        with profiler.stage('weights'):
+            weights = calc_weights_cached(
+                leaves[i], flat_rows[i], cache, selection_id, chunksize=chunksize,
+            )
+        with profiler.stage('histograms'):
+            counts, sumw2 = fill_histograms(
+                leaves[i]['path'],
+                missing,
+                transforms=transforms,
+                rows=flat_rows[i],
+                weights=weights,
+                chunksize=chunksize,
+                slicing=slicing,
+            )
+        for column in missing:
+            store.put_hist(hist_keys[column][i], counts[column], sumw2[column])
+
+    page_keys = {}
+    n_rendered = 0
+    for column in tqdm(columns):
+        page_keys[column] = cache_key(
+            'page', PAGE_STORE_VERSION, hist_keys[column],
+            config.get('columns').get(column, {}), n_bins, datasets,
+            config.get('slice_by'),
+        )
+        if store.has_page(page_keys[column]):
+            continue
+
+        flat_counts = [{column: store.get_hist(key)[0]} for key in hist_keys[column]]
+        store.put_page(page_keys[column], lambda path: write_pages(
+            path,
+            {column: bins[column]},
+            unflatten(flat_counts, structure),
+            config,
+            progress=False,
+        ))
+        n_rendered += 1
+
+    print('Filled histograms from {} of {} files, rendered {} of {} pages'.format(
+        len(needed), len(leaves), n_rendered, len(columns),
+    ))
+    with profiler.stage('writing'):
+        merge_pdfs([store.page_path(page_keys[column]) for column in columns], outputfile)
+
+    used_keys = [binning_keys[column] for column in columns]
+    used_keys += [key for column in columns for key in hist_keys[column]]
+    used_keys += list(page_keys.values())
+    store.collect_garbage(used_keys)
+
+
+def dataset_structure(datasets):
+    '''Number of parts of each dataset, -1 for datasets without parts'''
+    return [len(d['parts']) if 'parts' in d else -1 for d in datasets]
+
+
+def compare(
+    outputfile,
+    columns,
+    config,
+    chunksize,
+    jobs,
+    cache,
+    write_histograms,
+    batch_size,
+    prefetch,
+    io_threads,
+    metrics_only=False,
+):
+    datasets = config['datasets']
+
+    if config.get('event_selection') is not None:
+        with profiler.stage('selection'):
+            rows = select_all_rows(config, chunksize=chunksize)
+    else:
+        rows = None
+
+    with profiler.stage('weights'):
+        weights = calc_all_weights(
+            datasets, rows, cache=cache,
+            event_selection=selection_key(config),
+            chunksize=chunksize,
+        )
+
+    print_event_rates(weights, datasets)
+
+    if metrics_only:
+        # no pages, so all histograms are filled in a single pass over the files
+        results = [fill_column_histograms(columns, config, rows, weights, chunksize)]
+        write_metrics_table(outputfile, *results[0], config)
+    elif jobs == 1:
+        results = [render_pages(
+            outputfile, columns, config, rows, weights, chunksize,
+            batch_size=batch_size, prefetch=prefetch, threads=io_threads,
+        )]
+    else:
+        results = render_pages_parallel(outputfile, columns, config, rows, weights, chunksize, jobs)
+
+    if write_histograms is not None:
+        bins, hists, sumw2 = merge_shards(results)
+        write_histograms_file(
+            write_histograms, bins, hists, sumw2,
+            attrs={
+                'structure': dataset_structure(datasets),
+                'labels': [dataset['label'] for dataset in datasets],
+                'event_selection': config.get('event_selection'),
+                'slice_by': config.get('slice_by'),
+            },
+        )
+
+
 @click.command()
+@profile_command
 @click.argument('config')
 @click.argument('outputfile')
-def main(config, outputfile):
+@click.option(
+    '--chunksize', type=int, default=DEFAULT_CHUNKSIZE, show_default=True,
+    help='Number of rows read at once when filling the histograms',
+)
+@click.option(
+    '--max-memory',
+    help=(
+        'Upper limit for the memory used, e.g. 4G. Chunk sizes are chosen automatically'
+        ' to stay below it and the peak memory of each stage is reported.'
+        ' With --jobs, the limit applies to each worker process.'
+    ),
+)
+@click.option(
+    '-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True,
+    help='Number of worker processes, each rendering a part of the columns',
+)
+@click.option(
+    '--prefetch', type=click.IntRange(min=0), default=2, show_default=True,
+    help=(
+        'Number of column batches whose histograms are filled in the background'
+        ' while the pages of the previous batch are written, 0 to fill all histograms first'
+    ),
+)
+@click.option(
+    '--batch-size', type=click.IntRange(min=1), default=10, show_default=True,
+    help='Number of columns filled together with --prefetch',
+)
+@click.option(
+    '--io-threads', type=click.IntRange(min=1), default=1, show_default=True,
+    help='Number of threads filling batches with --prefetch',
+)
+@click.option(
+    '--cache-dir', default=DEFAULT_CACHE_DIR, show_default=True,
+    help='Directory for cached event weights, also set by FACT_PLOTS_CACHE_DIR',
+)
+@click.option(
+    '--max-cache-size', type=float, default=1024, show_default=True,
+    help='Maximum size of the weight cache in MB, least recently used entries are removed',
+)
+@click.option('--no-cache', is_flag=True, help='Always recalculate the event weights')
+@click.option(
+    '--write-histograms', type=click.Path(dir_okay=False),
+    help='Also store all histograms in this hdf5 file for re-rendering',
+)
+@click.option(
+    '--from-histograms', type=click.Path(exists=True, dir_okay=False),
+    help='Only render the pdf from histograms stored with --write-histograms',
+)
+@click.option(
+    '--incremental', is_flag=True,
+    help='Only recompute histograms and pages whose inputs changed since the last run',
+)
+@click.option(
+    '--metrics-only', is_flag=True,
+    help=(
+        'Do not plot, write the data/MC agreement metrics of all columns'
+        ' to OUTPUTFILE instead, as csv if it ends with .csv, else as json'
+    ),
+)
+@click.option(
+    '--page-store', type=click.Path(file_okay=False),
+    help='Directory for the stored pages of --incremental, default: OUTPUTFILE.pages',
+)
+def main(
+    config,
+    outputfile,
+    chunksize,
+    max_memory,
+    jobs,
+    prefetch,
+    batch_size,
+    io_threads,
+    cache_dir,
+    max_cache_size,
+    no_cache,
+    write_histograms,
+    from_histograms,
+    incremental,
+    page_store,
+    metrics_only,
+):
 
     with open(config) as f:
         config = yaml.load(f)
 
     datasets = config['datasets']
 
-    n_bins = config.get('n_bins', 100)
+    if max_memory is not None:
+        try:
+            max_memory = parse_memory(max_memory)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--max-memory')
+        chunksize = MemoryBudget(max_memory)
+        monitor.enabled = True
+
+    if from_histograms is not None:
+        bins, hists, sumw2, attrs = read_histograms(from_histograms)
+        if attrs.get('structure') != dataset_structure(datasets):
+            raise click.ClickException(
+                'Datasets in config do not match those in {}'.format(from_histograms)
+            )
+        if slicing_key(attrs.get('slice_by')) != slicing_key(config.get('slice_by')):
+            raise click.ClickException(
+                'slice_by in config does not match the one of {}'.format(from_histograms)
+            )
+        if metrics_only:
+            write_metrics_table(outputfile, bins, hists, sumw2, config)
+        else:
+            write_pages(outputfile, bins, hists, config)
+        return
 
-    if config.get('event_selection') is not None:
-        masks = create_masks(config)
+    if no_cache:
+        cache = None
     else:
-        masks = None
-
-    # get columns available in all datasets and calculate weights
+        cache = DiskCache(cache_dir, max_size=int(max_cache_size * 1024**2))
 
-    weights = calc_all_weights(datasets, masks)
-    common_columns = get_common_columns(datasets)
+    # get columns available in all datasets
+    with profiler.stage('catalogs'):
+        common_columns = get_common_columns(datasets, chunksize)
+    common_columns = set(common_columns) | set(get_derived_columns(config, common_columns))
 
     # select columns
     columns = config.get('include_columns')
@@ -381,30 +1252,27 @@ def main(config, outputfile):
             )
         columns = list(filter(excluded, columns))
 
-    fig = plt.figure(constrained_layout=True)
-    ax_hist = fig.add_subplot(1, 1, 1)
-
-    with PdfPages(outputfile) as pdf:
-        for i, column in enumerate(tqdm(columns)):
-
-            kwargs = config.get('columns').get(column, {})
-            kwargs['n_bins'] = kwargs.get('n_bins', n_bins)
-            if 'transform' in kwargs:
-                kwargs['transform'] = eval(kwargs['transform'])
-
-            dfs = read_dfs_for_column(datasets, column, masks=masks)
+    if incremental:
+        if jobs > 1 or write_histograms is not None or metrics_only:
+            raise click.UsageError(
+                '--incremental can not be combined with --jobs, --write-histograms or --metrics-only'
+            )
+        store = PageStore(page_store or outputfile + '.pages')
 
-            if i == 0:
-                print_event_rates(weights, datasets)
+    try:
+        if incremental:
+            render_incremental(outputfile, columns, config, chunksize, cache, store)
+        else:
+            compare(
+                outputfile, columns, config, chunksize, jobs, cache, write_histograms,
+                batch_size=batch_size, prefetch=prefetch, io_threads=io_threads,
+                metrics_only=metrics_only,
+            )
+    except MemoryError as e:
+        raise click.ClickException('Not enough memory: {}'.format(e))
 
-            ax_hist.cla()
-            try:
-                plot_hists(dfs, weights, column, datasets, ax=ax_hist, **kwargs)
-                # fig.tight_layout(pad=0)
-                pdf.savefig(fig)
-            except IOError as e:
-                print(f'Could not plot column {column}')
-                print(e)
+    if max_memory is not None:
+        print(monitor.report(max_memory))
 
 
 if __name__ == '__main__':
@@ -8,6 +8,7 @@ import click
 
 from ..plotting import add_preliminary
 from ..effective_area import plot_effective_area
+from ..profiling import profiler, profile_command
 
 yaml = YAML(typ='safe')
 
@@ -22,6 +23,7 @@ plot_config = {
 
 
 @click.command()
+@profile_command
 @click.argument('CORSIKA_HEADERS')
 @click.argument('ANALYSIS_OUTPUT')
 @click.option('-f', '--fraction', type=float, help='Sample fraction for all_events')
@@ -56,18 +58,19 @@ def main(
         with open(config) as f:
             plot_config.update(yaml.load(f))
 
-    all_events = read_data(corsika_headers, key='corsika_events')
-
-
-    analysed = read_data(
-        analysis_output,
-        key='events',
-        columns=[
-            'corsika_event_header_total_energy',
-            'gamma_prediction',
-            'theta_deg'
-        ]
-    )
+    with profiler.stage('read'):
+        all_events = read_data(corsika_headers, key='corsika_events')
+
+        analysed = read_data(
+            analysis_output,
+            key='events',
+            columns=[
+                'corsika_event_header_total_energy',
+                'gamma_prediction',
+                'theta_deg'
+            ]
+        )
+        profiler.add_rows(len(all_events) + len(analysed))
 
     if fraction is None:
         with h5py.File(analysis_output, 'r') as f:
@@ -88,40 +91,45 @@ def main(
     assert len(theta2_cut) == len(threshold), 'Number of cuts has to be the same for theta and threshold'
 
     for threshold, theta2_cut in zip(threshold[:], theta2_cut[:]):
-        selected = analysed.query(
-            '(gamma_prediction >= @threshold) & (theta_deg**2 <= @theta2_cut)'
-        ).copy()
+        with profiler.stage('selection'):
+            selected = analysed.query(
+                '(gamma_prediction >= @threshold) & (theta_deg**2 <= @theta2_cut)'
+            ).copy()
 
         label = r'$p_\gamma \geq {}$'.format(threshold)
         if theta2_cut != np.inf:
             label += r', $\theta^2 \leq {:.3g}\,\mathrm{{deg}}^2$'.format(theta2_cut)
 
-        plot_effective_area(
-            all_events.total_energy,
-            selected.corsika_event_header_total_energy,
-            bins=bins,
-            impact=impact,
-            sample_fraction=fraction,
-            label=label,
-        )
-
-    if preliminary:
-        add_preliminary(
-            plot_config['preliminary_position'],
-            size=plot_config['preliminary_size'],
-            color=plot_config['preliminary_color'],
-        )
-
-    plt.legend()
-    plt.xlabel(plot_config['xlabel'])
-    plt.ylabel(plot_config['ylabel'])
-
-    plt.yscale('log')
-    plt.xscale('log')
+        with profiler.stage('plotting'):
+            plot_effective_area(
+                all_events.total_energy,
+                selected.corsika_event_header_total_energy,
+                bins=bins,
+                impact=impact,
+                sample_fraction=fraction,
+                label=label,
+            )
+
+    with profiler.stage('plotting'):
+        if preliminary:
+            add_preliminary(
+                plot_config['preliminary_position'],
+                size=plot_config['preliminary_size'],
+                color=plot_config['preliminary_color'],
+            )
+
+        plt.legend()
+        plt.xlabel(plot_config['xlabel'])
+        plt.ylabel(plot_config['ylabel'])
+
+        plt.yscale('log')
+        plt.xscale('log')
+
+        plt.tight_layout(pad=0.02)
 
-    plt.tight_layout(pad=0.02)
     if output is not None:
-        plt.savefig(output, dpi=300)
+        with profiler.stage('writing'):
+            plt.savefig(output, dpi=300)
     else:
         plt.show()
 
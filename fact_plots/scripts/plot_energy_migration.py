@@ -7,6 +7,7 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 from ruamel.yaml import YAML
 
 from ..plotting import add_preliminary
+from ..profiling import profiler, profile_command
 
 yaml = YAML(typ='safe')
 plot_config = {
@@ -21,6 +22,7 @@ plot_config = {
 
 
 @click.command()
+@profile_command
 @click.argument('gamma_path')
 @click.option(
     '--std', default=False, is_flag=True,
@@ -34,34 +36,38 @@ plot_config = {
 @click.option('-o', '--output')
 def main(gamma_path, std, n_bins, threshold, theta2_cut, preliminary, config, output):
 
-    df = read_h5py(
-        gamma_path,
-        key='events',
-        columns=[
-            'gamma_energy_prediction',
-            'corsika_event_header_total_energy',
-            'gamma_prediction',
-            'theta_deg'
-        ],
-    )
+    with profiler.stage('read'):
+        df = read_h5py(
+            gamma_path,
+            key='events',
+            columns=[
+                'gamma_energy_prediction',
+                'corsika_event_header_total_energy',
+                'gamma_prediction',
+                'theta_deg'
+            ],
+        )
+        profiler.add_rows(len(df))
 
     if config:
         with open(config) as f:
             plot_config.update(yaml.load(f))
 
-    if threshold:
-        df = df.query('gamma_prediction >= @threshold').copy()
-    if theta2_cut:
-        df = df.query('theta_deg**2 <= @theta2_cut').copy()
+    with profiler.stage('selection'):
+        if threshold:
+            df = df.query('gamma_prediction >= @threshold').copy()
+        if theta2_cut:
+            df = df.query('theta_deg**2 <= @theta2_cut').copy()
 
-    fig = plt.figure()
-    ax = fig.add_subplot(1, 1, 1)
-    divider = make_axes_locatable(ax)
-    cax = divider.append_axes('right', size='5%', pad=0.025)
+    with profiler.stage('plotting'):
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 1, 1)
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes('right', size='5%', pad=0.025)
 
-    ax.set_aspect(1)
-    ax.set_xscale('log')
-    ax.set_yscale('log')
+        ax.set_aspect(1)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
 
     e_min = min(
         df.gamma_energy_prediction.min(),
@@ -75,35 +81,39 @@ def main(gamma_path, std, n_bins, threshold, theta2_cut, preliminary, config, ou
     limits = np.log10([e_min, e_max])
     bins = np.logspace(limits[0], limits[1], n_bins + 1)
 
-    hist, xedges, yedges = np.histogram2d(
-        df.corsika_event_header_total_energy.values,
-        df.gamma_energy_prediction.values,
-        bins=bins,
-    )
-    plot = ax.pcolormesh(
-        xedges, yedges, hist.T,
-        norm=LogNorm() if plot_config['logz'] else None,
-        cmap=plot_config['cmap'],
-    )
-    plot.set_rasterized(True)
-
-    fig.colorbar(plot, cax=cax)
+    with profiler.stage('histograms'):
+        hist, xedges, yedges = np.histogram2d(
+            df.corsika_event_header_total_energy.values,
+            df.gamma_energy_prediction.values,
+            bins=bins,
+        )
 
-    if preliminary:
-        add_preliminary(
-            plot_config['preliminary_position'],
-            size=plot_config['preliminary_size'],
-            color=plot_config['preliminary_color'],
-            ax=ax,
+    with profiler.stage('plotting'):
+        plot = ax.pcolormesh(
+            xedges, yedges, hist.T,
+            norm=LogNorm() if plot_config['logz'] else None,
+            cmap=plot_config['cmap'],
         )
+        plot.set_rasterized(True)
+
+        fig.colorbar(plot, cax=cax)
+
+        if preliminary:
+            add_preliminary(
+                plot_config['preliminary_position'],
+                size=plot_config['preliminary_size'],
+                color=plot_config['preliminary_color'],
+                ax=ax,
+            )
 
-    ax.set_xlabel(plot_config['xlabel'])
-    ax.set_ylabel(plot_config['ylabel'])
+        ax.set_xlabel(plot_config['xlabel'])
+        ax.set_ylabel(plot_config['ylabel'])
 
-    fig.tight_layout(pad=0)
+        fig.tight_layout(pad=0)
 
     if output:
-        fig.savefig(output, dpi=300)
+        with profiler.stage('writing'):
+            fig.savefig(output, dpi=300)
     else:
         plt.show()
 
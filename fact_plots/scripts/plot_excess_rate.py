@@ -1,15 +1,26 @@
+import os
+from datetime import datetime
+from time import sleep
+
 from fact import analysis
-import fact.analysis.binning
 from fact import plotting
 from fact.io import read_h5py
+import numpy as np
 import pandas as pd
 from dateutil.parser import parse
 
 import matplotlib.pyplot as plt
 import click
-from functools import partial
 
 from ..plotting import add_preliminary
+from ..profiling import profiler, profile_command
+from ..gti import build_gti
+from ..histograms import iter_chunks
+from ..time import gti_rows
+from ..theta_squared import POSITION_COLUMNS, calc_theta, run_summary
+from ..cache import DiskCache, DEFAULT_CACHE_DIR
+from ..binning import NIGHTLY, bin_runs
+from ..follow import RunCounter, input_files
 
 
 plot_config = {
@@ -33,24 +44,222 @@ columns = [
 ]
 
 
+def binning_output(output, binning, several):
+    '''
+    Output file of one binning, `{binning}` in `output` is replaced by it
+    or, for several binnings, it is appended to the file name
+    '''
+    label = binning if binning == NIGHTLY else '{:g}min'.format(binning)
+    if '{binning}' in output:
+        return output.format(binning=label)
+    if not several:
+        return output
+    root, ext = os.path.splitext(output)
+    return '{}_{}{}'.format(root, label, ext)
+
+
+def event_summary(data_path, runs, rows, threshold, theta2_cut, key, n_off=None):
+    '''
+    Read the events `rows`, all if None, and count the on and off events of each run
+    with `calc_run_summary_source_independent`
+
+    Returns
+    -------
+    summary: pd.DataFrame
+        `runs` with the on and off counts
+    n_regions: int
+        number of off regions
+    '''
+    if n_off is None:
+        theta_off_keys = [c for c in columns if c.startswith('theta_deg_off_')]
+        event_columns = columns
+    else:
+        theta_off_keys = ['theta_deg_off_{}'.format(i) for i in range(1, n_off + 1)]
+        event_columns = ['gamma_prediction', 'run_id', 'night'] + POSITION_COLUMNS
+
+    with profiler.stage('read'):
+        if rows is None:
+            events = read_h5py(data_path, key=key, columns=event_columns)
+            profiler.add_rows(len(events))
+        else:
+            # only the chunks containing selected events are read
+            chunks = list(iter_chunks(data_path, event_columns, key=key, rows=rows))
+            if chunks:
+                events = pd.DataFrame({
+                    column: np.concatenate([chunk[column] for chunk in chunks])
+                    for column in event_columns
+                })
+            else:
+                events = read_h5py(data_path, key=key, columns=event_columns, first=0, last=0)
+
+    with profiler.stage('analysis'):
+        if n_off is not None:
+            theta = calc_theta(*(events[column].values for column in POSITION_COLUMNS), n_off=n_off)
+            events = events.drop(columns=POSITION_COLUMNS)
+            for column, values in zip(['theta_deg'] + theta_off_keys, theta):
+                events[column] = values
+
+        summary = analysis.calc_run_summary_source_independent(
+            events,
+            runs,
+            prediction_threshold=threshold,
+            theta2_cut=theta2_cut,
+            theta_off_keys=theta_off_keys,
+        )
+
+    return summary, len(theta_off_keys)
+
+
+def parse_binnings(binning):
+    '''The values of --binning as `NIGHTLY` or the ontime of a bin in minutes'''
+    binnings = []
+    for value in binning:
+        if value == NIGHTLY:
+            binnings.append(NIGHTLY)
+            continue
+        try:
+            binnings.append(float(value))
+        except ValueError:
+            print('--binning must be float or "nightly"')
+            raise click.Abort()
+    return binnings
+
+
+def plot_binned(summary, alpha, binnings, ontime_fraction, preliminary=False, output=None):
+    '''Bin the run `summary` for all `binnings` and plot the excess rate of each'''
+    with profiler.stage('binning'):
+        binned = bin_runs(summary, alpha=alpha, binnings=binnings)
+
+    for value, bins in binned.items():
+        if value != NIGHTLY:
+            bins = bins.query('ontime >= (@ontime_fraction * @value * 60)')
+
+        with profiler.stage('plotting'):
+            ax_exc, ax_sig, ax_mjd = plotting.analysis.plot_excess_rate(bins)
+
+            if preliminary:
+                add_preliminary(
+                    plot_config['preliminary_position'],
+                    size=plot_config['preliminary_size'],
+                    color=plot_config['preliminary_color'],
+                    ax=ax_exc,
+                )
+
+            plt.tight_layout(pad=0)
+
+        if output:
+            with profiler.stage('writing'):
+                plt.savefig(binning_output(output, value, several=len(binnings) > 1), dpi=300)
+            plt.close()
+
+
+def follow(
+    data_path, counter, interval, select_time, alpha, binnings, ontime_fraction, preliminary, output,
+):
+    '''
+    Update the on and off counts of `counter` with the events appended to the
+    files of `data_path` every `interval` seconds and re-render the plots,
+    until interrupted. `select_time` applies the time selection to the runs.
+    '''
+    print('Following {}, updating every {:g} s, stop with Ctrl+C'.format(data_path, interval))
+    n_runs = None
+    try:
+        while True:
+            n_new = 0
+            for path in input_files(data_path):
+                try:
+                    n_new += counter.update(path)
+                except (OSError, KeyError) as e:
+                    # e.g. a file that is still being created
+                    print('Skipping {} for now: {}'.format(path, e))
+
+            if counter.runs and (n_new > 0 or n_runs is None or counter.n_runs != n_runs):
+                n_runs = counter.n_runs
+                summary = select_time(counter.summary())
+                plot_binned(
+                    summary, alpha if alpha is not None else 1 / counter.n_regions,
+                    binnings, ontime_fraction, preliminary, output,
+                )
+                print('{:%H:%M:%S} {} new events, {} runs'.format(datetime.now(), n_new, len(summary)))
+
+            sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
 @click.command()
+@profile_command
 @click.argument('data_path')
 @click.option('--threshold', type=float, help='prediction threshold', default=0.8, show_default=True)
 @click.option('--theta2-cut', type=float, help='cut for theta^2 in deg^2', default=0.03, show_default=True)
 @click.option('--key', help='Key for the hdf5 group', default='events')
 @click.option(
     '--binning',
-    help='Ontime in one bin in minutes or "nightly" for nightly binning',
-    default='20',
+    help=(
+        'Ontime in one bin in minutes or "nightly" for nightly binning.'
+        ' Can be given multiple times to plot several binnings, the binning'
+        ' is then added to the output file name or replaces "{binning}" in it'
+    ),
+    default=['20'],
+    multiple=True,
     show_default=True
 )
-@click.option('--alpha', help='Ratio of on vs off region', default=0.2, show_default=True)
+@click.option(
+    '--alpha', type=float,
+    help='Ratio of on vs off region, default: one over the number of off regions',
+)
 @click.option('--start', help='Date of first observation YYYY-MM-DD HH:SS or anything parseable by dateutil')
 @click.option('--end', help='Date of first observation YYYY-MM-DD HH:SS or anything parseable by dateutil')
+@click.option(
+    '--gti', 'gti_file', type=click.Path(exists=True, dir_okay=False),
+    help='File with good time intervals, one "start, stop" per line, combined with --start/--end',
+)
+@click.option(
+    '--run-selection',
+    help='Only use the time of runs passing this query on the runs table, e.g. "fOnTime > 0.9"',
+)
+@click.option(
+    '--n-off', type=click.IntRange(min=1),
+    help=(
+        'Compute theta for this many off positions from the source position columns'
+        ' instead of reading the theta_deg_off_<i> columns'
+    ),
+)
+@click.option(
+    '--run-cache', is_flag=True,
+    help=(
+        'Keep the on and off counts of each run for these cuts in the cache directory,'
+        ' so only runs not seen before or reprocessed since are read.'
+        ' With --start/--end, --gti or --run-selection, only runs completely inside are used'
+    ),
+)
+@click.option(
+    '--cache-dir', default=DEFAULT_CACHE_DIR, show_default=True,
+    help='Directory for --run-cache, also set by FACT_PLOTS_CACHE_DIR',
+)
+@click.option(
+    '--max-cache-size', type=float, default=1024, show_default=True,
+    help='Maximum size of the cache in MB, least recently used entries are removed',
+)
+@click.option(
+    '--follow', 'follow_mode', is_flag=True,
+    help=(
+        'Keep running and update the plots whenever events are appended to DATA_PATH,'
+        ' which can also be a directory of hdf5 files. Only new events are read'
+    ),
+)
+@click.option(
+    '--interval', type=float, default=30, show_default=True,
+    help='Seconds between checks for new events with --follow',
+)
 @click.option('-f', '--ontime-fraction', default=0.90, help='Discard bins with less ontime than fraction * binning')
 @click.option('--preliminary', is_flag=True, help='Add preliminary')
 @click.option('-o', '--output', help='(optional) output file for the plot')
-def main(data_path, threshold, theta2_cut, key, binning, alpha, start, end, ontime_fraction, preliminary, output):
+def main(
+    data_path, threshold, theta2_cut, key, binning, alpha, start, end,
+    gti_file, run_selection, n_off, run_cache, cache_dir, max_cache_size,
+    follow_mode, interval, ontime_fraction, preliminary, output,
+):
     '''
     Given the DATA_PATH to a data hdf5 file (e.g. the output of ERNAs gather scripts)
     this script will create a plot of excess rates over time.
@@ -69,61 +278,83 @@ def main(data_path, threshold, theta2_cut, key, binning, alpha, start, end, onti
 
     The 'gamma_prediction' column can be added to the data using
     'klaas_apply_separation_model' for example.
-    '''
-
-    events = read_h5py(data_path, key='events', columns=columns)
 
-    runs = read_h5py(data_path, key='runs')
-    runs['run_start'] = pd.to_datetime(runs['run_start'])
-    runs['run_stop'] = pd.to_datetime(runs['run_stop'])
+    With --n-off, the theta columns are not needed. Instead, theta is computed
+    for the on and the given number of off positions from the columns
+        'source_x_prediction', 'source_y_prediction',
+        'source_position_x', 'source_position_y'.
 
-    if start:
-        start = parse(start)
-        runs = runs.query('run_start >= @start')
-    if end:
-        end = parse(end)
-        runs = runs.query('run_stop <= @end')
+    Time selections by --start/--end, --gti and --run-selection are combined
+    into one set of good time intervals. Only events inside the intervals
+    are used and the ontime of runs partially inside is scaled by the covered fraction.
 
-    summary = analysis.calc_run_summary_source_independent(
-        events,
-        runs,
-        prediction_threshold=threshold,
-        theta2_cut=theta2_cut,
-    )
+    With --follow, the plots are updated during observations as events are
+    appended, reading only the new events. Time selections then only use
+    runs completely inside the intervals.
+    '''
+    binnings = parse_binnings(binning)
+    start = parse(start) if start else None
+    end = parse(end) if end else None
 
-    if binning == 'nightly':
-        binning_function = fact.analysis.binning.nightly_binning
-    else:
+    if follow_mode:
+        if not output:
+            raise click.UsageError('--follow needs an --output to update')
         try:
-            binning = float(binning)
-        except ValueError:
-            print('--binning must be float or "nightly"')
-            raise click.Abort()
+            build_gti(start, end, gti_file)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--gti')
+
+        def select_time(runs):
+            gti = build_gti(start, end, gti_file, runs, run_selection)
+            if gti is None:
+                return runs
+            runs = gti.select_runs(runs)
+            return runs[np.isclose(runs['ontime_fraction'], 1)]
 
-        binning_function = partial(
-            fact.analysis.binning.ontime_binning,
-            bin_width_minutes=binning
+        follow(
+            data_path, RunCounter(threshold, theta2_cut, key=key, n_off=n_off),
+            interval, select_time, alpha, binnings, ontime_fraction, preliminary, output,
         )
+        return
 
-    bins = analysis.bin_runs(summary, alpha=alpha, binning_function=binning_function)
-    if isinstance(binning, float):
-        bins = bins.query('ontime >= (@ontime_fraction * @binning * 60)')
+    with profiler.stage('read'):
+        runs = read_h5py(data_path, key='runs')
+        runs['run_start'] = pd.to_datetime(runs['run_start'])
+        runs['run_stop'] = pd.to_datetime(runs['run_stop'])
 
-    ax_exc, ax_sig, ax_mjd = plotting.analysis.plot_excess_rate(bins)
+    with profiler.stage('selection'):
+        try:
+            gti = build_gti(start, end, gti_file, runs, run_selection)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--gti')
+
+        rows = None
+        if gti is not None:
+            runs = gti.select_runs(runs)
+            if run_cache:
+                # the stored counts are per run, so partial runs can't be used
+                runs = runs[np.isclose(runs['ontime_fraction'], 1)]
+            else:
+                rows = gti_rows(data_path, gti, key=key)
 
-    if preliminary:
-        add_preliminary(
-            plot_config['preliminary_position'],
-            size=plot_config['preliminary_size'],
-            color=plot_config['preliminary_color'],
-            ax=ax_exc,
+    if run_cache:
+        cache = DiskCache(cache_dir, max_size=int(max_cache_size * 1024**2))
+        with profiler.stage('analysis'):
+            counts, n_regions = run_summary(
+                data_path, threshold, theta2_cut, cache=cache, key=key, n_off=n_off, runs=runs,
+            )
+            summary = runs.merge(counts, on=['night', 'run_id'], how='left')
+            summary[['n_on', 'n_off']] = summary[['n_on', 'n_off']].fillna(0)
+    else:
+        summary, n_regions = event_summary(
+            data_path, runs, rows, threshold, theta2_cut, key, n_off,
         )
 
-    plt.tight_layout(pad=0)
+    if alpha is None:
+        alpha = 1 / n_regions
 
-    if output:
-        plt.savefig(output, dpi=300)
-    else:
+    plot_binned(summary, alpha, binnings, ontime_fraction, preliminary, output)
+    if not output:
         plt.show()
 
 
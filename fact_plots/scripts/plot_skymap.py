@@ -8,6 +8,7 @@ from fact.io import read_h5py
 
 from ..skymap import plot_skymap
 from ..plotting import add_preliminary
+from ..profiling import profiler, profile_command
 
 yaml = YAML(typ='safe')
 plot_config = {
@@ -31,6 +32,7 @@ columns = [
 
 
 @click.command()
+@profile_command
 @click.argument('data_path')
 @click.option('--threshold', type=float, help='prediction threshold', default=0.8, show_default=True)
 @click.option('--key', help='Key for the hdf5 group', default='events')
@@ -53,10 +55,13 @@ def main(data_path, threshold, key, bins, width, preliminary, config, output, so
     if threshold > 0.0:
         columns.append('gamma_prediction')
 
-    events = read_h5py(data_path, key='events', columns=columns)
+    with profiler.stage('read'):
+        events = read_h5py(data_path, key='events', columns=columns)
+        profiler.add_rows(len(events))
 
-    if threshold > 0.0:
-        events = events.query('gamma_prediction >= @threshold').copy()
+    with profiler.stage('selection'):
+        if threshold > 0.0:
+            events = events.query('gamma_prediction >= @threshold').copy()
 
     fig, ax = plt.subplots(1, 1)
 
@@ -78,45 +83,48 @@ def main(data_path, threshold, key, bins, width, preliminary, config, output, so
     else:
         center_ra = center_dec = None
 
-    ax, img = plot_skymap(
-        events,
-        width=width,
-        bins=bins,
-        center_ra=center_ra,
-        center_dec=center_dec,
-        ax=ax,
-    )
-
-    if coord:
-        ax.plot(
-            center_ra,
-            center_dec,
-            label=label,
-            color=plot_config['source_color'],
-            marker='o',
-            linestyle='',
-            markersize=plot_config['source_size'],
-            markerfacecolor='none',
-        )
-        if label:
-            l = ax.legend(**plot_config['legend'])
-            if plot_config['legend_font_color']:
-                for t in l.get_texts():
-                    t.set_color(plot_config['legend_font_color'])
-
-    fig.colorbar(img, cax=cax, label='Gamma-Like Events')
-
-    if preliminary:
-        add_preliminary(
-            plot_config['preliminary_position'],
-            size=plot_config['preliminary_size'],
-            color=plot_config['preliminary_color'],
+    with profiler.stage('plotting'):
+        ax, img = plot_skymap(
+            events,
+            width=width,
+            bins=bins,
+            center_ra=center_ra,
+            center_dec=center_dec,
             ax=ax,
-            zorder=3,
         )
 
-    fig.tight_layout(pad=0)
+        if coord:
+            ax.plot(
+                center_ra,
+                center_dec,
+                label=label,
+                color=plot_config['source_color'],
+                marker='o',
+                linestyle='',
+                markersize=plot_config['source_size'],
+                markerfacecolor='none',
+            )
+            if label:
+                l = ax.legend(**plot_config['legend'])
+                if plot_config['legend_font_color']:
+                    for t in l.get_texts():
+                        t.set_color(plot_config['legend_font_color'])
+
+        fig.colorbar(img, cax=cax, label='Gamma-Like Events')
+
+        if preliminary:
+            add_preliminary(
+                plot_config['preliminary_position'],
+                size=plot_config['preliminary_size'],
+                color=plot_config['preliminary_color'],
+                ax=ax,
+                zorder=3,
+            )
+
+        fig.tight_layout(pad=0)
+
     if output:
-        fig.savefig(output, dpi=300)
+        with profiler.stage('writing'):
+            fig.savefig(output, dpi=300)
     else:
         plt.show()
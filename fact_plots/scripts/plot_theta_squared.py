@@ -1,3 +1,5 @@
+import os
+
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
@@ -5,11 +7,30 @@ from ruamel.yaml import YAML
 from dateutil.parser import parse as parse_date
 
 from fact.io import read_h5py
-from fact.analysis import li_ma_significance
 import click
 
 from ..plotting import add_preliminary
-from ..time import read_timestamp
+from ..gti import GTI, TimeWindows, build_gti
+from ..time import gti_rows
+from ..profiling import profiler, profile_command
+from ..selection import select_rows
+from ..histograms import iter_chunks
+from ..cache import DiskCache, DEFAULT_CACHE_DIR
+from ..theta_squared import (
+    BASE_BIN_WIDTH,
+    RUN_ID_FACTOR,
+    base_bins,
+    cut_scan,
+    read_theta,
+    rebin,
+    run_histograms,
+    stats_from_histograms,
+    theta_squared_bins,
+    theta_squared_histograms,
+    theta_squared_stats,
+    window_histograms,
+    window_stats,
+)
 
 yaml = YAML(typ='safe')
 
@@ -21,40 +42,386 @@ plot_config = {
     'legend_loc': 'center right'
 }
 
-columns = [
-    'theta_deg',
-    'theta_deg_off_1',
-    'theta_deg_off_2',
-    'theta_deg_off_3',
-    'theta_deg_off_4',
-    'theta_deg_off_5',
-]
-
 tex = plt.rcParams['text.usetex'] or (plt.get_backend() == 'pgf')
 
 stats_box_template = r'''Source: {source}, $t_{{\mathrm{{obs}}}} = {t_obs:.1f}\,\mathrm{{h}}$
-$N_{{\mathrm{{On}}}} = {n_on}$, $N_{{\mathrm{{Off}}}} = {n_off}$, $\alpha = {alpha}$
+$N_{{\mathrm{{On}}}} = {n_on}$, $N_{{\mathrm{{Off}}}} = {n_off}$, $\alpha = {alpha:.3g}$
 $N_{{\mathrm{{Exc}}}} = {n_excess:.1f} \pm {n_excess_err:.1f}$, $S_{{\mathrm{{Li&Ma}}}} = {significance:.1f}\,\sigma$
 '''
+significance_label = r'$S_{\mathrm{Li&Ma}} \,\, / \,\, \sigma$'
 
 if tex:
     stats_box_template = stats_box_template.replace('&', '\&')
+    significance_label = significance_label.replace('&', '\&')
+
+
+def read_prediction(data_path, key, rows=None):
+    '''The gamma prediction of the events `rows`'''
+    prediction = [np.empty(0)]
+    for chunk in iter_chunks(data_path, ['gamma_prediction'], key=key, rows=rows):
+        prediction.append(chunk['gamma_prediction'])
+    return np.concatenate(prediction)
+
+
+def plot_theta_squared(
+    bins, h_on, h_off, stats, theta2_cut, source, t_obs,
+    preliminary=False, ymax=None, output=None,
+):
+    '''Plot the on and scaled off theta² histograms with a box of the `stats`, `t_obs` in hours'''
+    alpha = stats['alpha']
+
+    with profiler.stage('plotting'):
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 1, 1)
+        ax.stairs(alpha * h_off, bins, fill=True, color='lightgray', zorder=0)
+
+        bin_center = bins[1:] - np.diff(bins) * 0.5
+        bin_width = np.diff(bins)
+
+        ax.errorbar(
+            bin_center,
+            h_on,
+            yerr=np.sqrt(h_on),
+            xerr=bin_width / 2,
+            linestyle='',
+            label='On',
+        )
+
+        ax.errorbar(
+            bin_center,
+            alpha * h_off,
+            yerr=alpha * np.sqrt(h_off),
+            xerr=bin_width / 2,
+            linestyle='',
+            label='Off',
+            zorder=1
+        )
+
+        ax.axvline(theta2_cut, color='black', alpha=0.3, linestyle='--')
+
+        ax.text(
+            0.5, 0.95,
+            stats_box_template.format(source=source, t_obs=t_obs, **stats),
+            transform=ax.transAxes,
+            va='top',
+            ha='center',
+        )
+
+        if preliminary:
+            add_preliminary(
+                plot_config['preliminary_position'],
+                size=plot_config['preliminary_size'],
+                color=plot_config['preliminary_color'],
+                ax=ax,
+            )
+
+        if ymax:
+            ax.set_ylim(0, ymax)
+
+        ax.set_xlim(0, bins.max())
+        ax.set_xlabel(plot_config['xlabel'])
+        ax.legend(loc=plot_config['legend_loc'])
+        fig.tight_layout(pad=0)
+
+    if output:
+        with profiler.stage('writing'):
+            fig.savefig(output, dpi=300)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def theta_squared_from_events(data_path, bins, theta2_cut, threshold, alpha, gti, key, n_off=None):
+    '''theta² histograms and stats of all selected events'''
+    with profiler.stage('selection'):
+        rows = None
+        if gti is not None:
+            # only the events in the good time intervals are read from here on
+            rows = gti_rows(data_path, gti, key=key)
+
+        if threshold > 0 and rows is None:
+            rows = select_rows(data_path, {'gamma_prediction': ['>=', threshold]}, key=key)
+        elif threshold > 0:
+            rows = rows[read_prediction(data_path, key, rows) >= threshold]
+
+    with profiler.stage('read'):
+        theta_on, theta_off = read_theta(data_path, key=key, rows=rows, n_off=n_off)
+
+    with profiler.stage('histograms'):
+        h_on, h_off = theta_squared_histograms(theta_on, theta_off, bins)
+        stats = theta_squared_stats(theta_on, theta_off, theta2_cut, alpha=alpha)
+    return h_on, h_off, stats
+
+
+def theta_squared_from_runs(
+    data_path, runs, bins, theta2_cut, threshold, alpha, cache, key, time_selection, n_off=None,
+):
+    '''
+    theta² histograms and stats summed from the cached histograms of each run,
+    with a time selection only of the runs in `runs`
+    '''
+    with profiler.stage('histograms'):
+        run_ids, run_on, run_off, n_regions = run_histograms(
+            data_path, threshold=threshold if threshold > 0 else None, cache=cache, key=key, n_off=n_off,
+        )
+
+    if time_selection:
+        selected = np.isin(
+            run_ids[:, 0] * RUN_ID_FACTOR + run_ids[:, 1],
+            runs['night'].values.astype(np.int64) * RUN_ID_FACTOR + runs['run_id'].values,
+        )
+        run_on, run_off = run_on[selected], run_off[selected]
+
+    total_on, total_off = run_on.sum(axis=0), run_off.sum(axis=0)
+    h_on, h_off = rebin(np.stack([total_on, total_off]), base_bins(), bins)
+    stats = stats_from_histograms(total_on, total_off, base_bins(), theta2_cut, n_regions, alpha=alpha)
+    return h_on, h_off, stats
+
+
+def window_output(output, label):
+    '''Output file of one time window, `{window}` in `output` is replaced by the label or it is appended'''
+    if '{window}' in output:
+        return output.format(window=label)
+    root, ext = os.path.splitext(output)
+    return '{}_{}{}'.format(root, label, ext)
+
+
+def theta_squared_windows(
+    data_path, runs, windows, gti, bins, theta2_cut, threshold, alpha, key,
+    n_off=None, preliminary=False, ymax=None, output=None, table=None,
+):
+    '''
+    One theta² plot and stats row per time window of `windows`,
+    reading the events of all windows only once.
+    `runs` are the runs before applying `gti` to them.
+    '''
+    selection = windows.gti() if gti is None else windows.gti().intersect(gti)
+
+    with profiler.stage('selection'):
+        rows, timestamps = gti_rows(data_path, selection, key=key, return_timestamps=True)
+        if threshold > 0:
+            selected = read_prediction(data_path, key, rows) >= threshold
+            rows, timestamps = rows[selected], timestamps[selected]
+        window = windows.window_index(timestamps)
+
+    with profiler.stage('read'):
+        theta_on, theta_off = read_theta(data_path, key=key, rows=rows, n_off=n_off)
+
+    with profiler.stage('histograms'):
+        h_on, h_off = window_histograms(theta_on, theta_off, window, len(windows), bins)
+        stats = window_stats(theta_on, theta_off, window, len(windows), theta2_cut, alpha=alpha)
+
+    table_rows = []
+    for i, (label, start, stop) in enumerate(windows):
+        window_gti = GTI([start], [stop])
+        if gti is not None:
+            window_gti = window_gti.intersect(gti)
+        window_runs = window_gti.select_runs(runs)
+        if len(window_runs) == 0 and h_on[i].sum() == 0 and h_off[i].sum() == 0:
+            print('Skipping {}, no data'.format(label))
+            continue
+
+        window_stats_row = {k: v if k == 'alpha' else v[i] for k, v in stats.items()}
+        t_obs = window_runs.ontime.sum() / 3600
+        print('{}: N_on {}, N_off {}, Li&Ma: {}'.format(
+            label, window_stats_row['n_on'], window_stats_row['n_off'], window_stats_row['significance'],
+        ))
+        table_rows.append(dict(
+            window=label,
+            start=pd.Timestamp(start),
+            stop=pd.Timestamp(stop),
+            t_obs=t_obs,
+            **window_stats_row,
+        ))
+
+        plot_theta_squared(
+            bins, h_on[i], h_off[i], window_stats_row, theta2_cut,
+            source=window_runs.source.iloc[0] if len(window_runs) > 0 else '',
+            t_obs=t_obs,
+            preliminary=preliminary, ymax=ymax, output=window_output(output, label),
+        )
+
+    if table is not None:
+        with profiler.stage('writing'):
+            columns = [
+                'window', 'start', 'stop', 't_obs',
+                'n_on', 'n_off', 'alpha', 'n_excess', 'n_excess_err', 'significance',
+            ]
+            pd.DataFrame(table_rows, columns=columns).to_csv(table, index=False)
+
+
+def plot_cut_scan(
+    data_path, runs, thresholds, theta2_cuts, alpha, gti, key,
+    preliminary=False, output=None, table=None, n_off=None,
+):
+    '''
+    Plot the Li&Ma significance for all combinations of `thresholds`
+    on the gamma prediction and `theta2_cuts` as a heatmap,
+    reading the events only once
+    '''
+    with profiler.stage('selection'):
+        rows = None
+        if gti is not None:
+            rows = gti_rows(data_path, gti, key=key)
+
+    with profiler.stage('read'):
+        prediction = read_prediction(data_path, key, rows)
+
+        # events below the lowest threshold are not needed at all
+        selected = np.flatnonzero(prediction >= thresholds[0])
+        prediction = prediction[selected]
+        rows = selected if rows is None else rows[selected]
+        theta_on, theta_off = read_theta(data_path, key=key, rows=rows, n_off=n_off)
+
+    with profiler.stage('histograms'):
+        stats = cut_scan(theta_on, theta_off, prediction, thresholds, theta2_cuts, alpha=alpha)
+
+    significance = stats['significance']
+    best = np.unravel_index(np.argmax(significance), significance.shape)
+    print('Best cuts: threshold {:.3f}, theta2 cut {:.4f}'.format(
+        thresholds[best[0]], theta2_cuts[best[1]],
+    ))
+    print('N_on', stats['n_on'][best])
+    print('N_off', stats['n_off'][best])
+    print('Li&Ma: {}'.format(significance[best]))
+
+    if table is not None:
+        with profiler.stage('writing'):
+            threshold_grid, theta2_grid = np.meshgrid(thresholds, theta2_cuts, indexing='ij')
+            df = pd.DataFrame({
+                'threshold': threshold_grid.ravel(),
+                'theta2_cut': theta2_grid.ravel(),
+                'n_on': stats['n_on'].ravel(),
+                'n_off': stats['n_off'].ravel(),
+                'n_excess': stats['n_excess'].ravel(),
+                'n_excess_err': stats['n_excess_err'].ravel(),
+                'significance': significance.ravel(),
+            })
+            df.to_csv(table, index=False)
+
+    with profiler.stage('plotting'):
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 1, 1)
+
+        mesh = ax.pcolormesh(thresholds, theta2_cuts, significance.T, shading='nearest')
+        fig.colorbar(mesh, ax=ax, label=significance_label)
+        ax.plot(thresholds[best[0]], theta2_cuts[best[1]], 'wx')
+
+        if preliminary:
+            add_preliminary(
+                plot_config['preliminary_position'],
+                size=plot_config['preliminary_size'],
+                color=plot_config['preliminary_color'],
+                ax=ax,
+            )
+
+        if len(runs) > 0:
+            ax.set_title(r'{}, $t_{{\mathrm{{obs}}}} = {:.1f}\,\mathrm{{h}}$'.format(
+                runs.source.iloc[0], runs.ontime.sum() / 3600,
+            ))
+        ax.set_xlabel('gamma_prediction threshold')
+        ax.set_ylabel(plot_config['xlabel'] + ' cut')
+        fig.tight_layout(pad=0)
+
+    if output:
+        with profiler.stage('writing'):
+            fig.savefig(output, dpi=300)
+    else:
+        plt.show()
 
 
 @click.command()
+@profile_command
 @click.argument('data_path')
 @click.option('--threshold', type=float, help='prediction threshold', default=0.8, show_default=True)
 @click.option('--theta2-cut', type=float, help='cut for theta^2 in deg^2', default=0.03, show_default=True)
 @click.option('--key', help='Key for the hdf5 group', default='events')
 @click.option('--bins', help='Number of bins in the histogram', default=40, show_default=True)
-@click.option('--alpha', help='Ratio of on vs off region', default=0.2, show_default=True)
+@click.option(
+    '--alpha', type=float,
+    help='Ratio of on vs off region, default: one over the number of off regions',
+)
 @click.option('--start', help='First timestamp to consider', type=parse_date)
 @click.option('--end', help='last timestamp to consider', type=parse_date)
+@click.option(
+    '--gti', 'gti_file', type=click.Path(exists=True, dir_okay=False),
+    help='File with good time intervals, one "start, stop" per line, combined with --start/--end',
+)
+@click.option(
+    '--run-selection',
+    help='Only use the time of runs passing this query on the runs table, e.g. "fOnTime > 0.9"',
+)
+@click.option(
+    '--n-off', type=click.IntRange(min=1),
+    help=(
+        'Compute theta for this many off positions from the source position columns'
+        ' instead of reading the theta_deg_off_<i> columns'
+    ),
+)
 @click.option('--preliminary', is_flag=True, help='Add preliminary')
 @click.option('--ymax', type=float, help='The upper ylim')
 @click.option('-c', '--config', help='Path to yaml config file')
 @click.option('-o', '--output', help='(optional) Output file for the plot')
-def main(data_path, threshold, theta2_cut, key, bins, alpha, start, end, preliminary, ymax, config, output):
+@click.option(
+    '--run-cache', is_flag=True,
+    help=(
+        'Keep the theta^2 histograms of each run in the cache directory,'
+        ' so only runs not seen before or reprocessed since are read.'
+        ' With --start/--end, --gti or --run-selection, only runs completely inside are used'
+    ),
+)
+@click.option(
+    '--cache-dir', default=DEFAULT_CACHE_DIR, show_default=True,
+    help='Directory for --run-cache, also set by FACT_PLOTS_CACHE_DIR',
+)
+@click.option(
+    '--max-cache-size', type=float, default=1024, show_default=True,
+    help='Maximum size of the cache in MB, least recently used entries are removed',
+)
+@click.option(
+    '--windows', 'windows_file', type=click.Path(exists=True, dir_okay=False),
+    help=(
+        'Make one plot per time window in this file, one "start, stop" per line,'
+        ' reading the events only once. The window is added to the output file name,'
+        ' or replaces "{window}" in it'
+    ),
+)
+@click.option(
+    '--split',
+    help=(
+        'Make one plot per period of this pandas frequency, e.g. "M" for months'
+        ' or "Y" for years, like --windows'
+    ),
+)
+@click.option(
+    '--stats-table', type=click.Path(dir_okay=False),
+    help='With --windows or --split, write N_on, N_off, excess and significance of each window as csv',
+)
+@click.option(
+    '--scan', is_flag=True,
+    help=(
+        'Instead of the theta^2 plot, plot the Li&Ma significance for a grid'
+        ' of prediction thresholds and theta^2 cuts, reading the file only once'
+    ),
+)
+@click.option(
+    '--scan-thresholds', type=(float, float, int), default=(0.5, 0.99, 50), show_default=True,
+    help='Lowest and highest prediction threshold and number of thresholds for --scan',
+)
+@click.option(
+    '--scan-theta2-cuts', type=(float, float, int), default=(0.005, 0.1, 20), show_default=True,
+    help='Lowest and highest theta^2 cut and number of cuts for --scan',
+)
+@click.option(
+    '--scan-table', type=click.Path(dir_okay=False),
+    help='Write N_on, N_off, excess and significance of all cuts of --scan as csv to this file',
+)
+def main(
+    data_path, threshold, theta2_cut, key, bins, alpha, start, end, gti_file, run_selection, n_off,
+    preliminary, ymax, config, output,
+    run_cache, cache_dir, max_cache_size, windows_file, split, stats_table,
+    scan, scan_thresholds, scan_theta2_cuts, scan_table,
+):
     '''
     Given the DATA_PATH to a data hdf5 file (e.g. the output of ERNAs gather scripts)
     this script will create the infamous theta square plot.
@@ -68,12 +435,23 @@ def main(data_path, threshold, theta2_cut, key, bins, alpha, start, end, prelimi
 
     The HDF files are expected to a have a group called 'runs' and a group called 'events'
     The events group has to have the columns:
-        'theta',
+        'theta_deg',
         'theta_deg_off_1',
-        'theta_deg_off_2',
-        'theta_deg_off_3',
-        'theta_deg_off_4',
-        'theta_deg_off_5',
+        ...
+        'theta_deg_off_<n>',
+    all off regions found are used.
+
+    With --n-off, these columns are not needed. Instead, theta is computed
+    for the on and the given number of off positions from the columns
+        'source_x_prediction', 'source_y_prediction',
+        'source_position_x', 'source_position_y'.
+
+    Time selections by --start/--end, --gti and --run-selection are combined
+    into one set of good time intervals. Only events inside the intervals
+    are used and the ontime of runs partially inside is scaled by the covered fraction.
+
+    With --windows or --split, one plot is made for each time window,
+    all from a single read of the events.
 
     If a prediction threshold is to be used, also 'gamma_prediction',
     must be in the group.
@@ -84,132 +462,97 @@ def main(data_path, threshold, theta2_cut, key, bins, alpha, start, end, prelimi
         with open(config) as f:
             plot_config.update(yaml.safe_load(f))
 
-    theta_cut = np.sqrt(theta2_cut)
-
-    if threshold > 0.0:
-        columns.append('gamma_prediction')
-
-    events = read_h5py(data_path, key='events', columns=columns)
-
-    if start or end:
-        events['timestamp'] = read_timestamp(data_path)
-
-    try:
-        runs = read_h5py(data_path, key='runs')
-        runs['run_start'] = pd.to_datetime(runs['run_start'])
-        runs['run_stop'] = pd.to_datetime(runs['run_stop'])
-    except IOError:
-        runs = pd.DataFrame(columns=['run_start', 'run_stop', 'ontime', 'source'])
-
-    if start is not None:
-        events = events.query('timestamp >= @start')
-        runs = runs.query('run_start >= @start')
-    if end is not None:
-        events = events.query('timestamp <= @end')
-        runs = runs.query('run_stop <= @end')
-
-    if threshold > 0:
-        selected = events.query('gamma_prediction >= {}'.format(threshold))
+    with profiler.stage('read'):
+        try:
+            runs = read_h5py(data_path, key='runs')
+            runs['run_start'] = pd.to_datetime(runs['run_start'])
+            runs['run_stop'] = pd.to_datetime(runs['run_stop'])
+        except IOError:
+            runs = pd.DataFrame(columns=['night', 'run_id', 'run_start', 'run_stop', 'ontime', 'source'])
+        profiler.add_rows(len(runs))
+
+    if scan and run_cache:
+        raise click.UsageError('--scan can not be combined with --run-cache')
+    batch = windows_file is not None or split is not None
+    if batch and (run_cache or scan):
+        raise click.UsageError('--windows and --split can not be combined with --run-cache or --scan')
+    if batch and not output:
+        raise click.UsageError('--windows and --split need an --output')
+    if windows_file is not None and split is not None:
+        raise click.UsageError('Use either --windows or --split')
+
+    with profiler.stage('selection'):
+        try:
+            gti = build_gti(start, end, gti_file, runs, run_selection)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--gti')
+
+        if batch:
+            try:
+                if windows_file is not None:
+                    windows = TimeWindows.from_file(windows_file)
+                else:
+                    if (start is None or end is None) and len(runs) == 0:
+                        raise click.UsageError('--split needs --start and --end without a runs table')
+                    windows = TimeWindows.periodic(
+                        start if start is not None else runs.run_start.min(),
+                        end if end is not None else runs.run_stop.max(),
+                        split,
+                    )
+            except ValueError as e:
+                raise click.BadParameter(str(e), param_hint='--windows/--split')
+
+        if gti is not None and not batch:
+            runs = gti.select_runs(runs)
+            if run_cache:
+                # the cached histograms are per run, so partial runs can't be used
+                runs = runs[np.isclose(runs['ontime_fraction'], 1)]
+
+    if batch:
+        theta_squared_windows(
+            data_path, runs, windows, gti,
+            theta_squared_bins(theta2_cut, n_bins=bins), theta2_cut, threshold, alpha, key,
+            n_off=n_off, preliminary=preliminary, ymax=ymax, output=output, table=stats_table,
+        )
+        return
+
+    if scan:
+        plot_cut_scan(
+            data_path, runs,
+            np.linspace(*scan_thresholds),
+            np.linspace(*scan_theta2_cuts),
+            alpha, gti, key,
+            preliminary=preliminary, output=output, table=scan_table, n_off=n_off,
+        )
+        return
+
+    if run_cache:
+        cache = DiskCache(cache_dir, max_size=int(max_cache_size * 1024**2))
+        try:
+            bins = theta_squared_bins(theta2_cut, n_bins=bins, base_width=BASE_BIN_WIDTH)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--theta2-cut')
+        h_on, h_off, stats = theta_squared_from_runs(
+            data_path, runs, bins, theta2_cut, threshold, alpha, cache, key,
+            time_selection=gti is not None, n_off=n_off,
+        )
     else:
-        selected = events
-    theta_on = selected.theta_deg
-    theta_off = pd.concat([
-        selected['theta_deg_off_{}'.format(i)]
-        for i in range(1, 6)
-    ])
-
-    del events
-
-    max_theta2 = 0.3
-    width = max_theta2 / bins
-    rounded_width = theta2_cut / np.round(theta2_cut / width)
-    bins = np.arange(0, max_theta2 + 0.1 * rounded_width, rounded_width)
-
+        bins = theta_squared_bins(theta2_cut, n_bins=bins)
+        h_on, h_off, stats = theta_squared_from_events(
+            data_path, bins, theta2_cut, threshold, alpha, gti, key, n_off=n_off,
+        )
     print('Using {} bins to get theta_cut on a bin edge'.format(len(bins) - 1))
-
-    fig = plt.figure()
-    ax = fig.add_subplot(1, 1, 1)
-    h_on, bin_edges = np.histogram(
-        theta_on.apply(lambda x: x**2).values,
-        bins=bins,
-    )
-    h_off, bin_edges, _ = ax.hist(
-        theta_off.apply(lambda x: x**2).values,
-        bins=bin_edges,
-        weights=np.full(len(theta_off), 0.2),
-        histtype='stepfilled',
-        color='lightgray',
-        zorder=0,
-    )
-
-    bin_center = bin_edges[1:] - np.diff(bin_edges) * 0.5
-    bin_width = np.diff(bin_edges)
-
-    ax.errorbar(
-        bin_center,
-        h_on,
-        yerr=np.sqrt(h_on),
-        xerr=bin_width / 2,
-        linestyle='',
-        label='On',
+    print('N_on', stats['n_on'])
+    print('N_off', stats['n_off'])
+    print('Li&Ma: {}'.format(stats['significance']))
+
+    plot_theta_squared(
+        bins, h_on, h_off, stats, theta2_cut,
+        source=runs.source.iloc[0] if len(runs) > 0 else '',
+        t_obs=runs.ontime.sum() / 3600,
+        preliminary=preliminary, ymax=ymax, output=output,
     )
 
-    ax.errorbar(
-        bin_center,
-        h_off,
-        yerr=alpha * np.sqrt(h_off),
-        xerr=bin_width / 2,
-        linestyle='',
-        label='Off',
-        zorder=1
-    )
-
-    ax.axvline(theta_cut**2, color='black', alpha=0.3, linestyle='--')
-
-    n_on = np.sum(theta_on < theta_cut)
-    n_off = np.sum(theta_off < theta_cut)
-    significance = li_ma_significance(n_on, n_off, alpha=alpha)
-
-    print('N_on', n_on)
-    print('N_off', n_off)
-    print('Li&Ma: {}'.format(significance))
-
-    ax.text(
-        0.5, 0.95,
-        stats_box_template.format(
-            source=runs.source.iloc[0] if len(runs) > 0 else '',
-            t_obs=runs.ontime.sum() / 3600,
-            n_on=n_on, n_off=n_off, alpha=alpha,
-            n_excess=n_on - alpha * n_off,
-            n_excess_err=np.sqrt(n_on + alpha**2 * n_off),
-            significance=significance,
-        ),
-        transform=ax.transAxes,
-        va='top',
-        ha='center',
-    )
-
-    if preliminary:
-        add_preliminary(
-            plot_config['preliminary_position'],
-            size=plot_config['preliminary_size'],
-            color=plot_config['preliminary_color'],
-            ax=ax,
-        )
-
-    if ymax:
-        ax.set_ylim(0, ymax)
-
-    ax.set_xlim(0, bins.max())
-    ax.set_xlabel(plot_config['xlabel'])
-    ax.legend(loc=plot_config['legend_loc'])
-    fig.tight_layout(pad=0)
-
-    if output:
-        fig.savefig(output, dpi=300)
-    else:
-        plt.show()
-
 
 if __name__ == '__main__':
     main()
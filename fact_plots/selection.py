@@ -0,0 +1,103 @@
+import h5py
+import numexpr as ne
+import numpy as np
+
+from .catalog import list_columns
+from .histograms import iter_chunks, DEFAULT_CHUNKSIZE
+from .expressions import Translator, check_boolean, quote
+
+
+OPERATORS = {
+    '<': '<', 'lt': '<',
+    '<=': '<=', 'le': '<=',
+    '==': '==', 'eq': '==',
+    '=': '==',
+    '!=': '!=', 'ne': '!=',
+    '>': '>', 'gt': '>',
+    '>=': '>=', 'ge': '>=',
+}
+
+
+def compile_selection(selection_config, definitions=None, available=None):
+    '''
+    Compile an `event_selection` config block, mapping column names
+    to `[operator, value]`, into a single numexpr expression.
+
+    Instead of a column name, an expression on columns
+    like `width / length` can be used, see `fact_plots.expressions`.
+    Names in `definitions` are replaced by the expressions they define.
+    Keys that are one of the `available` columns are used as column
+    even if they are not python identifiers.
+
+    Columns and values are referenced through placeholder variables,
+    so column names don't have to be valid numexpr identifiers.
+
+    Returns
+    -------
+    expression: str
+        numexpr expression combining all cuts with `&`
+    columns: dict
+        mapping of placeholder variable to column name
+    values: dict
+        mapping of placeholder variable to cut value
+    boolean_columns: set
+        columns used with `not`, see `fact_plots.expressions.check_boolean`
+    '''
+    available = set(available) if available is not None else set()
+    terms = []
+    translator = Translator(definitions=definitions, available=available)
+    values = {}
+    for i, (column, (op, value)) in enumerate(selection_config.items()):
+        if op not in OPERATORS:
+            raise ValueError('Unknown operator "{}" for column "{}"'.format(op, column))
+
+        # numexpr compares strings as bytes
+        if isinstance(value, str):
+            value = value.encode()
+
+        values['v{}'.format(i)] = value
+        source = quote(column) if column in available else column
+        terms.append('({} {} v{})'.format(translator.translate(source), OPERATORS[op], i))
+
+    return ' & '.join(terms), translator.columns, values, translator.boolean_columns
+
+
+def select_rows(path, selection_config, key='events', chunksize=DEFAULT_CHUNKSIZE, definitions=None):
+    '''
+    Evaluate the event selection on the file at `path` chunk by chunk,
+    only the columns used in the selection are read.
+    `definitions` are passed to `compile_selection`.
+
+    Returns
+    -------
+    rows: np.ndarray[int64]
+        sorted indices of the selected rows, to be used as `rows`
+        argument of `fact_plots.histograms.iter_chunks`
+    '''
+    with h5py.File(path, 'r') as f:
+        group = f.get(key)
+        if group is None:
+            raise IOError('File does not contain group "{}"'.format(key))
+        available = list_columns(group)
+
+    expression, columns, values, boolean_columns = compile_selection(
+        selection_config, definitions, available,
+    )
+    if not columns:
+        raise ValueError('Empty event selection')
+
+    # numexpr caches the compiled expression, so only the first chunk pays for it
+    rows = []
+    offset = 0
+    for chunk in iter_chunks(path, set(columns.values()), key=key, chunksize=chunksize):
+        check_boolean(chunk, boolean_columns)
+        local_dict = {var: chunk[column] for var, column in columns.items()}
+        local_dict.update(values)
+
+        selected = ne.evaluate(expression, local_dict=local_dict)
+        rows.append(np.flatnonzero(selected) + offset)
+        offset += len(selected)
+
+    if not rows:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(rows).astype(np.int64, copy=False)
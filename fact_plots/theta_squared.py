@@ -0,0 +1,686 @@
+import hashlib
+import os
+import re
+
+import h5py
+import numexpr as ne
+import numpy as np
+import pandas as pd
+from fact.analysis import li_ma_significance
+from fact.io import to_native_byteorder
+from fact.instrument import camera_distance_mm_to_deg
+
+from .cache import cache_key
+from .catalog import list_columns
+from .histograms import iter_chunks, histogram, resolve_column, DEFAULT_CHUNKSIZE
+from .time import RUN_ID_FACTOR, get_time_index
+
+
+THETA_ON = 'theta_deg'
+THETA_OFF = re.compile(r'theta_deg_off_(\d+)$')
+# reconstructed and true source position in camera coordinates in mm,
+# used to compute theta for any number of off positions
+POSITION_COLUMNS = ['source_x_prediction', 'source_y_prediction', 'source_position_x', 'source_position_y']
+MM_TO_DEG = camera_distance_mm_to_deg(1.0)
+
+# per run histograms are stored with this binning, plots use multiples of it
+BASE_BIN_WIDTH = 0.0005
+BASE_MAX_THETA2 = 0.5
+# increase if the per run histograms change
+RUN_CACHE_VERSION = 2
+RUN_SUMMARY_VERSION = 2
+# number of evenly spaced events of a run hashed to recognise reprocessed runs
+FINGERPRINT_SAMPLES = 16
+
+
+def find_off_columns(path, key='events'):
+    '''Names of the off region theta columns in the file at `path`, in order of the off region'''
+    with h5py.File(path, 'r') as f:
+        group = f.get(key)
+        if group is None:
+            raise IOError('File does not contain group "{}"'.format(key))
+        columns = list_columns(group)
+
+    matches = [(THETA_OFF.match(column), column) for column in columns]
+    off_columns = sorted(
+        (int(m.group(1)), column) for m, column in matches if m is not None
+    )
+    return [column for _, column in off_columns]
+
+
+def off_position_angles(n_off):
+    '''
+    Rotation angles around the camera center of the on position, the first,
+    and of `n_off` wobble symmetric off positions, evenly spaced on the circle
+    through the source position as done by `fact.analysis.calc_off_position`
+    '''
+    return 2 * np.pi * np.arange(n_off + 1) / (n_off + 1)
+
+
+def calc_theta(prediction_x, prediction_y, source_x, source_y, n_off):
+    '''
+    Distance in degrees of the reconstructed source position to the source
+    position and to `n_off` off positions, in a single numexpr kernel
+    over all events and regions.
+
+    Parameters
+    ----------
+    prediction_x, prediction_y: np.ndarray
+        reconstructed source position in camera coordinates in mm
+    source_x, source_y: np.ndarray
+        source position in camera coordinates in mm
+
+    Returns
+    -------
+    theta: np.ndarray
+        shape (n_off + 1, n_events), the first row is the on region
+    '''
+    angles = off_position_angles(n_off)[:, np.newaxis]
+    return ne.evaluate(
+        'factor * sqrt('
+        '(px - (sx * cos(phi) - sy * sin(phi)))**2'
+        ' + (py - (sx * sin(phi) + sy * cos(phi)))**2'
+        ')',
+        local_dict={
+            'px': prediction_x, 'py': prediction_y,
+            'sx': source_x, 'sy': source_y,
+            'phi': angles, 'factor': MM_TO_DEG,
+        },
+    )
+
+
+def chunk_theta(chunk, off_columns=None, n_off=None):
+    '''
+    theta of the on and off regions of a chunk, shape (n_regions, n_events),
+    either from the `off_columns` or, if they are None, computed for
+    `n_off` off positions from the `POSITION_COLUMNS`
+    '''
+    if off_columns is not None:
+        return np.stack([chunk[column] for column in [THETA_ON] + list(off_columns)])
+    return calc_theta(*(chunk[column] for column in POSITION_COLUMNS), n_off=n_off)
+
+
+def read_theta(path, key='events', rows=None, off_columns=None, chunksize=DEFAULT_CHUNKSIZE, n_off=None):
+    '''
+    Read the on and off region theta columns of the file at `path`
+    chunk by chunk into a single preallocated array.
+
+    Parameters
+    ----------
+    path: str
+        path to the hdf5 file
+    key: str
+        name of the hdf5 group
+    rows: array-like[int] or None
+        sorted indices of the selected rows, e.g. from
+        `fact_plots.selection.select_rows`
+    off_columns: list[str] or None
+        off region columns, by default all found by `find_off_columns`
+    chunksize: int or fact_plots.memory.MemoryBudget
+        number of rows read at once
+    n_off: int or None
+        if given, theta is computed with `calc_theta` for `n_off` off positions
+        from the `POSITION_COLUMNS` instead of read from the theta columns
+
+    Returns
+    -------
+    theta_on: np.ndarray
+        shape (n_events, )
+    theta_off: np.ndarray
+        shape (n_events, n_off), a view sharing the memory of `theta_on`
+    '''
+    if n_off is not None:
+        if n_off < 1:
+            raise ValueError('At least one off position is needed, got {}'.format(n_off))
+        columns = POSITION_COLUMNS
+        n_regions = n_off + 1
+    else:
+        if off_columns is None:
+            off_columns = find_off_columns(path, key=key)
+        if not off_columns:
+            raise ValueError('No off region columns "theta_deg_off_<i>" in {}'.format(path))
+        columns = [THETA_ON] + list(off_columns)
+        n_regions = len(columns)
+
+    if rows is not None:
+        n_events = len(rows)
+    else:
+        with h5py.File(path, 'r') as f:
+            n_events = f[key][columns[0]].shape[0]
+
+    # one row per region, so each column of a chunk is copied into contiguous memory
+    theta = np.empty((n_regions, n_events))
+    offset = 0
+    for chunk in iter_chunks(path, columns, key=key, chunksize=chunksize, rows=rows):
+        chunk_values = chunk_theta(chunk, off_columns, n_off)
+        n = chunk_values.shape[1]
+        theta[:, offset:offset + n] = chunk_values
+        offset += n
+
+    return theta[0], theta[1:].T
+
+
+def get_alpha(theta_off, alpha=None):
+    '''Ratio of on to off exposure, by default one over the number of off regions'''
+    if alpha is None:
+        return 1 / theta_off.shape[1]
+    return alpha
+
+
+def theta_squared_histograms(theta_on, theta_off, bins):
+    '''
+    Histograms of theta² of the on events and of the events
+    of all off regions together, unscaled.
+
+    Returns
+    -------
+    h_on: np.ndarray
+    h_off: np.ndarray
+    '''
+    h_on, _ = histogram(np.square(theta_on), bins)
+    # np.square keeps the memory layout of the view, so ravel does not copy
+    h_off, _ = histogram(np.square(theta_off).ravel(order='K'), bins)
+    return h_on, h_off
+
+
+def theta_squared_stats(theta_on, theta_off, theta2_cut, alpha=None):
+    '''
+    Number of on and off events inside `theta2_cut`, the excess
+    and its Li&Ma significance, see `excess_stats`.
+    '''
+    theta_cut = np.sqrt(theta2_cut)
+    n_on = int(np.count_nonzero(theta_on < theta_cut))
+    n_off = int(np.count_nonzero(theta_off < theta_cut))
+    return excess_stats(n_on, n_off, get_alpha(theta_off, alpha))
+
+
+def window_histograms(theta_on, theta_off, window, n_windows, bins):
+    '''
+    `theta_squared_histograms` for each of `n_windows` time windows,
+    `window` is the window index of each event, -1 for none.
+
+    Returns
+    -------
+    h_on: np.ndarray
+    h_off: np.ndarray
+        shape (n_windows, n_bins)
+    '''
+    h_on, _ = histogram(np.square(theta_on), bins, slices=window, n_slices=n_windows)
+    h_off = sum(
+        histogram(np.square(theta_off[:, i]), bins, slices=window, n_slices=n_windows)[0]
+        for i in range(theta_off.shape[1])
+    )
+    return h_on, h_off
+
+
+def window_stats(theta_on, theta_off, window, n_windows, theta2_cut, alpha=None):
+    '''
+    `theta_squared_stats` for each of `n_windows` time windows,
+    `window` is the window index of each event, -1 for none.
+
+    Returns
+    -------
+    stats: dict
+        as returned by `excess_stats`, with arrays of shape (n_windows, )
+    '''
+    theta_cut = np.sqrt(theta2_cut)
+    selected = window >= 0
+    n_on = np.bincount(window[selected & (theta_on < theta_cut)], minlength=n_windows)
+    n_off = sum(
+        np.bincount(window[selected & (theta_off[:, i] < theta_cut)], minlength=n_windows)
+        for i in range(theta_off.shape[1])
+    )
+    return excess_stats(n_on, n_off, get_alpha(theta_off, alpha))
+
+
+def excess_stats(n_on, n_off, alpha):
+    '''
+    Excess and Li&Ma significance of `n_on` and `n_off` events
+
+    Returns
+    -------
+    stats: dict
+        with keys `n_on`, `n_off`, `alpha`, `n_excess`, `n_excess_err`
+        and `significance`
+    '''
+    return {
+        'n_on': n_on,
+        'n_off': n_off,
+        'alpha': alpha,
+        'n_excess': n_on - alpha * n_off,
+        'n_excess_err': np.sqrt(n_on + alpha**2 * n_off),
+        'significance': li_ma_significance(n_on, n_off, alpha=alpha),
+    }
+
+
+def theta_squared_bins(theta2_cut, n_bins=40, max_theta2=0.3, base_width=None):
+    '''
+    Bin edges from 0 to about `max_theta2` with a bin width close to
+    `max_theta2 / n_bins`, chosen so that `theta2_cut` is on a bin edge.
+
+    With `base_width`, the bin width is also a multiple of `base_width`,
+    so the bins can be summed from histograms with that bin width.
+    `theta2_cut` then has to be a multiple of `base_width`.
+    '''
+    width = max_theta2 / n_bins
+    if base_width is None:
+        rounded_width = theta2_cut / np.round(theta2_cut / width)
+    else:
+        n_base = int(np.round(theta2_cut / base_width))
+        if n_base < 1 or not np.isclose(n_base * base_width, theta2_cut):
+            raise ValueError('theta2 cut {} is not a multiple of {}'.format(theta2_cut, base_width))
+        # the divisor of the cut in base bins giving the closest bin width
+        divisors = [k for k in range(1, n_base + 1) if n_base % k == 0]
+        k = min(divisors, key=lambda k: abs(k * base_width - width))
+        rounded_width = k * base_width
+    return np.arange(0, max_theta2 + 0.1 * rounded_width, rounded_width)
+
+
+def base_bins():
+    '''The bin edges of the per run histograms'''
+    n_bins = int(np.round(BASE_MAX_THETA2 / BASE_BIN_WIDTH))
+    return np.linspace(0, BASE_MAX_THETA2, n_bins + 1)
+
+
+def rebin(counts, base_edges, edges):
+    '''
+    Sum the bins of `counts`, binned with `base_edges` along the last axis,
+    into the bins given by `edges`, which all have to be in `base_edges`
+    '''
+    indices = np.searchsorted(base_edges, edges - 0.5 * np.diff(base_edges).min())
+    if indices[-1] >= len(base_edges) or not np.allclose(base_edges[indices], edges):
+        raise ValueError('Bin edges are not a subset of the base binning')
+    return np.add.reduceat(counts[..., :indices[-1]], indices[:-1], axis=-1)
+
+
+class RunIndex:
+    '''
+    The rows of the events of each run (night, run_id) of an events file
+
+    Parameters
+    ----------
+    runs: np.ndarray
+        shape (n_runs, 2), night and run_id of each run
+    starts: np.ndarray
+    stops: np.ndarray
+        the events of run `i` are `order[starts[i]:stops[i]]`
+    order: np.ndarray or None
+        order of the events sorting them by run, None if they already are
+    '''
+    def __init__(self, runs, starts, stops, order=None):
+        self.runs = runs
+        self.starts = starts
+        self.stops = stops
+        self.order = order
+
+    @classmethod
+    def from_file(cls, path, key='events', chunksize=DEFAULT_CHUNKSIZE):
+        '''Build the index from the `night` and `run_id` columns of the file at `path`'''
+        run_keys = [np.empty(0, dtype=np.int64)]
+        for chunk in iter_chunks(path, ['night', 'run_id'], key=key, chunksize=chunksize):
+            run_keys.append(chunk['night'].astype(np.int64) * RUN_ID_FACTOR + chunk['run_id'])
+        run_keys = np.concatenate(run_keys)
+
+        # files are usually written run by run, so sorting is rarely needed
+        if np.all(run_keys[1:] >= run_keys[:-1]):
+            order = None
+        else:
+            order = np.argsort(run_keys, kind='stable')
+            run_keys = run_keys[order]
+
+        starts = np.flatnonzero(np.diff(run_keys, prepend=-1) != 0)
+        stops = np.append(starts[1:], len(run_keys))
+        runs = np.column_stack(np.divmod(run_keys[starts], RUN_ID_FACTOR))
+        return cls(runs, starts, stops, order)
+
+    @classmethod
+    def from_time_index(cls, path, key='events', chunksize=DEFAULT_CHUNKSIZE):
+        '''
+        Take the run boundaries from the stored `fact_plots.time.TimeIndex`,
+        so the run columns don't have to be read again,
+        falling back to `from_file` if the index has none
+        '''
+        try:
+            time_index = get_time_index(path, key=key, chunksize=chunksize)
+        except KeyError:
+            time_index = None
+
+        if time_index is None or len(time_index.runs) == 0:
+            return cls.from_file(path, key=key, chunksize=chunksize)
+        return cls(time_index.runs, time_index.run_starts, time_index.run_stops)
+
+    @property
+    def n_events(self):
+        return self.stops - self.starts
+
+    def rows(self, indices):
+        '''
+        Sorted rows of the events of the runs `indices`
+        and for each row the position of its run in `indices`
+        '''
+        rows = [np.empty(0, dtype=np.int64)]
+        for i in indices:
+            if self.order is None:
+                rows.append(np.arange(self.starts[i], self.stops[i]))
+            else:
+                rows.append(self.order[self.starts[i]:self.stops[i]])
+        rows = np.concatenate(rows)
+        positions = np.repeat(np.arange(len(indices)), self.n_events[indices])
+
+        if self.order is not None:
+            sort = np.argsort(rows, kind='stable')
+            rows, positions = rows[sort], positions[sort]
+        return rows, positions
+
+    def fingerprints(self, path, indices, columns, key='events', n_samples=FINGERPRINT_SAMPLES):
+        '''
+        A fingerprint of the content of each of the runs `indices`:
+        a hash of `columns` of `n_samples` evenly spaced events of the run.
+        Reprocessing a run, e.g. with a new separation model, changes
+        the values of nearly all of its events, so this recognises it
+        without reading the whole run.
+
+        Returns
+        -------
+        fingerprints: np.ndarray
+            non negative int64 per run
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        fingerprints = np.zeros(len(indices), dtype=np.int64)
+        if len(indices) == 0:
+            return fingerprints
+
+        n_events = self.n_events[indices]
+        steps = np.arange(n_samples) * (n_events[:, np.newaxis] - 1) // max(n_samples - 1, 1)
+        positions = self.starts[indices, np.newaxis] + steps
+        rows = positions if self.order is None else self.order[positions]
+        # h5py needs increasing indices, so every sampled row is read once in order
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        inverse = inverse.reshape(rows.shape)
+
+        samples = []
+        with h5py.File(path, 'r') as f:
+            group = f[key]
+            for column in columns:
+                dataset, index = resolve_column(group, column)
+                if index is None:
+                    array = dataset[unique_rows]
+                else:
+                    array = dataset[unique_rows, index]
+                samples.append(to_native_byteorder(array)[inverse])
+
+        for i in range(len(indices)):
+            digest = hashlib.sha256()
+            for values in samples:
+                digest.update(values[i].tobytes())
+            fingerprints[i] = int(digest.hexdigest()[:15], 16)
+        return fingerprints
+
+
+def theta_columns(path, key='events', n_off=None):
+    '''
+    The off region columns, number of off regions and columns to read
+    for `chunk_theta`, computing theta for `n_off` off positions if given
+    '''
+    if n_off is not None:
+        return None, n_off, list(POSITION_COLUMNS)
+
+    off_columns = find_off_columns(path, key=key)
+    if not off_columns:
+        raise ValueError('No off region columns "theta_deg_off_<i>" in {}'.format(path))
+    return off_columns, len(off_columns), [THETA_ON] + off_columns
+
+
+def run_histograms(path, threshold=None, cache=None, key='events', chunksize=DEFAULT_CHUNKSIZE, n_off=None):
+    '''
+    theta² histograms of the on region and of all off regions together
+    for each run in the file at `path`, binned with `base_bins`.
+
+    With a `fact_plots.cache.DiskCache` as `cache`, the histograms
+    of each run are stored, so only the events of runs not seen before
+    are read, e.g. after new runs were added to the file.
+    Stored runs are recognised by their number of events and
+    `RunIndex.fingerprints`, so reprocessed runs are read again.
+
+    Parameters
+    ----------
+    threshold: float or None
+        only events with a `gamma_prediction` of at least `threshold` are used
+    n_off: int or None
+        compute theta for `n_off` off positions, see `read_theta`
+
+    Returns
+    -------
+    runs: np.ndarray
+        shape (n_runs, 2), night and run_id of each run
+    h_on: np.ndarray
+    h_off: np.ndarray
+        shape (n_runs, n_base_bins)
+    n_regions: int
+        number of off regions
+    '''
+    # n_off stays None when the stored columns are used, so chunk_theta reads them
+    off_columns, n_regions, columns = theta_columns(path, key=key, n_off=n_off)
+    index = RunIndex.from_time_index(path, key=key, chunksize=chunksize)
+    edges = base_bins()
+    n_bins = len(edges) - 1
+
+    if threshold is not None:
+        columns.append('gamma_prediction')
+
+    # the number of events and a sample of their values detect runs that were reprocessed
+    fingerprints = index.fingerprints(path, np.arange(len(index.runs)), columns, key=key)
+    keys = [
+        cache_key(
+            'theta2_run', RUN_CACHE_VERSION, os.path.abspath(path), key,
+            int(night), int(run_id), int(n_events), int(fingerprint), threshold, off_columns or n_off,
+            BASE_BIN_WIDTH, BASE_MAX_THETA2,
+        )
+        for (night, run_id), n_events, fingerprint in zip(index.runs, index.n_events, fingerprints)
+    ]
+
+    hists = np.zeros((len(keys), 2, n_bins))
+    missing = []
+    for i, run_key in enumerate(keys):
+        cached = cache.get(run_key) if cache is not None else None
+        if cached is None:
+            missing.append(i)
+        else:
+            hists[i] = cached
+
+    if missing:
+        # one slice per missing run, so all of them are filled in one pass
+        rows, positions = index.rows(missing)
+        filled = np.zeros((2, len(missing), n_bins))
+        offset = 0
+        for chunk in iter_chunks(path, columns, key=key, chunksize=chunksize, rows=rows):
+            theta = chunk_theta(chunk, off_columns, n_off)
+            n = theta.shape[1]
+            slices = positions[offset:offset + n]
+            offset += n
+            if threshold is not None:
+                slices = np.where(chunk['gamma_prediction'] >= threshold, slices, -1)
+
+            filled[0] += histogram(
+                np.square(theta[0]), edges, slices=slices, n_slices=len(missing),
+            )[0]
+            for region in theta[1:]:
+                filled[1] += histogram(
+                    np.square(region), edges, slices=slices, n_slices=len(missing),
+                )[0]
+
+        hists[missing] = filled.transpose(1, 0, 2)
+        if cache is not None:
+            for i in missing:
+                cache.put(keys[i], hists[i].astype(np.int32), evict=False)
+            cache.evict()
+
+    return index.runs, hists[:, 0], hists[:, 1], n_regions
+
+
+def run_summary(
+    path, threshold, theta2_cut, cache=None, key='events', chunksize=DEFAULT_CHUNKSIZE, n_off=None,
+    runs=None,
+):
+    '''
+    Number of on and off events of each run in the file at `path` with
+    a `gamma_prediction` of at least `threshold` and theta² up to `theta2_cut`,
+    counted like `fact.analysis.calc_run_summary_source_independent`.
+
+    With a `fact_plots.cache.DiskCache` as `cache`, the counts of all runs
+    are stored in one entry per file and cuts, so only the events of runs
+    not seen before are read, e.g. after new runs were added to the file.
+    Like in `run_histograms`, stored runs are recognised by their number
+    of events and `RunIndex.fingerprints`, so reprocessed runs are read again.
+
+    Parameters
+    ----------
+    runs: pd.DataFrame or None
+        only summarize the runs with the `night` and `run_id` of these,
+        e.g. the runs inside a time selection, by default all
+
+    Returns
+    -------
+    counts: pd.DataFrame
+        with columns `night`, `run_id`, `n_on` and `n_off`
+    n_regions: int
+        number of off regions
+    '''
+    # n_off stays None when the stored columns are used, so chunk_theta reads them
+    off_columns, n_regions, columns = theta_columns(path, key=key, n_off=n_off)
+    columns = columns + ['gamma_prediction']
+    index = RunIndex.from_time_index(path, key=key, chunksize=chunksize)
+    run_keys = index.runs[:, 0] * RUN_ID_FACTOR + index.runs[:, 1]
+
+    if runs is None:
+        indices = np.arange(len(run_keys))
+    else:
+        wanted = runs['night'].values.astype(np.int64) * RUN_ID_FACTOR + runs['run_id'].values
+        indices = np.flatnonzero(np.isin(run_keys, wanted))
+    run_keys = run_keys[indices]
+    n_events = index.n_events[indices]
+    fingerprints = index.fingerprints(path, indices, columns, key=key)
+
+    store_key = cache_key(
+        'run_summary', RUN_SUMMARY_VERSION, os.path.abspath(path), key,
+        threshold, theta2_cut, off_columns or n_regions,
+    )
+    # one row per run: run key, number of events, fingerprint, n_on, n_off, sorted by run key
+    stored = cache.get(store_key) if cache is not None else None
+
+    counts = np.zeros((len(run_keys), 2), dtype=np.int64)
+    missing = np.arange(len(run_keys))
+    if stored is not None and len(stored) > 0:
+        position = np.clip(np.searchsorted(stored[:, 0], run_keys), 0, len(stored) - 1)
+        # the number of events and a sample of their values detect runs that were reprocessed
+        found = (
+            (stored[position, 0] == run_keys)
+            & (stored[position, 1] == n_events)
+            & (stored[position, 2] == fingerprints)
+        )
+        counts[found] = stored[position[found], 3:]
+        missing = np.flatnonzero(~found)
+
+    if len(missing) > 0:
+        theta_cut = np.sqrt(theta2_cut)
+        rows, positions = index.rows(indices[missing])
+        filled = np.zeros((len(missing), 2), dtype=np.int64)
+        offset = 0
+        for chunk in iter_chunks(path, columns, key=key, chunksize=chunksize, rows=rows):
+            theta = chunk_theta(chunk, off_columns, n_off)
+            n = theta.shape[1]
+            run_positions = positions[offset:offset + n]
+            offset += n
+
+            selected = chunk['gamma_prediction'] >= threshold
+            filled[:, 0] += np.bincount(
+                run_positions[selected & (theta[0] <= theta_cut)], minlength=len(missing),
+            )
+            for region in theta[1:]:
+                filled[:, 1] += np.bincount(
+                    run_positions[selected & (region <= theta_cut)], minlength=len(missing),
+                )
+        counts[missing] = filled
+
+        if cache is not None:
+            table = np.column_stack([run_keys, n_events, fingerprints, counts])
+            if stored is not None:
+                # keep the stored runs that were not summarized this time
+                table = np.concatenate([stored[~np.isin(stored[:, 0], run_keys)], table])
+            cache.put(store_key, table[np.argsort(table[:, 0])])
+
+    counts = pd.DataFrame({
+        'night': index.runs[indices, 0],
+        'run_id': index.runs[indices, 1],
+        'n_on': counts[:, 0],
+        'n_off': counts[:, 1],
+    })
+    return counts, n_regions
+
+
+def stats_from_histograms(h_on, h_off, base_edges, theta2_cut, n_off, alpha=None):
+    '''`theta_squared_stats` from the histograms of `run_histograms`'''
+    n_on, n_off_events = rebin(
+        np.stack([h_on, h_off]), base_edges, np.array([0, theta2_cut]),
+    )[:, 0]
+    if alpha is None:
+        alpha = 1 / n_off
+    return excess_stats(int(n_on), int(n_off_events), alpha)
+
+
+def cut_scan(theta_on, theta_off, prediction, thresholds, theta2_cuts, alpha=None):
+    '''
+    `excess_stats` for every combination of a threshold on `prediction`
+    and a theta² cut, from a single pass over the events.
+
+    The events are histogrammed in (prediction, theta²) with the thresholds
+    and cuts as bin edges, the counts for all cuts are then the cumulative
+    sums of this histogram, from high to low prediction and from low to
+    high theta².
+
+    Parameters
+    ----------
+    theta_on: np.ndarray
+        shape (n_events, )
+    theta_off: np.ndarray
+        shape (n_events, n_off)
+    prediction: np.ndarray
+        shape (n_events, ), e.g. the `gamma_prediction`
+    thresholds: array-like
+        events with a prediction of at least the threshold are selected
+    theta2_cuts: array-like
+        events with a theta² below the cut are counted
+
+    Returns
+    -------
+    stats: dict
+        as returned by `excess_stats`, with arrays of shape
+        (n_thresholds, n_theta2_cuts)
+    '''
+    thresholds = np.asarray(thresholds, dtype=float)
+    theta2_cuts = np.asarray(theta2_cuts, dtype=float)
+    if np.any(np.diff(thresholds) <= 0) or np.any(np.diff(theta2_cuts) <= 0):
+        raise ValueError('Thresholds and theta2 cuts have to be increasing')
+
+    n_thresholds = len(thresholds)
+    n_cuts = len(theta2_cuts)
+
+    # index of the highest threshold an event passes, -1 for none
+    threshold_index = np.searchsorted(thresholds, prediction, side='right') - 1
+    selected = (threshold_index >= 0) & ~np.isnan(prediction)
+    offsets = threshold_index[selected] * n_cuts
+
+    def scan_counts(theta):
+        # index of the lowest cut an event is below, n_cuts for none
+        cut_index = np.searchsorted(theta2_cuts, np.square(theta[selected]), side='right')
+        valid = cut_index < n_cuts
+        counts = np.bincount(
+            offsets[valid] + cut_index[valid],
+            minlength=n_thresholds * n_cuts,
+        ).reshape(n_thresholds, n_cuts)
+        # prediction >= threshold: sum over higher thresholds, theta² < cut: sum over lower cuts
+        return np.cumsum(np.cumsum(counts[::-1], axis=0)[::-1], axis=1)
+
+    n_on = scan_counts(theta_on)
+    n_off = sum(scan_counts(theta_off[:, i]) for i in range(theta_off.shape[1]))
+    return excess_stats(n_on, n_off, get_alpha(theta_off, alpha))
@@ -1,19 +1,250 @@
-from fact.io import read_h5py
+import json
+import os
+import tempfile
+
+import h5py
+import numpy as np
 import pandas as pd
 
+from .cache import DEFAULT_CACHE_DIR, cache_key, file_identity
+from .catalog import list_columns
+from .histograms import iter_chunks, DEFAULT_CHUNKSIZE
+
+
+TIME_INDEX_VERSION = 1
+TIME_INDEX_SUFFIX = '.timeindex.npz'
+# number of rows summarised by one entry of the time index
+TIME_INDEX_BLOCKSIZE = 10000
+# night * RUN_ID_FACTOR + run_id identifies a run by a single integer
+RUN_ID_FACTOR = 10**6
+
+
+def timestamp_columns(columns):
+    '''The columns the event timestamps are stored in, either `timestamp` or `unix_time_utc`'''
+    if 'timestamp' in columns:
+        return ['timestamp']
+    if 'unix_time_utc_0' in columns and 'unix_time_utc_1' in columns:
+        return ['unix_time_utc_0', 'unix_time_utc_1']
+    raise KeyError('File contains neither "timestamp" nor "unix_time_utc"')
+
+
+def chunk_timestamps(chunk):
+    '''Timestamps of a chunk read from the `timestamp_columns` as int64 nanoseconds'''
+    if 'timestamp' in chunk:
+        timestamp = chunk['timestamp']
+        if timestamp.dtype.kind == 'S':
+            timestamp = timestamp.astype(str)
+        return pd.to_datetime(timestamp).values.astype('datetime64[ns]').view(np.int64)
+
+    seconds = chunk['unix_time_utc_0'].astype(np.int64)
+    microseconds = chunk['unix_time_utc_1'].astype(np.int64)
+    return (seconds * 10**6 + microseconds) * 1000
+
+
+class TimeIndex:
+    '''
+    Coarse index of the event timestamps of a file, so rows of a time window
+    or of runs can be found without reading the timestamps of all events.
+
+    Parameters
+    ----------
+    n_rows: int
+        number of events in the file
+    blocksize: int
+        number of rows of each block
+    block_min: np.ndarray
+    block_max: np.ndarray
+        smallest and largest timestamp in int64 nanoseconds of the rows
+        `[i * blocksize, (i + 1) * blocksize)` for each block `i`
+    runs: np.ndarray
+        shape (n_runs, 2), night and run_id of the runs, sorted by their first row,
+        empty if the file has no run columns or the events are not grouped by run
+    run_starts: np.ndarray
+    run_stops: np.ndarray
+        the events of run `i` are the rows `[run_starts[i], run_stops[i])`
+    '''
+    def __init__(self, n_rows, blocksize, block_min, block_max, runs, run_starts, run_stops):
+        self.n_rows = n_rows
+        self.blocksize = blocksize
+        self.block_min = block_min
+        self.block_max = block_max
+        self.runs = runs
+        self.run_starts = run_starts
+        self.run_stops = run_stops
+
+    def candidate_rows(self, gti):
+        '''Rows of all blocks with events inside the good time intervals `gti`'''
+        blocks = np.flatnonzero(gti.overlaps(self.block_min, self.block_max))
+        rows = [np.empty(0, dtype=np.int64)]
+        for block in blocks:
+            first = block * self.blocksize
+            rows.append(np.arange(first, min(first + self.blocksize, self.n_rows)))
+        return np.concatenate(rows)
+
+    def to_arrays(self):
+        return {
+            'n_rows': self.n_rows,
+            'blocksize': self.blocksize,
+            'block_min': self.block_min,
+            'block_max': self.block_max,
+            'runs': self.runs,
+            'run_starts': self.run_starts,
+            'run_stops': self.run_stops,
+        }
+
+
+def build_time_index(path, key='events', blocksize=TIME_INDEX_BLOCKSIZE, chunksize=DEFAULT_CHUNKSIZE):
+    '''Build the `TimeIndex` of the file at `path` in one chunked pass over the timestamps'''
+    with h5py.File(path, 'r') as f:
+        group = f.get(key)
+        if group is None:
+            raise IOError('File does not contain group "{}"'.format(key))
+        available = list_columns(group)
+
+    columns = timestamp_columns(available)
+    has_runs = 'night' in available and 'run_id' in available
+    if has_runs:
+        columns = columns + ['night', 'run_id']
+
+    n_rows = 0
+    block_min = []
+    block_max = []
+    run_keys = [np.empty(0, dtype=np.int64)]
+    for chunk in iter_chunks(path, columns, key=key, chunksize=chunksize):
+        timestamp = chunk_timestamps(chunk)
+
+        # the first block of a chunk may continue the last block of the previous one
+        first = (-n_rows) % blocksize
+        starts = np.arange(first, len(timestamp), blocksize)
+        if first > 0:
+            head = timestamp[:first]
+            block_min[-1] = min(block_min[-1], head.min())
+            block_max[-1] = max(block_max[-1], head.max())
+        if len(starts) > 0:
+            block_min.extend(np.minimum.reduceat(timestamp, starts))
+            block_max.extend(np.maximum.reduceat(timestamp, starts))
+        n_rows += len(timestamp)
 
-def read_timestamp(path):
-    try:
-        timestamp = read_h5py(path, key='events', columns=['timestamp'])
-        timestamp = pd.to_datetime(timestamp['timestamp'])
-    except KeyError:
+        if has_runs:
+            run_keys.append(chunk['night'].astype(np.int64) * RUN_ID_FACTOR + chunk['run_id'])
+
+    run_keys = np.concatenate(run_keys)
+    run_starts = np.flatnonzero(np.diff(run_keys, prepend=-1) != 0)
+    run_stops = np.append(run_starts[1:], len(run_keys)).astype(np.int64)
+    runs = np.column_stack(np.divmod(run_keys[run_starts], RUN_ID_FACTOR))
+    # run boundaries are only usable if every run is one contiguous range of rows
+    if not has_runs or len(np.unique(run_keys[run_starts])) != len(run_starts):
+        runs, run_starts, run_stops = runs[:0], run_starts[:0], run_stops[:0]
+
+    return TimeIndex(
+        n_rows=n_rows,
+        blocksize=blocksize,
+        block_min=np.array(block_min, dtype=np.int64),
+        block_max=np.array(block_max, dtype=np.int64),
+        runs=runs,
+        run_starts=run_starts,
+        run_stops=run_stops,
+    )
+
+
+def time_index_paths(path):
+    '''
+    Candidate locations of the time index for `path`: a sidecar file next to it
+    and, for read only input directories, a file in the cache directory
+    '''
+    return [
+        path + TIME_INDEX_SUFFIX,
+        os.path.join(
+            DEFAULT_CACHE_DIR, 'time_index',
+            cache_key(os.path.abspath(path)) + TIME_INDEX_SUFFIX,
+        ),
+    ]
+
+
+def write_time_index(index, path, key='events'):
+    metadata = json.dumps({
+        'version': TIME_INDEX_VERSION,
+        'identity': file_identity(path),
+        'key': key,
+    })
+    for index_path in time_index_paths(path):
+        directory = os.path.dirname(os.path.abspath(index_path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        except OSError:
+            continue
+
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, metadata=metadata, **index.to_arrays())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, index_path)
+        return index_path
+
+
+def read_time_index(path, key='events'):
+    '''
+    Return the stored `TimeIndex` for `path` or None, if there is none
+    or the file changed since it was built.
+    '''
+    metadata = {
+        'version': TIME_INDEX_VERSION,
+        'identity': file_identity(path),
+        'key': key,
+    }
+    for index_path in time_index_paths(path):
         try:
-            col = 'unix_time_utc'
-            unix_time_utc = read_h5py(path, key='events', columns=[col])
-            timestamp = pd.to_datetime(
-                unix_time_utc[col + '_0'] * 1e6 + unix_time_utc[col + '_1'],
-                unit='us',
-            )
-        except KeyError:
-            raise KeyError('File contains neither "timestamp" nor "unix_time_utc"')
-    return timestamp
+            with np.load(index_path) as f:
+                if json.loads(str(f['metadata'])) != metadata:
+                    continue
+                return TimeIndex(
+                    n_rows=int(f['n_rows']),
+                    blocksize=int(f['blocksize']),
+                    block_min=f['block_min'],
+                    block_max=f['block_max'],
+                    runs=f['runs'],
+                    run_starts=f['run_starts'],
+                    run_stops=f['run_stops'],
+                )
+        except (OSError, ValueError, KeyError):
+            continue
+    return None
+
+
+def get_time_index(path, key='events', chunksize=DEFAULT_CHUNKSIZE):
+    '''Read the time index for `path`, building and storing it if needed'''
+    index = read_time_index(path, key=key)
+    if index is None:
+        index = build_time_index(path, key=key, chunksize=chunksize)
+        write_time_index(index, path, key=key)
+    return index
+
+
+def gti_rows(path, gti, key='events', chunksize=DEFAULT_CHUNKSIZE, return_timestamps=False):
+    '''
+    Sorted rows of the events with a timestamp inside the good time intervals `gti`
+    and, if `return_timestamps`, their timestamps in int64 nanoseconds.
+
+    Using the `TimeIndex` of the file, only the timestamps of the blocks
+    overlapping the intervals are read.
+    '''
+    index = get_time_index(path, key=key, chunksize=chunksize)
+    candidates = index.candidate_rows(gti)
+
+    with h5py.File(path, 'r') as f:
+        columns = timestamp_columns(list_columns(f[key]))
+
+    rows = [np.empty(0, dtype=np.int64)]
+    timestamps = [np.empty(0, dtype=np.int64)]
+    offset = 0
+    for chunk in iter_chunks(path, columns, key=key, chunksize=chunksize, rows=candidates):
+        timestamp = chunk_timestamps(chunk)
+        inside = gti.contains(timestamp)
+        rows.append(candidates[offset:offset + len(timestamp)][inside])
+        if return_timestamps:
+            timestamps.append(timestamp[inside])
+        offset += len(timestamp)
+
+    if return_timestamps:
+        return np.concatenate(rows), np.concatenate(timestamps)
+    return np.concatenate(rows)
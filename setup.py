@@ -14,11 +14,12 @@ setup(
         'docopt',
         'h5py',
         'matplotlib-hep==0.1.0',
-        'matplotlib>=1.5',  # in anaconda
+        'matplotlib>=3.4',  # in anaconda
         'numexpr',
         'numpy',            # in anaconda
         'pandas',           # in anaconda
         'pyfact>=0.24.0',
+        'pypdf',
         'pytest',
         'python-dateutil',  # in anaconda
         'pytz',             # in anaconda